@@ -41,3 +41,29 @@ class ContainerManagerBase(object):  # pragma: no cover
         """
         raise NotImplementedError(
             'ContainerManagerBase().node_registered() must be overridden.')
+
+    def wait_for_node(self, name, timeout=15):
+        """
+        Waits for a node to be registered.
+
+        :param name: The name of the node.
+        :type name: str
+        :param timeout: Seconds to wait before giving up.
+        :type timeout: int
+        :returns: True if registered, otherwise False
+        :rtype: bool
+        """
+        raise NotImplementedError(
+            'ContainerManagerBase().wait_for_node() must be overridden.')
+
+    def remove_node(self, name):
+        """
+        Removes a node from the container manager.
+
+        :param name: The name of the node.
+        :type name: str
+        :returns: True if the node is gone, otherwise False
+        :rtype: bool
+        """
+        raise NotImplementedError(
+            'ContainerManagerBase().remove_node() must be overridden.')
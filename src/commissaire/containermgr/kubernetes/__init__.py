@@ -16,8 +16,15 @@
 The kubernetes container manager package.
 """
 
+import json
+import sys
+
+import gevent
 import requests
 
+from gevent.event import Event
+from requests.adapters import HTTPAdapter
+
 from commissaire.containermgr import ContainerManagerBase
 
 
@@ -26,25 +33,43 @@ class ContainerManager(ContainerManagerBase):
     Kubernetes container manager implementation.
     """
 
-    def __init__(self, config):
+    def __init__(self, config, pool_connections=4, pool_maxsize=32):
         """
         Creates an instance of the Kubernetes Container Manager.
 
         :param config: Configuration information.
         :type config: commissaire.config.Config
+        :param pool_connections: Number of hosts to keep connection pools for.
+        :type pool_connections: int
+        :param pool_maxsize: Number of kept alive connections per host.
+        :type pool_maxsize: int
         """
         ContainerManagerBase.__init__(self)
         self.host = config.kubernetes['uri'].hostname
         self.port = config.kubernetes['uri'].port
         self.con = requests.Session()
+        # Callers wait for a free connection rather than opening extra
+        # ones which would be thrown away
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+            pool_block=True)
+        self.con.mount('http://', adapter)
+        self.con.mount('https://', adapter)
         token = config.kubernetes['token']
         self.con.headers["Authorization"] = "Bearer {0}".format(token)
+        self.con.headers["Connection"] = "keep-alive"
         # TODO: Verify TLS!!!
         self.con.verify = False
         self.base_uri = 'http://{0}:{1}/api/v1'.format(
             self.host, self.port)
-        print('Kubernetes Container Manager: {0}'.format(
-            self.__dict__))
+        self.logger.debug('Kubernetes Container Manager for {0}'.format(
+            self.base_uri))
+        #: Seconds to wait before watching again after an error
+        self.watch_retry = 1
+        #: node name -> gevent.event.Event set while the node is registered
+        self._nodes = {}
+        self._listeners = []
+        self._watcher = None
 
     def _get(self, part, *args, **kwargs):
         """
@@ -69,6 +94,29 @@ class ContainerManager(ContainerManagerBase):
             part, resp.status_code))
         return resp
 
+    def _delete(self, part, *args, **kwargs):
+        """
+        Delete a resource from the Kubernetes apiserver.
+
+        :param part: The URI part. EG: /nodes/10.2.0.2
+        :type part: sdtr
+        :param args: All other non-keyword arguments.
+        :type args: tuple
+        :param kwargs: All other keyword arguments.
+        :type kwargs: dict
+        :returns: requests.Response
+        """
+        # Fix part if it doesn't start with a slash
+        if not part.startswith('/'):
+            part = '/{0}'.format(part)
+
+        self.logger.debug('Executing DELETE for {0}'.format(part))
+        resp = self.con.delete(
+            '{0}{1}'.format(self.base_uri, part), *args, **kwargs)
+        self.logger.debug('Response for {0}. Status: {1}'.format(
+            part, resp.status_code))
+        return resp
+
     def node_registered(self, name):
         """
         Checks is a node was registered.
@@ -85,6 +133,178 @@ class ContainerManager(ContainerManagerBase):
             return True
         return False
 
+    def remove_node(self, name):
+        """
+        Removes a node from the container manager.
+
+        :param name: The name of the node.
+        :type name: str
+        :returns: True if the node is gone, otherwise False
+        :rtype: bool
+        """
+        resp = self._delete('/nodes/{0}'.format(name))
+        # A missing node has already been removed
+        if resp.status_code in (200, 404):
+            return True
+        return False
+
+    def _node_event(self, name):
+        """
+        Returns the registration event for a node, creating it if needed.
+
+        :param name: The name of the node.
+        :type name: str
+        :returns: The registration event.
+        :rtype: gevent.event.Event
+        """
+        event = self._nodes.get(name)
+        if event is None:
+            event = self._nodes[name] = Event()
+        return event
+
+    def _handle_node(self, event_type, node):
+        """
+        Applies a single node event from the apiserver.
+
+        :param event_type: ADDED, MODIFIED or DELETED.
+        :type event_type: str
+        :param node: The node object.
+        :type node: dict
+        """
+        name = node['metadata']['name']
+        if event_type == 'DELETED':
+            self._node_event(name).clear()
+        else:
+            self._node_event(name).set()
+        for listener in self._listeners:
+            try:
+                listener(event_type, node)
+            except:
+                _, exc_msg, _ = sys.exc_info()
+                self.logger.warn('Node listener failed: {0}'.format(exc_msg))
+
+    def add_listener(self, listener):
+        """
+        Registers a callable to receive every node event from the watch.
+
+        :param listener: Called with the event type and the node object.
+        :type listener: callable
+        """
+        self._listeners.append(listener)
+
+    def _list_nodes(self):
+        """
+        Lists all nodes, replacing the known registrations.
+
+        :returns: The resourceVersion to start watching from.
+        :rtype: str
+        :raises: Exception
+        """
+        resp = self._get('/nodes')
+        if resp.status_code != 200:
+            raise Exception('Listing nodes failed: {0}'.format(
+                resp.status_code))
+        node_list = resp.json()
+        registered = set()
+        for node in node_list.get('items', []):
+            self._handle_node('ADDED', node)
+            registered.add(node['metadata']['name'])
+        # Nodes removed while the watch was down
+        for name in set(self._nodes.keys()) - registered:
+            if self._nodes[name].is_set():
+                self._handle_node('DELETED', {'metadata': {'name': name}})
+        return node_list['metadata']['resourceVersion']
+
+    def _watch(self):
+        """
+        Keeps a single list+watch on the nodes running.
+        """
+        while True:
+            try:
+                version = self._list_nodes()
+                resp = self._get(
+                    '/nodes',
+                    params={'watch': 'true', 'resourceVersion': version},
+                    stream=True)
+                try:
+                    # chunk_size=None hands over each event as it arrives
+                    for line in resp.iter_lines(chunk_size=None):
+                        if not line:
+                            continue
+                        event = json.loads(line.decode('utf-8'))
+                        if event['type'] == 'ERROR':
+                            # Usually 410 Gone. List again to catch up.
+                            self.logger.debug(
+                                'Node watch error: {0}'.format(
+                                    event['object']))
+                            break
+                        self._handle_node(event['type'], event['object'])
+                finally:
+                    # Hand the connection back to the pool
+                    resp.close()
+                # The apiserver ended the watch. List and watch again.
+                continue
+            except Exception:
+                # Not a bare except so stop_watch can kill the greenlet
+                _, exc_msg, _ = sys.exc_info()
+                self.logger.warn('Node watch failed: {0}'.format(exc_msg))
+            gevent.sleep(self.watch_retry)
+
+    def watch(self):
+        """
+        Starts following node registrations if not already running.
+        """
+        if self._watcher is None or self._watcher.dead:
+            self._watcher = gevent.spawn(self._watch)
+
+    def stop_watch(self):
+        """
+        Stops following node registrations.
+        """
+        if self._watcher is not None:
+            self._watcher.kill()
+            self._watcher = None
+
+    def wait_for_node(self, name, timeout=15):
+        """
+        Waits for a node to be registered.
+
+        :param name: The name of the node.
+        :type name: str
+        :param timeout: Seconds to wait before giving up.
+        :type timeout: int
+        :returns: True if registered, otherwise False
+        :rtype: bool
+        """
+        self.watch()
+        event = self._node_event(name)
+        event.wait(timeout)
+        return event.is_set()
+
 
 #: Friendly name for the class
 KubeContainerManager = ContainerManager
+
+#: Process wide container managers keyed by (uri, token)
+_MANAGERS = {}
+
+
+def get_container_manager(config):
+    """
+    Returns the process wide container manager for a configuration.
+
+    The manager and its connection pool are shared by every caller so
+    connections to the apiserver are kept alive and reused.
+
+    :param config: Configuration information.
+    :type config: commissaire.config.Config
+    :returns: The shared container manager.
+    :rtype: ContainerManager
+    """
+    key = (config.kubernetes['uri'].geturl(), config.kubernetes['token'])
+    manager = _MANAGERS.get(key)
+    if manager is None:
+        # Only one manager is kept. A new token replaces the old client.
+        _MANAGERS.clear()
+        manager = _MANAGERS[key] = ContainerManager(config)
+    return manager
@@ -0,0 +1,434 @@
+# Copyright (C) 2016  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+In-process event bus fed by a single etcd watch.
+
+Every change under /commissaire is turned into an Event and handed to the
+subscriptions it matches. Subscriptions can ask for a host address, a
+cluster (its record, its operations and its hosts) and/or event types.
+Each subscription has a bounded queue so a slow consumer never holds up
+the watch or the other consumers.
+"""
+
+import json
+import logging
+import sys
+
+import etcd
+import gevent
+
+from gevent.queue import Empty, Full, Queue
+
+
+#: What a subscription does when its queue is full
+OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'close')
+
+#: Key prefix -> kind of the records under it
+KINDS = (
+    ('/commissaire/hosts/', 'host'),
+    ('/commissaire/clusters/', 'cluster'),
+    ('/commissaire/cluster/', 'operation'),
+    ('/commissaire/workers/', 'worker'),
+    ('/commissaire/jobs/', 'job'),
+    ('/commissaire/deleted/hosts/', 'tombstone'),
+)
+
+#: etcd actions removing a key
+DELETE_ACTIONS = ('delete', 'expire', 'compareAndDelete')
+
+
+class SubscriptionClosed(Exception):
+    """
+    Raised when reading from a closed subscription.
+    """
+    pass
+
+
+def _loads(value):
+    """
+    Parses a JSON record, returning None for anything else.
+    """
+    try:
+        return json.loads(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class Event:
+    """
+    A change to a record in the store.
+    """
+
+    def __init__(self, action, key, index, value=None, prev_value=None):
+        """
+        Creates an instance of the Event.
+
+        :param action: The etcd action.
+        :type action: str
+        :param key: The key which changed.
+        :type key: str
+        :param index: The etcd index of the change.
+        :type index: int
+        :param value: The new value. None if deleted.
+        :type value: str
+        :param prev_value: The value before the change.
+        :type prev_value: str
+        """
+        self.action = action
+        self.key = key
+        self.index = index
+        self.data = _loads(value)
+        self.prev = _loads(prev_value)
+        self.kind = 'other'
+        for prefix, kind in KINDS:
+            if key.startswith(prefix):
+                self.kind = kind
+                break
+        if action == 'resync':
+            change = None
+        elif action in DELETE_ACTIONS:
+            change = 'deleted'
+        elif prev_value is None:
+            change = 'added'
+        else:
+            change = 'modified'
+        #: kind.change, such as host.added or operation.modified. resync
+        #: when events were missed, which is not about any one record.
+        self.event_type = '{0}.{1}'.format(self.kind, change)
+        if change is None:
+            self.kind = self.event_type = action
+        self.address = None
+        self.cluster = None
+        record = self.data or self.prev or {}
+        if self.kind == 'host':
+            self.address = record.get('address', key.rsplit('/', 1)[-1])
+        elif self.kind == 'tombstone':
+            self.address = key.rsplit('/', 1)[-1]
+        elif self.kind == 'cluster':
+            self.cluster = key.rsplit('/', 1)[-1]
+        elif self.kind == 'operation':
+            # /commissaire/cluster/<name>/<restart|upgrade>
+            self.cluster = key.split('/')[3]
+
+    @classmethod
+    def from_result(cls, result):
+        """
+        Creates an Event from an etcd watch result.
+
+        :param result: The watch result.
+        :type result: etcd.EtcdResult
+        :returns: The event.
+        :rtype: Event
+        """
+        prev_value = None
+        prev_node = getattr(result, '_prev_node', None)
+        if prev_node is not None:
+            prev_value = prev_node.value
+        value = None
+        if result.action not in DELETE_ACTIONS:
+            value = result.value
+        return cls(result.action, result.key, result.modifiedIndex,
+                   value, prev_value)
+
+    def __repr__(self):
+        return 'Event({0}, {1}, {2})'.format(
+            self.event_type, self.key, self.index)
+
+
+class Subscription:
+    """
+    Bounded queue of the events matching a filter.
+    """
+
+    def __init__(self, bus, address=None, cluster=None, event_types=None,
+                 maxsize=1000, overflow='drop_oldest'):
+        """
+        Creates an instance of the Subscription.
+
+        :param bus: The bus delivering the events.
+        :type bus: EventBus
+        :param address: Only events for this host.
+        :type address: str
+        :param cluster: Only events for this cluster or its hosts.
+        :type cluster: str
+        :param event_types: Only these event types. A kind such as host
+                            matches all of its types.
+        :type event_types: list
+        :param maxsize: Most events to hold.
+        :type maxsize: int
+        :param overflow: One of OVERFLOW_POLICIES.
+        :type overflow: str
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy {0}'.format(overflow))
+        self.bus = bus
+        self.address = address
+        self.cluster = cluster
+        self.event_types = event_types
+        self.overflow = overflow
+        self.dropped = 0
+        self.closed = False
+        self._queue = Queue(maxsize)
+
+    def matches(self, event):
+        """
+        Returns if an event is for this subscription.
+
+        :param event: The event.
+        :type event: Event
+        :returns: True if it matches, otherwise False
+        :rtype: bool
+        """
+        if event.kind == 'resync':
+            # Everyone needs to know they missed something
+            return True
+        if self.event_types is not None and not (
+                event.event_type in self.event_types or
+                event.kind in self.event_types):
+            return False
+        if self.address is not None and event.address != self.address:
+            return False
+        if self.cluster is not None:
+            if event.cluster is not None:
+                return event.cluster == self.cluster
+            return event.address in self.bus.hostset(self.cluster)
+        return True
+
+    def put(self, event):
+        """
+        Adds an event, applying the overflow policy if full.
+
+        :param event: The event.
+        :type event: Event
+        """
+        if self.closed:
+            return
+        try:
+            self._queue.put_nowait(event)
+            return
+        except Full:
+            self.dropped += 1
+        if self.overflow == 'drop_oldest':
+            self._queue.get_nowait()
+            self._queue.put_nowait(event)
+        elif self.overflow == 'close':
+            # The consumer has missed events and has to start over
+            self.bus.logger.warn('Closing {0} after it fell behind.'.format(
+                self))
+            self.close()
+
+    def get(self, block=True, timeout=None):
+        """
+        Returns the next event.
+
+        :param block: If get should wait for an event.
+        :type block: bool
+        :param timeout: Most seconds to wait.
+        :type timeout: int
+        :returns: The next event.
+        :rtype: Event
+        :raises: gevent.queue.Empty, SubscriptionClosed
+        """
+        event = self._queue.get(block, timeout)
+        if event is None:
+            raise SubscriptionClosed()
+        return event
+
+    def drain(self):
+        """
+        Returns all waiting events without blocking.
+
+        :returns: The waiting events.
+        :rtype: list
+        :raises: SubscriptionClosed
+        """
+        events = []
+        while True:
+            try:
+                events.append(self.get(block=False))
+            except Empty:
+                return events
+
+    def close(self):
+        """
+        Stops the subscription. Waiting readers get SubscriptionClosed.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.bus.unsubscribe(self)
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._queue.put_nowait(None)
+
+    def __iter__(self):
+        """
+        Yields events until the subscription is closed.
+        """
+        while True:
+            try:
+                yield self.get()
+            except SubscriptionClosed:
+                return
+
+    def __repr__(self):
+        return 'Subscription(address={0}, cluster={1}, types={2})'.format(
+            self.address, self.cluster, self.event_types)
+
+
+class EventBus:
+    """
+    Fans changes from one etcd watch out to subscriptions.
+    """
+
+    def __init__(self, prefix='/commissaire', retry=1):
+        """
+        Creates an instance of the EventBus.
+
+        :param prefix: The keys to watch.
+        :type prefix: str
+        :param retry: Seconds to wait before watching again after an error.
+        :type retry: int
+        """
+        self.logger = logging.getLogger('events')
+        self.prefix = prefix
+        self.retry = retry
+        self.store = None
+        #: etcd index of the last event delivered
+        self.index = None
+        self._subscriptions = []
+        #: cluster name -> set of host addresses
+        self._hostsets = {}
+        self._watcher = None
+
+    def subscribe(self, address=None, cluster=None, event_types=None,
+                  maxsize=1000, overflow='drop_oldest'):
+        """
+        Creates a subscription. See Subscription for the arguments.
+
+        :returns: The new subscription.
+        :rtype: Subscription
+        """
+        subscription = Subscription(
+            self, address, cluster, event_types, maxsize, overflow)
+        self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Removes a subscription.
+
+        :param subscription: The subscription.
+        :type subscription: Subscription
+        """
+        if subscription in self._subscriptions:
+            self._subscriptions.remove(subscription)
+
+    def hostset(self, cluster):
+        """
+        Returns the addresses of the hosts in a cluster.
+
+        :param cluster: The name of the cluster.
+        :type cluster: str
+        :returns: The host addresses.
+        :rtype: set
+        """
+        return self._hostsets.get(cluster, set())
+
+    def publish(self, event):
+        """
+        Delivers an event to all matching subscriptions.
+
+        :param event: The event.
+        :type event: Event
+        :returns: The number of subscriptions it was delivered to.
+        :rtype: int
+        """
+        if event.kind == 'cluster':
+            if event.data is None:
+                self._hostsets.pop(event.cluster, None)
+            else:
+                self._hostsets[event.cluster] = set(
+                    event.data.get('hostset', []))
+        sent_to = 0
+        for subscription in list(self._subscriptions):
+            if subscription.matches(event):
+                subscription.put(event)
+                sent_to += 1
+        self.logger.debug('Sent {0} to {1} subscriptions.'.format(
+            event, sent_to))
+        return sent_to
+
+    def load(self):
+        """
+        Reads the cluster host sets and the index to watch from.
+        """
+        try:
+            clusters = self.store.read('/commissaire/clusters/')
+            self.index = clusters.etcd_index
+            self._hostsets = {}
+            for cluster in clusters.leaves:
+                data = _loads(cluster.value)
+                if data is not None:
+                    self._hostsets[cluster.key.rsplit('/', 1)[-1]] = set(
+                        data.get('hostset', []))
+        except etcd.EtcdKeyNotFound:
+            self.index = self.store.read('/').etcd_index
+
+    def _watch(self):
+        """
+        Keeps the single watch running and publishes its events.
+        """
+        while True:
+            try:
+                if self.index is None:
+                    self.load()
+                result = self.store.watch(
+                    self.prefix, index=self.index + 1, recursive=True)
+                self.index = result.modifiedIndex
+                self.publish(Event.from_result(result))
+                continue
+            except etcd.EtcdWatchTimedOut:
+                continue
+            except etcd.EtcdEventIndexCleared:
+                # Too far behind for etcd's history. Consumers start over.
+                self.logger.warn('Missed events. Resynchronizing.')
+                self.index = None
+                self.load()
+                self.publish(Event('resync', self.prefix, self.index))
+                continue
+            except Exception:
+                _, exc_msg, _ = sys.exc_info()
+                self.logger.warn('Event watch failed: {0}'.format(exc_msg))
+            gevent.sleep(self.retry)
+
+    def start(self, store):
+        """
+        Starts watching the store if not already running.
+
+        :param store: Data store to watch.
+        :type store: etcd.Client
+        """
+        self.store = store
+        if self._watcher is None or self._watcher.dead:
+            self._watcher = gevent.spawn(self._watch)
+
+    def stop(self):
+        """
+        Stops watching the store.
+        """
+        if self._watcher is not None:
+            self._watcher.kill()
+            self._watcher = None
@@ -21,12 +21,51 @@ import falcon
 import etcd
 import json
 
+from gevent.queue import Empty
+
+from commissaire.events import SubscriptionClosed
+from commissaire.jobqueue import enqueue
+from commissaire.queues import EVENT_BUS
 from commissaire.resource import Resource
-from commissaire.jobs import POOLS, clusterexec
 from commissaire.handlers.models import (
     Cluster, Clusters, ClusterRestart, ClusterUpgrade, Host)
 
 
+#: Seconds between keep-alive comments on an idle event stream
+STREAM_KEEPALIVE = 15
+
+
+def wants_stream(req):
+    """
+    Returns if the client asked for a text/event-stream response.
+
+    :param req: Request instance that will be passed through.
+    :type req: falcon.Request
+    :returns: True if an event stream was asked for, otherwise False
+    :rtype: bool
+    """
+    return 'text/event-stream' in (req.accept or '')
+
+
+def sse(event, data, event_id=None):
+    """
+    Formats one Server-Sent Event.
+
+    :param event: The event name.
+    :type event: str
+    :param data: The event data. Must be a single line.
+    :type data: str
+    :param event_id: The id clients send back as Last-Event-ID.
+    :type event_id: int
+    :returns: The encoded event.
+    :rtype: bytes
+    """
+    message = 'event: {0}\ndata: {1}\n\n'.format(event, data)
+    if event_id is not None:
+        message = 'id: {0}\n'.format(event_id) + message
+    return message.encode('utf-8')
+
+
 class ClustersResource(Resource):
     """
     Resource for working with Clusters.
@@ -375,14 +414,120 @@ class ClusterSingleHostResource(ClusterHostsResource):
         resp.status = falcon.HTTP_200
 
 
-class ClusterRestartResource(Resource):
+class ClusterOperationResource(Resource):
+    """
+    Parent class for Resources of operations across a Cluster.
+    """
+
+    #: The clusterexec command
+    command = None
+    #: Model of the operation status
+    model = None
+
+    def _status_event(self, index, value):
+        """
+        Returns a status event and whether the operation is over.
+        """
+        status = self.model(**json.loads(value))
+        return (sse('status', status.to_json(), index),
+                bool(status.finished_at))
+
+    def _events(self, key, subscription):
+        """
+        Yields the current status and then every change to it.
+
+        :param key: The key of the operation status.
+        :type key: str
+        :param subscription: Operation events for the Cluster.
+        :type subscription: commissaire.events.Subscription
+        """
+        try:
+            current = True
+            while True:
+                if current:
+                    # On start and after missed events
+                    current = False
+                    try:
+                        status = self.store.get(key)
+                        message, done = self._status_event(
+                            status.modifiedIndex, status.value)
+                        yield message
+                        if done:
+                            return
+                    except etcd.EtcdKeyNotFound:
+                        pass
+                try:
+                    event = subscription.get(timeout=STREAM_KEEPALIVE)
+                except Empty:
+                    yield b': keep-alive\n\n'
+                    continue
+                except SubscriptionClosed:
+                    self.logger.debug('Stream for {0} fell behind.'.format(
+                        key))
+                    subscription = EVENT_BUS.subscribe(
+                        **self._subscription(subscription.cluster))
+                    current = True
+                    continue
+                if event.kind == 'resync':
+                    current = True
+                elif event.key != key:
+                    continue
+                elif event.data is None:
+                    yield sse('deleted', '{}', event.index)
+                    return
+                else:
+                    message, done = self._status_event(
+                        event.index, json.dumps(event.data))
+                    yield message
+                    if done:
+                        return
+        finally:
+            subscription.close()
+
+    def _subscription(self, name):
+        """
+        Returns the arguments subscribing to the Cluster's operations.
+        """
+        return {
+            'cluster': name,
+            'event_types': ('operation',),
+            'maxsize': 100,
+            'overflow': 'close',
+        }
+
+    def _stream(self, req, resp, name):
+        """
+        Answers with a text/event-stream of status changes. The stream
+        ends once the operation finishes.
+
+        :param req: Request instance that will be passed through.
+        :type req: falcon.Request
+        :param resp: Response instance that will be passed through.
+        :type resp: falcon.Response
+        :param name: The name of the Cluster.
+        :type name: str
+        """
+        key = '/commissaire/cluster/{0}/{1}'.format(name, self.command)
+        # Subscribe before reading the status so no change is missed
+        subscription = EVENT_BUS.subscribe(**self._subscription(name))
+        resp.status = falcon.HTTP_200
+        resp.content_type = 'text/event-stream'
+        resp.set_header('Cache-Control', 'no-cache')
+        resp.stream = self._events(key, subscription)
+
+
+class ClusterRestartResource(ClusterOperationResource):
     """
     Resource for initiating or querying a Cluster restart.
     """
 
+    command = 'restart'
+    model = ClusterRestart
+
     def on_get(self, req, resp, name):
         """
-        Handles GET (or "status") requests for a Cluster restart.
+        Handles GET (or "status") requests for a Cluster restart. Clients
+        accepting text/event-stream get each change as it happens.
 
         :param req: Request instance that will be passed through.
         :type req: falcon.Request
@@ -399,6 +544,9 @@ class ClusterRestartResource(Resource):
             except etcd.EtcdKeyNotFound:
                 resp.status = falcon.HTTP_404
                 return
+            if wants_stream(req):
+                self._stream(req, resp, name)
+                return
             status = self.store.get(key)
         except etcd.EtcdKeyNotFound:
             # Return "204 No Content" if we have no status,
@@ -421,8 +569,6 @@ class ClusterRestartResource(Resource):
         :param name: The name of the Cluster being restarted.
         :type name: str
         """
-        POOLS['clusterexecpool'].spawn(
-            clusterexec.clusterexec, name, 'restart', self.store)
         key = '/commissaire/cluster/{0}/restart'.format(name)
         cluster_restart_default = {
             'status': 'in_process',
@@ -432,19 +578,28 @@ class ClusterRestartResource(Resource):
             'finished_at': None
         }
         cluster_restart = ClusterRestart(**cluster_restart_default)
+        # The job updates the status, so it must exist before the job runs
         self.store.set(key, cluster_restart.to_json())
+        enqueue(self.store, 'clusterexec', {
+            'cluster': name,
+            'command': 'restart',
+        })
         resp.status = falcon.HTTP_201
         req.context['model'] = cluster_restart
 
 
-class ClusterUpgradeResource(Resource):
+class ClusterUpgradeResource(ClusterOperationResource):
     """
     Resource for initiating or querying a Cluster upgrade.
     """
 
+    command = 'upgrade'
+    model = ClusterUpgrade
+
     def on_get(self, req, resp, name):
         """
-        Handles GET (or "status") requests for a Cluster upgrade.
+        Handles GET (or "status") requests for a Cluster upgrade. Clients
+        accepting text/event-stream get each change as it happens.
 
         :param req: Request instance that will be passed through.
         :type req: falcon.Request
@@ -461,6 +616,9 @@ class ClusterUpgradeResource(Resource):
             except etcd.EtcdKeyNotFound:
                 resp.status = falcon.HTTP_404
                 return
+            if wants_stream(req):
+                self._stream(req, resp, name)
+                return
             status = self.store.get(key)
         except etcd.EtcdKeyNotFound:
             # Return "204 No Content" if we have no status,
@@ -491,9 +649,6 @@ class ClusterUpgradeResource(Resource):
         except (KeyError, ValueError):
             resp.status = falcon.HTTP_400
             return
-        # FIXME: How do I pass 'upgrade_to'?
-        POOLS['clusterexecpool'].spawn(
-            clusterexec.clusterexec, name, 'upgrade', self.store)
         key = '/commissaire/cluster/{0}/upgrade'.format(name)
         cluster_upgrade_default = {
             'status': 'in_process',
@@ -504,6 +659,13 @@ class ClusterUpgradeResource(Resource):
             'finished_at': None
         }
         cluster_upgrade = ClusterUpgrade(**cluster_upgrade_default)
+        # The job updates the status, so it must exist before the job runs
         self.store.set(key, cluster_upgrade.to_json())
+        # FIXME: clusterexec does not use 'upgrade_to' yet
+        enqueue(self.store, 'clusterexec', {
+            'cluster': name,
+            'command': 'upgrade',
+            'upgrade_to': upgrade_to,
+        })
         resp.status = falcon.HTTP_201
         req.context['model'] = cluster_upgrade
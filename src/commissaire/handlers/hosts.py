@@ -19,10 +19,147 @@ Host(s) handlers.
 import falcon
 import etcd
 import json
+import sys
+import time
 
-from commissaire.queues import INVESTIGATE_QUEUE
+from gevent.pool import Pool
+from gevent.queue import Empty
+
+from commissaire.events import SubscriptionClosed
+from commissaire.jobqueue import enqueue
+from commissaire.queues import DEREGISTER_QUEUE, EVENT_BUS
 from commissaire.resource import Resource
-from commissaire.handlers.models import Cluster, Host, Hosts
+from commissaire.handlers.models import (
+    Cluster, Host, HostChanges, HostRegistration, HostRegistrations, Hosts)
+
+
+#: Where deleted Hosts are remembered for delta listings
+HOST_TOMBSTONES = '/commissaire/deleted/hosts'
+#: Delta listings from before this etcd index may miss pruned deletions
+HOST_TOMBSTONES_HORIZON = '/commissaire/deleted/hosts_horizon'
+
+#: Seconds a deleted Host is remembered at least, and at most how often
+#: older tombstones are pruned
+HOST_TOMBSTONE_TTL = 86400
+HOST_TOMBSTONE_PRUNE_INTERVAL = 600
+
+#: When this process last pruned tombstones
+TOMBSTONES = {
+    'pruned': 0,
+}
+
+#: Seconds a listing with wait=true blocks by default and at most
+DEFAULT_WAIT = 60
+MAX_WAIT = 300
+
+#: Most Hosts registered by one request and how many are written at once
+MAX_BULK_HOSTS = 1000
+BULK_CONCURRENCY = 10
+
+
+def prepare_host(host_creation):
+    """
+    Fills in the fields of a Host which has yet to be investigated.
+
+    :param host_creation: The Host as sent by the client. Modified in place.
+    :type host_creation: dict
+    :returns: The name of the Cluster to add the Host to, if any.
+    :rtype: str
+    """
+    host_creation['os'] = ''
+    host_creation['status'] = 'investigating'
+    host_creation['cpus'] = -1
+    host_creation['memory'] = -1
+    host_creation['space'] = -1
+    host_creation['last_check'] = None
+
+    # Don't store the cluster name in etcd.
+    return host_creation.pop('cluster', None)
+
+
+def tombstone_horizon(store):
+    """
+    Returns the etcd index delta listings are complete from.
+
+    :param store: Data store holding the tombstones.
+    :type store: etcd.Client
+    :returns: The horizon or 0 if nothing was pruned yet.
+    :rtype: int
+    """
+    try:
+        return int(store.get(HOST_TOMBSTONES_HORIZON).value)
+    except etcd.EtcdKeyNotFound:
+        return 0
+
+
+def _advance_horizon(store, index):
+    """
+    Moves the tombstone horizon forward to an etcd index.
+
+    :param store: Data store holding the tombstones.
+    :type store: etcd.Client
+    :param index: The new horizon.
+    :type index: int
+    """
+    while True:
+        try:
+            current = store.get(HOST_TOMBSTONES_HORIZON)
+        except etcd.EtcdKeyNotFound:
+            current = None
+        try:
+            if current is None:
+                store.write(
+                    HOST_TOMBSTONES_HORIZON, str(index), prevExist=False)
+            elif int(current.value) < index:
+                store.write(
+                    HOST_TOMBSTONES_HORIZON, str(index),
+                    prevIndex=current.modifiedIndex)
+            return
+        except (etcd.EtcdAlreadyExist, etcd.EtcdCompareFailed):
+            # Another worker moved it. Look again.
+            continue
+
+
+def prune_tombstones(store, now=None):
+    """
+    Removes tombstones older than HOST_TOMBSTONE_TTL. The horizon is
+    moved past them first so delta listings which could have missed one
+    are answered with a full listing instead.
+
+    :param store: Data store holding the tombstones.
+    :type store: etcd.Client
+    :param now: The current time. Default: time.time()
+    :type now: float
+    :returns: The number of tombstones removed.
+    :rtype: int
+    """
+    if now is None:
+        now = time.time()
+    try:
+        tombstones = store.get(HOST_TOMBSTONES)
+    except etcd.EtcdKeyNotFound:
+        return 0
+    expired = []
+    if len(tombstones._children):
+        for tombstone in tombstones.leaves:
+            try:
+                deleted = json.loads(tombstone.value)['deleted']
+            except (TypeError, ValueError, KeyError):
+                deleted = 0
+            if now - deleted >= HOST_TOMBSTONE_TTL:
+                expired.append(tombstone)
+    if not expired:
+        return 0
+    _advance_horizon(store, max(x.modifiedIndex for x in expired))
+    pruned = 0
+    for tombstone in expired:
+        try:
+            store.delete(tombstone.key, prevIndex=tombstone.modifiedIndex)
+            pruned += 1
+        except (etcd.EtcdCompareFailed, etcd.EtcdKeyNotFound):
+            # Deleted again since or pruned by another worker
+            pass
+    return pruned
 
 
 class HostsResource(Resource):
@@ -39,6 +176,10 @@ class HostsResource(Resource):
         :param resp: Response instance that will be passed through.
         :type resp: falcon.Response
         """
+        since = req.get_param_as_int('since', min=0)
+        if since is not None:
+            self._on_get_changes(req, resp, since)
+            return
         try:
             hosts_dir = self.store.get('/commissaire/hosts/')
         except etcd.EtcdKeyNotFound:
@@ -60,6 +201,275 @@ class HostsResource(Resource):
             resp.status = falcon.HTTP_200
             req.context['model'] = None
 
+    def on_post(self, req, resp):
+        """
+        Handles registering a batch of Hosts. The batch is checked as a
+        whole, each Cluster is updated once and every Host gets its own
+        result.
+
+        :param req: Request instance that will be passed through.
+        :type req: falcon.Request
+        :param resp: Response instance that will be passed through.
+        :type resp: falcon.Response
+        """
+        try:
+            batch = json.loads(req.stream.read().decode())
+            if not isinstance(batch, list) or not (
+                    0 < len(batch) <= MAX_BULK_HOSTS):
+                raise ValueError('Expected a list of 1 to {0} hosts'.format(
+                    MAX_BULK_HOSTS))
+        except ValueError:
+            _, exc_msg, _ = sys.exc_info()
+            self.logger.info('Bad bulk host registration: {0}'.format(
+                exc_msg))
+            resp.status = falcon.HTTP_400
+            return
+
+        # One read each for the Hosts and the Clusters named in the batch
+        existing = self._addresses()
+        clusters = {}
+        results = []
+        pending = []
+        queued = set()
+        for host_creation in batch:
+            address = None
+            if isinstance(host_creation, dict):
+                address = host_creation.get('address')
+            result = HostRegistration(
+                address=address, status=201, error=None, host=None)
+            results.append(result)
+            if not address or 'ssh_priv_key' not in host_creation:
+                result.status = 400
+                result.error = 'address and ssh_priv_key are required'
+            elif address in queued:
+                result.status = 400
+                result.error = 'Listed more than once'
+            elif address in existing:
+                result.status = 409
+                result.error = 'Host already exists'
+            else:
+                cluster_name = prepare_host(host_creation)
+                if cluster_name and cluster_name not in clusters:
+                    clusters[cluster_name] = self._cluster(cluster_name)
+                if cluster_name and clusters[cluster_name] is None:
+                    result.status = 409
+                    result.error = 'Cluster {0} does not exist'.format(
+                        cluster_name)
+                    continue
+                queued.add(address)
+                pending.append((result, host_creation, cluster_name))
+
+        def write(registration):
+            result, host_creation, cluster_name = registration
+            host = Host(**host_creation)
+            try:
+                # prevExist guards against the same Host being added since
+                self.store.write(
+                    '/commissaire/hosts/{0}'.format(result.address),
+                    host.to_json(secure=True), prevExist=False)
+                result.host = host
+            except etcd.EtcdAlreadyExist:
+                result.status = 409
+                result.error = 'Host already exists'
+            except Exception:
+                _, exc_msg, _ = sys.exc_info()
+                self.logger.warn('Unable to add {0}: {1}'.format(
+                    result.address, exc_msg))
+                result.status = 500
+                result.error = 'Unable to store the host'
+
+        pool = Pool(BULK_CONCURRENCY)
+        pool.map(write, pending)
+        created = [x for x in pending if x[0].status == 201]
+
+        members = {}
+        for result, _, cluster_name in created:
+            if cluster_name:
+                members.setdefault(cluster_name, []).append(result)
+        for cluster_name, added in members.items():
+            if not self._add_to_cluster(
+                    cluster_name, clusters[cluster_name],
+                    [x.address for x in added]):
+                for result in added:
+                    result.error = 'Not added to cluster {0}'.format(
+                        cluster_name)
+
+        def investigate(registration):
+            result, host_creation, _ = registration
+            try:
+                enqueue(self.store, 'investigate', {
+                    'host': host_creation,
+                    'ssh_priv_key': host_creation['ssh_priv_key'],
+                })
+            except Exception:
+                _, exc_msg, _ = sys.exc_info()
+                self.logger.warn('Unable to queue {0}: {1}'.format(
+                    result.address, exc_msg))
+                result.error = 'Investigation was not queued'
+
+        pool.map(investigate, created)
+
+        if len(created) == len(results):
+            resp.status = falcon.HTTP_201
+        else:
+            # Older falcon releases have no HTTP_207
+            resp.status = '207 Multi-Status'
+        req.context['model'] = HostRegistrations(registrations=results)
+
+    def _addresses(self):
+        """
+        Returns the addresses of all Hosts.
+
+        :returns: The Host addresses.
+        :rtype: set
+        """
+        try:
+            hosts_dir = self.store.get('/commissaire/hosts/')
+        except etcd.EtcdKeyNotFound:
+            return set()
+        if not len(hosts_dir._children):
+            return set()
+        return set(x.key.rsplit('/', 1)[-1] for x in hosts_dir.leaves)
+
+    def _cluster(self, name):
+        """
+        Returns the record of a Cluster.
+
+        :param name: The name of the Cluster.
+        :type name: str
+        :returns: The Cluster record or None if it does not exist.
+        :rtype: etcd.EtcdResult
+        """
+        try:
+            return self.store.get('/commissaire/clusters/{0}'.format(name))
+        except etcd.EtcdKeyNotFound:
+            self.logger.info('Request for non-existent cluster {0}.'.format(
+                name))
+            return None
+
+    def _add_to_cluster(self, name, etcd_resp, addresses, retries=3):
+        """
+        Adds Hosts to a Cluster with one conditional write, reading the
+        Cluster again if it changed in the meantime.
+
+        :param name: The name of the Cluster.
+        :type name: str
+        :param etcd_resp: The Cluster record as last read.
+        :type etcd_resp: etcd.EtcdResult
+        :param addresses: The addresses of the Hosts to add.
+        :type addresses: list
+        :param retries: Most times to try again if the Cluster changed.
+        :type retries: int
+        :returns: True if the Hosts were added, otherwise False
+        :rtype: bool
+        """
+        key = '/commissaire/clusters/{0}'.format(name)
+        for attempt in range(retries + 1):
+            cluster = Cluster(**json.loads(etcd_resp.value))
+            cluster.hostset = sorted(set(cluster.hostset).union(addresses))
+            try:
+                self.store.write(
+                    key, cluster.to_json(secure=True),
+                    prevIndex=etcd_resp.modifiedIndex)
+                return True
+            except etcd.EtcdCompareFailed:
+                self.logger.debug('{0} changed while adding hosts.'.format(
+                    key))
+                etcd_resp = self._cluster(name)
+                if etcd_resp is None:
+                    break
+            except etcd.EtcdKeyNotFound:
+                break
+        self.logger.warn('Unable to add {0} to cluster {1}'.format(
+            ', '.join(addresses), name))
+        return False
+
+    def _on_get_changes(self, req, resp, since):
+        """
+        Handles GET requests for the Hosts changed after an etcd index.
+        With wait=true the request blocks until something changes or
+        the timeout runs out.
+
+        :param req: Request instance that will be passed through.
+        :type req: falcon.Request
+        :param resp: Response instance that will be passed through.
+        :type resp: falcon.Response
+        :param since: The etcd index the client is current to.
+        :type since: int
+        """
+        timeout = 0
+        if req.get_param_as_bool('wait'):
+            timeout = req.get_param_as_int('timeout', min=0, max=MAX_WAIT)
+            if timeout is None:
+                timeout = DEFAULT_WAIT
+        # Subscribe before reading so no change slips in between.
+        # Tombstones are written after the delete so both are followed.
+        subscription = EVENT_BUS.subscribe(
+            event_types=('host', 'tombstone'))
+        try:
+            changes = self._changes(since)
+            deadline = time.time() + timeout
+            while not (changes.resync or changes.hosts or changes.deleted):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    event = subscription.get(timeout=remaining)
+                except (Empty, SubscriptionClosed):
+                    break
+                if event.kind == 'resync' or event.index > since:
+                    changes = self._changes(since)
+        finally:
+            subscription.close()
+        resp.status = falcon.HTTP_200
+        req.context['model'] = changes
+
+    def _changes(self, since):
+        """
+        Reads the Hosts changed or deleted after an etcd index. When
+        deletions from after the index may have been pruned all Hosts
+        are returned as a resync.
+
+        :param since: The etcd index the client is current to.
+        :type since: int
+        :returns: The changes and the index they are current to.
+        :rtype: commissaire.handlers.models.HostChanges
+        """
+        hosts = []
+        all_hosts = []
+        addresses = set()
+        try:
+            hosts_dir = self.store.get('/commissaire/hosts/')
+            index = hosts_dir.etcd_index
+            if len(hosts_dir._children):
+                for host in hosts_dir.leaves:
+                    data = json.loads(host.value)
+                    addresses.add(data['address'])
+                    all_hosts.append(Host(**data))
+                    if host.modifiedIndex > since:
+                        hosts.append(all_hosts[-1])
+        except etcd.EtcdKeyNotFound:
+            index = self.store.read('/').etcd_index
+        # Tombstones are read after the hosts. One written in between is
+        # sent again next time, which is harmless, rather than missed.
+        deleted = []
+        try:
+            tombstones = self.store.get(HOST_TOMBSTONES)
+            if len(tombstones._children):
+                for tombstone in tombstones.leaves:
+                    address = tombstone.key.rsplit('/', 1)[-1]
+                    if (tombstone.modifiedIndex > since and
+                            address not in addresses):
+                        deleted.append(address)
+        except etcd.EtcdKeyNotFound:
+            pass
+        # Read last as pruning moves the horizon before removing anything
+        if since < tombstone_horizon(self.store):
+            return HostChanges(
+                index=index, hosts=all_hosts, deleted=[], resync=True)
+        return HostChanges(
+            index=index, hosts=hosts, deleted=deleted, resync=False)
+
 
 class HostResource(Resource):
     """
@@ -111,15 +521,7 @@ class HostResource(Resource):
         host_creation = json.loads(data)
         ssh_priv_key = host_creation['ssh_priv_key']
         host_creation['address'] = address
-        host_creation['os'] = ''
-        host_creation['status'] = 'investigating'
-        host_creation['cpus'] = -1
-        host_creation['memory'] = -1
-        host_creation['space'] = -1
-        host_creation['last_check'] = None
-
-        # Don't store the cluster name in etcd.
-        cluster_name = host_creation.pop('cluster', None)
+        cluster_name = prepare_host(host_creation)
 
         # Verify the cluster exists, if given.  Do it now
         # so we can fail before writing anything to etcd.
@@ -147,7 +549,10 @@ class HostResource(Resource):
         new_host = self.store.set(
             '/commissaire/hosts/{0}'.format(
                 address), host.to_json(secure=True))
-        INVESTIGATE_QUEUE.put((host_creation, ssh_priv_key))
+        enqueue(self.store, 'investigate', {
+            'host': host_creation,
+            'ssh_priv_key': ssh_priv_key,
+        })
 
         # Add host to the requested cluster.
         if cluster_name:
@@ -176,6 +581,24 @@ class HostResource(Resource):
             host = self.store.delete(
                 '/commissaire/hosts/{0}'.format(address))
             resp.status = falcon.HTTP_410
+            # Written after the delete so delta listings current to the
+            # delete's index still see the tombstone
+            now = time.time()
+            self.store.set(
+                '{0}/{1}'.format(HOST_TOMBSTONES, address),
+                json.dumps({'deleted': now}))
+            # The node is removed from the container manager in the
+            # background so the response does not wait on it
+            DEREGISTER_QUEUE.put(address)
+            if now - TOMBSTONES['pruned'] >= HOST_TOMBSTONE_PRUNE_INTERVAL:
+                TOMBSTONES['pruned'] = now
+                try:
+                    prune_tombstones(self.store, now)
+                except Exception:
+                    _, exc_msg, _ = sys.exc_info()
+                    self.logger.warn(
+                        'Unable to prune host tombstones: {0}'.format(
+                            exc_msg))
         except etcd.EtcdKeyNotFound:
             resp.status = falcon.HTTP_404
 
@@ -95,6 +95,30 @@ class Hosts(Model):
     _attributes = ('hosts', )
 
 
+class HostRegistration(Model):
+    """
+    Representation of the result of registering one Host in a batch.
+    """
+    _json_type = dict
+    _attributes = ('address', 'status', 'error', 'host')
+
+
+class HostRegistrations(Model):
+    """
+    Representation of the results of registering a batch of Hosts.
+    """
+    _json_type = list
+    _attributes = ('registrations', )
+
+
+class HostChanges(Model):
+    """
+    Representation of the Hosts changed or deleted after an etcd index.
+    """
+    _json_type = dict
+    _attributes = ('index', 'hosts', 'deleted', 'resync')
+
+
 class Status(Model):
     """
     Representation of a Host.
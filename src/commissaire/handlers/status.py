@@ -20,6 +20,7 @@ import falcon
 import etcd
 
 from commissaire.jobs import POOLS
+from commissaire.queues import INVESTIGATE_QUEUE
 from commissaire.resource import Resource
 from commissaire.handlers.models import Status
 
@@ -91,5 +92,8 @@ class StatusResource(Resource):
 
         map(populate_exceptions, POOLS.keys())
 
+        # Work waiting for the investigator in each lane
+        kwargs['investigator']['info']['queue'] = INVESTIGATE_QUEUE.depth()
+
         resp.status = falcon.HTTP_200
         req.context['model'] = Status(**kwargs)
@@ -0,0 +1,280 @@
+# Copyright (C) 2016  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Durable job queues kept in etcd.
+
+Jobs are in-order keys under /commissaire/jobs/<name>/items. A worker
+claims a job by creating /commissaire/jobs/<name>/claims/<id> with a TTL,
+which only one worker can do. The claim is the job's visibility timeout.
+If the worker dies the claim expires and the job can be claimed again.
+When the queue knows the worker membership, claims held by workers whose
+lease expired are handed off right away. Finished jobs are deleted.
+"""
+
+import json
+import logging
+
+import etcd
+
+from commissaire.membership import WORKER_ID
+
+
+def enqueue(store, name, payload):
+    """
+    Adds a job to a durable queue.
+
+    :param store: Data store holding the queue.
+    :type store: etcd.Client
+    :param name: The name of the queue.
+    :type name: str
+    :param payload: The JSON serializable job.
+    :returns: The key of the job.
+    :rtype: str
+    """
+    result = store.write(
+        '/commissaire/jobs/{0}/items'.format(name),
+        json.dumps(payload), append=True)
+    return result.key
+
+
+class Job:
+    """
+    A claimed job.
+    """
+
+    def __init__(self, key, payload):
+        """
+        Creates an instance of the Job.
+
+        :param key: The key of the job.
+        :type key: str
+        :param payload: The job.
+        """
+        self.key = key
+        self.id = key.rsplit('/', 1)[-1]
+        self.payload = payload
+
+    def __repr__(self):
+        return 'Job({0})'.format(self.key)
+
+
+class EtcdQueue:
+    """
+    Durable queue which many workers can drain at the same time.
+    """
+
+    def __init__(self, store, name, owner=None, visibility_timeout=300,
+                 members=None, accept=None):
+        """
+        Creates an instance of the EtcdQueue.
+
+        :param store: Data store holding the queue.
+        :type store: etcd.Client
+        :param name: The name of the queue.
+        :type name: str
+        :param owner: Who claims jobs. Default: WORKER_ID
+        :type owner: str
+        :param visibility_timeout: Seconds a claim lasts unless extended.
+        :type visibility_timeout: int
+        :param members: Live workers. Claims of others are handed off.
+        :type members: commissaire.membership.Membership
+        :param accept: Returns if a job payload is for this worker.
+                       Default: all jobs are.
+        :type accept: callable
+        """
+        self.logger = logging.getLogger('jobqueue')
+        self.store = store
+        self.name = name
+        self.owner = owner or WORKER_ID
+        self.visibility_timeout = visibility_timeout
+        self.members = members
+        self.accept = accept
+        self.path = '/commissaire/jobs/{0}'.format(name)
+        self.items_dir = self.path + '/items'
+        self.claims_dir = self.path + '/claims'
+        #: etcd index as of the last look at the jobs
+        self._index = None
+
+    def put(self, payload):
+        """
+        Adds a job.
+
+        :param payload: The JSON serializable job.
+        :returns: The key of the job.
+        :rtype: str
+        """
+        return enqueue(self.store, self.name, payload)
+
+    def _claim_key(self, job_id):
+        """
+        Returns the key holding the claim on a job.
+        """
+        return '{0}/{1}'.format(self.claims_dir, job_id)
+
+    def pending(self):
+        """
+        Returns all jobs with the current claim on each, oldest first.
+
+        :returns: List of (key, payload, owner) tuples. owner is None for
+                  jobs nobody holds.
+        :rtype: list
+        """
+        try:
+            # Jobs and claims in one read
+            queue = self.store.read(self.path, recursive=True, sorted=True)
+        except etcd.EtcdKeyNotFound:
+            return []
+        self._index = queue.etcd_index
+        items, claims = [], {}
+        for node in queue.leaves:
+            if node.dir:
+                continue
+            parent, job_id = node.key.rsplit('/', 1)
+            if parent == self.items_dir:
+                items.append((node.key, node.value))
+            elif parent == self.claims_dir:
+                claims[job_id] = node.value
+        return [(key, value, claims.get(key.rsplit('/', 1)[-1]))
+                for key, value in items]
+
+    def _hand_off(self, job, owner):
+        """
+        Drops the claim of a worker whose lease expired.
+
+        :param job: The claimed job.
+        :type job: Job
+        :param owner: The worker holding the claim.
+        :type owner: str
+        """
+        try:
+            self.store.delete(self._claim_key(job.id), prevValue=owner)
+            self.logger.info('Handing off {0} from {1}'.format(job, owner))
+        except (etcd.EtcdCompareFailed, etcd.EtcdKeyNotFound):
+            # Another worker got there first
+            pass
+
+    def claim(self):
+        """
+        Claims the oldest accepted job nobody holds.
+
+        :returns: The claimed job or None.
+        :rtype: Job
+        """
+        live = None
+        for key, value, owner in self.pending():
+            job = Job(key, json.loads(value))
+            if self.accept is not None and not self.accept(job.payload):
+                continue
+            if owner is not None:
+                if self.members is None or owner == self.owner:
+                    continue
+                if live is None:
+                    live = set(self.members.members())
+                # Nobody at all, not even us, means the registrations
+                # could not be read. Leave the claims alone.
+                if not live or owner in live:
+                    continue
+                self._hand_off(job, owner)
+            try:
+                self.store.write(
+                    self._claim_key(job.id), self.owner,
+                    ttl=self.visibility_timeout, prevExist=False)
+            except etcd.EtcdAlreadyExist:
+                continue
+            self.logger.debug('{0} claimed {1}'.format(self.owner, job))
+            return job
+        return None
+
+    def wait(self, timeout=10):
+        """
+        Waits for anything in the queue to change, such as a new job or
+        an expired claim.
+
+        :param timeout: Most seconds to wait.
+        :type timeout: int
+        """
+        kwargs = {}
+        if self._index is not None:
+            # Catch changes made since the last look
+            kwargs['waitIndex'] = self._index + 1
+        try:
+            self.store.read(
+                self.path, wait=True, recursive=True, timeout=timeout,
+                **kwargs)
+        except Exception:
+            # Timeouts, cleared indexes and dropped watches just mean
+            # look again
+            pass
+
+    def get(self, timeout=10):
+        """
+        Claims the oldest job, waiting for one if needed.
+
+        :param timeout: Seconds to wait between looks.
+        :type timeout: int
+        :returns: The claimed job.
+        :rtype: Job
+        """
+        while True:
+            job = self.claim()
+            if job is not None:
+                return job
+            self.wait(timeout)
+
+    def extend(self, job):
+        """
+        Extends the claim on a job.
+
+        :param job: The claimed job.
+        :type job: Job
+        :returns: True if the job is still held, otherwise False
+        :rtype: bool
+        """
+        try:
+            self.store.write(
+                self._claim_key(job.id), self.owner,
+                ttl=self.visibility_timeout, prevValue=self.owner)
+            return True
+        except (etcd.EtcdCompareFailed, etcd.EtcdKeyNotFound):
+            self.logger.warn('{0} lost the claim on {1}'.format(
+                self.owner, job))
+            return False
+
+    def ack(self, job):
+        """
+        Removes a finished job.
+
+        :param job: The claimed job.
+        :type job: Job
+        """
+        for key in (job.key, self._claim_key(job.id)):
+            try:
+                self.store.delete(key)
+            except etcd.EtcdKeyNotFound:
+                pass
+        self.logger.debug('{0} finished {1}'.format(self.owner, job))
+
+    def release(self, job):
+        """
+        Gives up the claim on a job so another worker can take it.
+
+        :param job: The claimed job.
+        :type job: Job
+        """
+        try:
+            self.store.delete(
+                self._claim_key(job.id), prevValue=self.owner)
+        except (etcd.EtcdCompareFailed, etcd.EtcdKeyNotFound):
+            pass
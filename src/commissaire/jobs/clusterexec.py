@@ -19,10 +19,9 @@ The clusterexec job.
 import datetime
 import json
 import logging
-import tempfile
 
-from commissaire.transport import ansibleapi
-from commissaire.compat.b64 import base64
+from commissaire.transport.keys import KEYS
+from commissaire.transport.worker import get_transport
 from commissaire.oscmd import get_oscmd
 
 
@@ -65,63 +64,69 @@ def clusterexec(cluster_name, command, store):
         '/commissaire/cluster/{0}/{1}'.format(cluster_name, command),
         json.dumps(cluster_status))
 
+    # One transport is shared by all hosts so the executor stays warm
+    transport = get_transport()
+
     # TODO: Find better way to do this
-    for a_host_dict in store.get('/commissaire/hosts')._children:
-        a_host = json.loads(a_host_dict['value'])
-        if a_host['cluster'] != cluster_name:
-            logger.debug('Skipping {0} as it is not in this cluster.'.format(
-                a_host['address']))
-            continue  # Move on to the next one
-        oscmd = get_oscmd(a_host['os'])
-
-        command_list = getattr(oscmd(), command)()  # Only used for logging
-        logger.info('Executing {0} on {1}...'.format(
-            command_list, a_host['address']))
-
-        cluster_status['in_process'].append(a_host['address'])
-        store.set(
-            '/commissaire/cluster/{0}/{1}'.format(cluster_name, command),
-            json.dumps(cluster_status))
-
-        # TODO: This is reused, make it reusable
-        f = tempfile.NamedTemporaryFile(prefix='key', delete=False)
-        key_file = f.name
-        logger.debug(
-            'Using {0} as the temporary key location for {1}'.format(
-                key_file, a_host['address']))
-        f.write(base64.decodestring(a_host['ssh_priv_key']))
-        logger.debug('Wrote key for {0}'.format(a_host['address']))
-        f.close()
-
-        transport = ansibleapi.Transport()
-        result, facts = getattr(transport, command)(
-            a_host['address'], key_file, oscmd())
-        try:
-            f.unlink(key_file)
-            logger.debug('Removed temporary key file {0}'.format(key_file))
-        except:
-            logger.warn(
-                'Unable to remove the temporary key file: {0}'.format(
-                    key_file))
-
-        # If there was a failure set the end_status and break out
-        if result != 0:
-            end_status = 'failed'
-            break
-
-        cluster_status[finished_hosts_key].append(a_host['address'])
-        try:
-            idx = cluster_status['in_process'].index(a_host['address'])
-            cluster_status['in_process'].pop(idx)
-        except ValueError:
-            logger.warn('Host {0} was not in_process for {1} {2}'.format(
-                a_host['address'], command, cluster_name))
-
-        store.set(
-            '/commissaire/cluster/{0}/{1}'.format(cluster_name, command),
-            json.dumps(cluster_status))
-        logger.info('Finished executing {0} for {1} in {2}'.format(
-            command, a_host['address'], cluster_name))
+    cluster_hosts = []
+    try:
+        for a_host_dict in store.get('/commissaire/hosts')._children:
+            a_host = json.loads(a_host_dict['value'])
+            if a_host['cluster'] != cluster_name:
+                logger.debug(
+                    'Skipping {0} as it is not in this cluster.'.format(
+                        a_host['address']))
+                continue  # Move on to the next one
+
+            # Hosts sharing a key share a single key file
+            key_file = KEYS.acquire(a_host['ssh_priv_key'])
+            logger.debug(
+                'Using {0} as the key location for {1}'.format(
+                    key_file, a_host['address']))
+            cluster_hosts.append((a_host, key_file))
+
+        # Pay the SSH handshake for every host up front and in parallel
+        transport.prewarm([
+            (a_host['address'], key_file)
+            for a_host, key_file in cluster_hosts])
+
+        for a_host, key_file in cluster_hosts:
+            oscmd = get_oscmd(a_host['os'])
+
+            command_list = getattr(oscmd(), command)()  # Only used for logging
+            logger.info('Executing {0} on {1}...'.format(
+                command_list, a_host['address']))
+
+            cluster_status['in_process'].append(a_host['address'])
+            store.set(
+                '/commissaire/cluster/{0}/{1}'.format(cluster_name, command),
+                json.dumps(cluster_status))
+
+            result, facts = getattr(transport, command)(
+                a_host['address'], key_file, oscmd())
+
+            # If there was a failure set the end_status and break out
+            if result != 0:
+                end_status = 'failed'
+                break
+
+            cluster_status[finished_hosts_key].append(a_host['address'])
+            try:
+                idx = cluster_status['in_process'].index(a_host['address'])
+                cluster_status['in_process'].pop(idx)
+            except ValueError:
+                logger.warn('Host {0} was not in_process for {1} {2}'.format(
+                    a_host['address'], command, cluster_name))
+
+            store.set(
+                '/commissaire/cluster/{0}/{1}'.format(cluster_name, command),
+                json.dumps(cluster_status))
+            logger.info('Finished executing {0} for {1} in {2}'.format(
+                command, a_host['address'], cluster_name))
+    finally:
+        # Key files are shared, so never leave a reference behind
+        for a_host, key_file in cluster_hosts:
+            KEYS.release(key_file)
 
     # Final set of command result
     cluster_status['finished_at'] = datetime.datetime.utcnow().isoformat()
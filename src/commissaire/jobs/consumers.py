@@ -0,0 +1,152 @@
+# Copyright (C) 2016  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Consumers moving jobs from the durable queues to the local workers.
+"""
+
+import logging
+import sys
+
+import gevent
+
+from gevent.lock import Semaphore
+
+from commissaire.jobqueue import EtcdQueue
+from commissaire.jobs import POOLS
+from commissaire.jobs.clusterexec import clusterexec
+
+
+def keep_claimed(jobs, held):
+    """
+    Extends the claims on held jobs until killed.
+
+    :param jobs: The queue the jobs were claimed from.
+    :type jobs: commissaire.jobqueue.EtcdQueue
+    :param held: Returns the jobs currently held.
+    :type held: callable
+    """
+    while True:
+        gevent.sleep(jobs.visibility_timeout / 3.0)
+        for job in held():
+            jobs.extend(job)
+
+
+def investigations(store, queue, max_claimed=10, visibility_timeout=300,
+                   members=None, run_once=False):
+    """
+    Feeds durable investigation jobs into the local investigation queue.
+
+    Jobs are acknowledged once the investigator is done with their host.
+    At most max_claimed jobs are held at once so other workers get their
+    share. With members only hosts owned by this worker are investigated
+    here, keeping its connections and caches for its own shard.
+
+    :param store: Data store holding the jobs.
+    :type store: etcd.Client
+    :param queue: The local investigation queue.
+    :type queue: commissaire.queues.LaneQueue
+    :param max_claimed: Most jobs to hold at the same time.
+    :type max_claimed: int
+    :param visibility_timeout: Seconds a claim lasts unless extended.
+    :type visibility_timeout: int
+    :param members: Live workers. Only jobs for owned hosts are claimed.
+    :type members: commissaire.membership.Membership
+    """
+    logger = logging.getLogger('jobqueue')
+
+    def accept(payload):
+        return members is None or members.owns(payload['host']['address'])
+
+    jobs = EtcdQueue(store, 'investigate',
+                     visibility_timeout=visibility_timeout, members=members,
+                     accept=accept)
+    slots = Semaphore(max_claimed)
+    #: address -> jobs merged into the queued entry for the address
+    held = {}
+
+    def finished(item, requeued):
+        claimed = held.pop(item[0]['address'], [])
+        if requeued and claimed:
+            # The newest job is waiting again in the queue
+            held[item[0]['address']] = [claimed.pop()]
+        for job in claimed:
+            jobs.ack(job)
+            slots.release()
+
+    queue.add_done_callback(finished)
+    heartbeat = gevent.spawn(
+        keep_claimed, jobs, lambda: sum(held.values(), []))
+    try:
+        while True:
+            slots.acquire()
+            job = jobs.get()
+            host = job.payload['host']
+            logger.info('Investigation of {0} claimed as {1}'.format(
+                host['address'], job))
+            held.setdefault(host['address'], []).append(job)
+            queue.put((host, job.payload['ssh_priv_key']))
+            if run_once:
+                break
+    finally:
+        heartbeat.kill()
+
+
+def run_operation(jobs, job, store):
+    """
+    Runs a claimed cluster operation and acknowledges it.
+
+    :param jobs: The queue the job was claimed from.
+    :type jobs: commissaire.jobqueue.EtcdQueue
+    :param job: The claimed job.
+    :type job: commissaire.jobqueue.Job
+    :param store: Data store to place results.
+    :type store: etcd.Client
+    """
+    heartbeat = gevent.spawn(keep_claimed, jobs, lambda: [job])
+    try:
+        clusterexec(job.payload['cluster'], job.payload['command'], store)
+    except Exception:
+        # Killed operations are left for another worker to claim
+        _, exc_msg, _ = sys.exc_info()
+        logging.getLogger('jobqueue').warn(
+            '{0} failed: {1}'.format(job, exc_msg))
+    finally:
+        heartbeat.kill()
+    jobs.ack(job)
+
+
+def operations(store, visibility_timeout=300, members=None, run_once=False):
+    """
+    Runs durable cluster operation jobs in the clusterexec pool.
+
+    :param store: Data store holding the jobs.
+    :type store: etcd.Client
+    :param visibility_timeout: Seconds a claim lasts unless extended.
+    :type visibility_timeout: int
+    :param members: Live workers to hand off jobs from.
+    :type members: commissaire.membership.Membership
+    """
+    logger = logging.getLogger('jobqueue')
+    jobs = EtcdQueue(store, 'clusterexec',
+                     visibility_timeout=visibility_timeout, members=members)
+    while True:
+        # Only claim what can start right away
+        POOLS['clusterexecpool'].wait_available()
+        job = jobs.get()
+        logger.info('{0} of {1} claimed as {2}'.format(
+            job.payload['command'], job.payload['cluster'], job))
+        POOLS['clusterexecpool'].spawn(run_operation, jobs, job, store)
+        if run_once:
+            break
@@ -0,0 +1,112 @@
+# Copyright (C) 2016  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Removes deleted hosts from the container manager.
+"""
+
+import logging
+import sys
+
+import etcd
+import gevent
+
+from gevent.pool import Pool
+
+from commissaire.containermgr.kubernetes import get_container_manager
+
+
+def deregister(queue, config, store, batch_size=50, concurrency=5,
+               retries=3, retry_delay=5, run_once=False):
+    """
+    Removes nodes from the container manager in batches. Hosts which have
+    been added again since they were deleted are left registered.
+
+    :param queue: Queue to pull addresses from.
+    :type queue: gevent.queue.Queue
+    :param config: Configuration information.
+    :type config: commissaire.config.Config
+    :param store: Data store holding the hosts.
+    :type store: etcd.Client
+    :param batch_size: Most nodes to remove in one batch.
+    :type batch_size: int
+    :param concurrency: Number of removals to run at the same time.
+    :type concurrency: int
+    :param retries: Number of times a failed removal is tried again.
+    :type retries: int
+    :param retry_delay: Seconds before the first retry. Doubles each time.
+    :type retry_delay: int
+    """
+    logger = logging.getLogger('deregister')
+    logger.info('Deregister started')
+
+    #: address -> number of failed attempts
+    attempts = {}
+
+    # True when removed, False to retry, None when the host is back
+    def remove(address):
+        try:
+            # A retry may come after the host was added again
+            store.get('/commissaire/hosts/{0}'.format(address))
+            logger.info('{0} was added again. Not removing it.'.format(
+                address))
+            return None
+        except etcd.EtcdKeyNotFound:
+            pass
+        except:
+            _, exc_msg, _ = sys.exc_info()
+            logger.debug('{0} Exception: {1}'.format(address, exc_msg))
+            return False
+        try:
+            if get_container_manager(config).remove_node(address):
+                return True
+        except:
+            _, exc_msg, _ = sys.exc_info()
+            logger.debug('{0} Exception: {1}'.format(address, exc_msg))
+        return False
+
+    while True:
+        batch = [queue.get()]
+        while len(batch) < batch_size and not queue.empty():
+            address = queue.get()
+            if address not in batch:
+                batch.append(address)
+
+        pool = Pool(concurrency)
+        for address, removed in zip(batch, pool.map(remove, batch)):
+            if removed is None:
+                attempts.pop(address, None)
+                continue
+            if removed:
+                logger.info(
+                    '{0} was removed from the container manager.'.format(
+                        address))
+                attempts.pop(address, None)
+                continue
+            failed = attempts.get(address, 0) + 1
+            if failed > retries:
+                logger.warn(
+                    'Giving up removing {0} from the container '
+                    'manager.'.format(address))
+                attempts.pop(address, None)
+                continue
+            attempts[address] = failed
+            delay = retry_delay * 2 ** (failed - 1)
+            logger.debug('Removing {0} failed. Retrying in {1}s.'.format(
+                address, delay))
+            gevent.spawn_later(delay, queue.put, address)
+
+        if run_once:
+            logger.info('Exiting due to run_once request.')
+            break
@@ -19,34 +19,151 @@ The investigator job.
 import datetime
 import json
 import logging
-import os
 import sys
-import tempfile
 
-import gevent
+import etcd
 
-from commissaire.compat.b64 import base64
-from commissaire.containermgr.kubernetes import KubeContainerManager
+from commissaire.containermgr.kubernetes import get_container_manager
+from commissaire.jobs.reflector import MIRRORED_STATUSES
 from commissaire.oscmd import get_oscmd
-from commissaire.transport import ansibleapi
+from commissaire.transport.keys import KEYS
+from commissaire.transport.worker import get_transport
 
+#: Times a refresh re-reads a host which changed while it was written
+REFRESH_ATTEMPTS = 3
 
-def clean_up_key(key_file):
+
+def refresh(transport, store, address, key_file):
     """
-    Remove the key file.
+    Refreshes the facts and last_check of a host which is already set up.
+    The status is left to the reflector and the host is not bootstrapped
+    again.
 
-    :param key_file: Full path to the key_file
+    :param transport: Transport to retrieve facts with.
+    :type transport: commissaire.transport.ansibleapi.Transport
+    :param store: Data store holding the host.
+    :type store: etcd.Client
+    :param address: The address of the host.
+    :type address: str
+    :param key_file: Path to the SSH private key of the host.
     :type key_file: str
+    :returns: True if the host was updated, otherwise False
+    :rtype: bool
     """
     logger = logging.getLogger('investigator')
     try:
-        os.unlink(key_file)
-        logger.debug('Removed temporary key file {0}'.format(key_file))
+        result, facts = transport.get_info(address, key_file, fast=True)
+    except:
+        _, exc_msg, _ = sys.exc_info()
+        logger.warn('Refreshing facts failed for {0}: {1}'.format(
+            address, exc_msg))
+        return False
+
+    key = '/commissaire/hosts/{0}'.format(address)
+    for attempt in range(REFRESH_ATTEMPTS):
+        try:
+            host = store.get(key)
+            data = json.loads(host.value)
+            data.update(facts)
+            data['last_check'] = datetime.datetime.utcnow().isoformat()
+            # Never overwrite a status change made since it was read
+            store.write(key, json.dumps(data), prevIndex=host.modifiedIndex)
+            logger.info('Refreshed facts for {0}'.format(address))
+            return True
+        except etcd.EtcdKeyNotFound:
+            logger.info('{0} was deleted while refreshing.'.format(address))
+            return False
+        except etcd.EtcdCompareFailed:
+            logger.debug('{0} changed while refreshing. Retrying.'.format(
+                address))
+    logger.warn('Unable to store refreshed facts for {0}'.format(address))
+    return False
+
+
+def investigate(transport, config, store, to_investigate, key_file):
+    """
+    Retrieves the facts of a host and bootstraps it, storing each status
+    along the way.
+
+    :param transport: Transport to work with the host through.
+    :type transport: commissaire.transport.ansibleapi.Transport
+    :param config: Configuration information.
+    :type config: commissaire.config.Config
+    :param store: Data store to place results.
+    :type store: etcd.Client
+    :param to_investigate: The queued host. Holds at least the address.
+    :type to_investigate: dict
+    :param key_file: Path to the SSH private key of the host.
+    :type key_file: str
+    :raises: etcd.EtcdKeyNotFound if the host does not exist
+    """
+    logger = logging.getLogger('investigator')
+    address = to_investigate['address']
+    key = '/commissaire/hosts/{0}'.format(address)
+    data = json.loads(store.get(key).value)
+
+    if (to_investigate.get('refresh') and
+            data.get('status') in MIRRORED_STATUSES):
+        # Scheduled refresh of a host the reflector now looks after
+        refresh(transport, store, address, key_file)
+        return
+
+    try:
+        result, facts = transport.get_info(address, key_file, fast=True)
+        data.update(facts)
+        data['last_check'] = datetime.datetime.utcnow().isoformat()
+        data['status'] = 'bootstrapping'
+        logger.info('Facts for {0} retrieved'.format(address))
+    except:
+        logger.warn('Getting info failed for {0}'.format(address))
+        data['status'] = 'failed'
+        store.set(key, json.dumps(data))
+        exc_type, exc_msg, tb = sys.exc_info()
+        logger.debug('{0} Exception: {1}'.format(address, exc_msg))
+        return
+
+    store.set(key, json.dumps(data))
+    logger.info(
+        'Finished and stored investigation data for {0}'.format(address))
+    logger.debug('Finished investigation update for {0}: {1}'.format(
+        address, data))
+    # --
+    logger.info('{0} is now in bootstrapping'.format(address))
+    oscmd = get_oscmd(data['os'])()
+    try:
+        result, facts = transport.bootstrap(
+            address, key_file, config, oscmd)
+        data['status'] = 'inactive'
+        store.set(key, json.dumps(data))
     except:
+        logger.warn('Unable to bootstrap {0}'.format(address))
         exc_type, exc_msg, tb = sys.exc_info()
-        logger.warn(
-            'Unable to remove the temporary key file: '
-            '{0}. Exception:{1}'.format(key_file, exc_msg))
+        logger.debug('{0} Exception: {1}'.format(address, exc_msg))
+        data['status'] = 'disassociated'
+        store.set(key, json.dumps(data))
+        return
+
+    # Verify association with the container manager
+    try:
+        container_mgr = get_container_manager(config)
+        if not container_mgr.wait_for_node(address):
+            raise Exception(
+                'Could not register with the container manager')
+        logger.info(
+            '{0} has been registered with the container manager.'.format(
+                address))
+        data['status'] = 'active'
+    except:
+        logger.warn('Unable to bootstrap {0}'.format(address))
+        exc = sys.exc_info()[0]
+        logger.debug('{0} Exception: {1}'.format(address, exc))
+        data['status'] = 'inactive'
+
+    store.set(key, json.dumps(data))
+    logger.info(
+        'Finished bootstrapping for {0}'.format(address))
+    logging.debug('Finished bootstrapping for {0}: {1}'.format(
+        address, data))
 
 
 def investigator(queue, config, store, run_once=False):
@@ -54,7 +171,7 @@ def investigator(queue, config, store, run_once=False):
     Investigates new hosts to retrieve and store facts.
 
     :param queue: Queue to pull work from.
-    :type queue: gevent.queue.Queue
+    :type queue: commissaire.queues.LaneQueue
     :param config: Configuration information.
     :type config: commissaire.config.Config
     :param store: Data store to place results.
@@ -65,99 +182,31 @@ def investigator(queue, config, store, run_once=False):
     logger = logging.getLogger('investigator')
     logger.info('Investigator started')
 
-    transport = ansibleapi.Transport()
+    transport = get_transport()
     while True:
         # Statuses follow:
         # http://commissaire.readthedocs.org/en/latest/enums.html#host-statuses
-        to_investigate, ssh_priv_key = queue.get()
+        entry = queue.get()
+        to_investigate, ssh_priv_key = entry
         address = to_investigate['address']
         logger.info('{0} is now in investigating.'.format(address))
         logger.debug('Investigation details: key={0}, data={1}'.format(
             to_investigate, ssh_priv_key))
 
-        f = tempfile.NamedTemporaryFile(prefix='key', delete=False)
-        key_file = f.name
+        key_file = KEYS.acquire(ssh_priv_key)
         logger.debug(
-            'Using {0} as the temporary key location for {1}'.format(
+            'Using {0} as the key location for {1}'.format(
                 key_file, address))
-        f.write(base64.decodestring(ssh_priv_key))
-        logger.debug('Wrote key for {0}'.format(address))
-        f.close()
-
-        key = '/commissaire/hosts/{0}'.format(address)
-        data = json.loads(store.get(key).value)
-
         try:
-            result, facts = transport.get_info(address, key_file)
-            data.update(facts)
-            data['last_check'] = datetime.datetime.utcnow().isoformat()
-            data['status'] = 'bootstrapping'
-            logger.info('Facts for {0} retrieved'.format(address))
-        except:
-            logger.warn('Getting info failed for {0}'.format(address))
-            data['status'] = 'failed'
-            store.set(key, json.dumps(data))
-            exc_type, exc_msg, tb = sys.exc_info()
-            logger.debug('{0} Exception: {1}'.format(address, exc_msg))
-            clean_up_key(key_file)
-            if run_once:
-                break
-            continue
-
-        store.set(key, json.dumps(data))
-        logger.info(
-            'Finished and stored investigation data for {0}'.format(address))
-        logger.debug('Finished investigation update for {0}: {1}'.format(
-            address, data))
-        # --
-        logger.info('{0} is now in bootstrapping'.format(address))
-        oscmd = get_oscmd(data['os'])()
-        try:
-            result, facts = transport.bootstrap(
-                address, key_file, config, oscmd)
-            data['status'] = 'inactive'
-            store.set(key, json.dumps(data))
-        except:
-            logger.warn('Unable to bootstrap {0}'.format(address))
-            exc_type, exc_msg, tb = sys.exc_info()
-            logger.debug('{0} Exception: {1}'.format(address, exc_msg))
-            data['status'] = 'disassociated'
-            store.set(key, json.dumps(data))
-            clean_up_key(key_file)
-            if run_once:
-                break
-            continue
-
-        # Verify association with the container manager
-        try:
-            container_mgr = KubeContainerManager(config)
-            # Try 3 times waiting 5 seconds each time before giving up
-            for cnt in range(0, 3):
-                if container_mgr.node_registered(address):
-                    logger.info(
-                        '{0} has been registered with the container manager.')
-                    data['status'] = 'active'
-                    break
-                if cnt == 3:
-                    raise Exception(
-                        'Could not register with the container manager')
-                logger.debug(
-                    '{0} has not been registered with the container manager. '
-                    'Checking again in 5 seconds...'.format(address))
-                gevent.sleep(5)
-        except:
-            logger.warn('Unable to bootstrap {0}'.format(address))
-            exc = sys.exc_info()[0]
-            logger.debug('{0} Exception: {1}'.format(address, exc))
-            data['status'] = 'inactive'
-
-        store.set(key, json.dumps(data))
-        logger.info(
-            'Finished bootstrapping for {0}'.format(address))
-        logging.debug('Finished bootstrapping for {0}: {1}'.format(
-            address, data))
+            investigate(transport, config, store, to_investigate, key_file)
+        except etcd.EtcdKeyNotFound:
+            logger.info('{0} was deleted before it was investigated.'.format(
+                address))
+        finally:
+            # Always hand back the key and let the host be queued again
+            KEYS.release(key_file)
+            queue.done(entry)
 
-        clean_up_key(key_file)
         if run_once:
             logger.info('Exiting due to run_once request.')
             break
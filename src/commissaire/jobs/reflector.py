@@ -0,0 +1,165 @@
+# Copyright (C) 2016  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Mirrors container manager node readiness into host statuses.
+"""
+
+import json
+import logging
+import sys
+
+import etcd
+import gevent
+
+from gevent.pool import Pool
+from gevent.queue import Queue
+
+from commissaire.containermgr.kubernetes import get_container_manager
+
+
+#: Host statuses which follow node readiness. Hosts in any other status
+#: are still owned by the investigator.
+MIRRORED_STATUSES = ('active', 'inactive')
+
+
+def node_status(event_type, node):
+    """
+    Returns the host status matching a node event.
+
+    :param event_type: ADDED, MODIFIED or DELETED.
+    :type event_type: str
+    :param node: The node object.
+    :type node: dict
+    :returns: active if the node is Ready, otherwise inactive
+    :rtype: str
+    """
+    if event_type != 'DELETED':
+        for condition in node.get('status', {}).get('conditions', []):
+            if condition.get('type') == 'Ready':
+                if condition.get('status') == 'True':
+                    return 'active'
+                break
+    return 'inactive'
+
+
+def changed_statuses(known, batch):
+    """
+    Returns the latest status of each node in a batch whose readiness
+    changed. Heartbeats only refresh other conditions and are dropped.
+
+    :param known: Node name -> last seen status. Updated in place.
+    :type known: dict
+    :param batch: List of (event type, node) tuples.
+    :type batch: list
+    :returns: Node name -> new status.
+    :rtype: dict
+    """
+    statuses = {}
+    for event_type, node in batch:
+        statuses[node['metadata']['name']] = node_status(event_type, node)
+    changed = {}
+    for name, status in statuses.items():
+        if known.get(name) != status:
+            known[name] = status
+            changed[name] = status
+    return changed
+
+
+def apply_statuses(store, statuses, concurrency=10):
+    """
+    Updates host statuses with parallel reads and compare-and-swap writes.
+    Only the hosts in statuses are read.
+
+    :param store: Data store holding the hosts.
+    :type store: etcd.Client
+    :param statuses: Host address -> new status.
+    :type statuses: dict
+    :param concurrency: Number of hosts to update at the same time.
+    :type concurrency: int
+    :returns: The addresses which were updated.
+    :rtype: list
+    """
+    logger = logging.getLogger('reflector')
+
+    def apply(item):
+        address, status = item
+        try:
+            host = store.get('/commissaire/hosts/{0}'.format(address))
+            data = json.loads(host.value)
+            if (data.get('status') == status or
+                    data.get('status') not in MIRRORED_STATUSES):
+                return None
+            data['status'] = status
+            # Never overwrite a record changed since it was read
+            store.write(
+                host.key, json.dumps(data), prevIndex=host.modifiedIndex)
+            logger.info('{0} is now {1}'.format(address, status))
+            return address
+        except etcd.EtcdKeyNotFound:
+            # Not a commissaire host
+            pass
+        except etcd.EtcdCompareFailed:
+            logger.debug('{0} changed while updating. Skipping.'.format(
+                address))
+        except:
+            _, exc_msg, _ = sys.exc_info()
+            logger.warn('Unable to update {0}: {1}'.format(
+                address, exc_msg))
+
+    pool = Pool(concurrency)
+    return [x for x in pool.map(apply, statuses.items()) if x is not None]
+
+
+def reflector(config, store, interval=1, run_once=False):
+    """
+    Follows node readiness through the container manager's watch and
+    mirrors it into host statuses in batches.
+
+    :param config: Configuration information.
+    :type config: commissaire.config.Config
+    :param store: Data store to place results.
+    :type store: etcd.Client
+    :param interval: Seconds to collect events before each update.
+    :type interval: int
+    """
+    logger = logging.getLogger('reflector')
+    logger.info('Reflector started')
+
+    events = Queue()
+    container_mgr = get_container_manager(config)
+    container_mgr.add_listener(
+        lambda event_type, node: events.put((event_type, node)))
+    container_mgr.watch()
+    # Node name -> last seen status
+    known = {}
+
+    while True:
+        # Block until something happens, then batch what follows
+        batch = [events.get()]
+        gevent.sleep(interval)
+        while not events.empty():
+            batch.append(events.get())
+
+        # Only the latest status of nodes whose readiness changed matters
+        statuses = changed_statuses(known, batch)
+        updated = []
+        if statuses:
+            updated = apply_statuses(store, statuses)
+        logger.debug('Applied {0} node events, updated {1} hosts.'.format(
+            len(batch), len(updated)))
+
+        if run_once:
+            logger.info('Exiting due to run_once request.')
+            break
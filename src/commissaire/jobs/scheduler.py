@@ -0,0 +1,337 @@
+# Copyright (C) 2016  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Re-investigation scheduling for hosts with stale facts.
+"""
+
+import datetime
+import heapq
+import json
+import logging
+import random
+import time
+
+import etcd
+import gevent
+
+from commissaire.events import SubscriptionClosed
+from commissaire.jobs.reflector import MIRRORED_STATUSES
+
+
+#: Fraction of the interval after which a host in a status is due again.
+#: Hosts in statuses not listed are being worked on and are not scheduled.
+STATUS_FACTORS = {
+    'active': 1.0,
+    'inactive': 0.5,
+    'failed': 0.25,
+    'disassociated': 0.25,
+}
+
+#: Format of last_check as written by the investigator
+LAST_CHECK_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def _timestamp(last_check):
+    """
+    Converts a last_check value to seconds since the epoch.
+
+    :param last_check: The last_check value of a host.
+    :type last_check: str
+    :returns: Seconds since the epoch or 0 if unknown.
+    :rtype: float
+    """
+    try:
+        checked = datetime.datetime.strptime(last_check, LAST_CHECK_FORMAT)
+    except (TypeError, ValueError):
+        return 0
+    delta = checked - datetime.datetime(1970, 1, 1)
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+class Scheduler:
+    """
+    Keeps hosts in a min-heap keyed by the time they are next due.
+
+    Entries are never removed from the middle of the heap. Rescheduling a
+    host pushes a new entry and stale ones are skipped when they surface,
+    so every operation is O(log n).
+    """
+
+    def __init__(self, queue, store, interval=3600, jitter=0.1, rate=10,
+                 members=None):
+        """
+        Creates an instance of the Scheduler.
+
+        :param queue: Investigation queue to feed due hosts into.
+        :type queue: commissaire.queues.LaneQueue
+        :param store: Data store holding the hosts.
+        :type store: etcd.Client
+        :param interval: Seconds between investigations of an active host.
+        :type interval: int
+        :param jitter: Fraction of the interval to randomly spread by.
+        :type jitter: float
+        :param rate: Most hosts to queue per second.
+        :type rate: int
+        :param members: Live workers. Only owned hosts are scheduled.
+        :type members: commissaire.membership.Membership
+        """
+        self.logger = logging.getLogger('scheduler')
+        self.queue = queue
+        self.store = store
+        self.interval = interval
+        self.jitter = jitter
+        self.rate = rate
+        self.members = members
+        self._heap = []
+        #: address -> due time of the live heap entry
+        self._due = {}
+
+    def __len__(self):
+        """
+        Returns the number of scheduled hosts.
+        """
+        return len(self._due)
+
+    def next_due(self, data, now=None):
+        """
+        Returns when a host should next be investigated.
+
+        :param data: The host record.
+        :type data: dict
+        :param now: The current time. Default: time.time()
+        :type now: float
+        :returns: Seconds since the epoch or None if not to be scheduled.
+        :rtype: float
+        """
+        factor = STATUS_FACTORS.get(data.get('status'))
+        if factor is None:
+            return None
+        if now is None:
+            now = time.time()
+        interval = self.interval * factor
+        interval += interval * random.uniform(-self.jitter, self.jitter)
+        due = _timestamp(data.get('last_check')) + interval
+        if due < now:
+            # Spread overdue hosts out instead of making them all due now
+            due = now + random.uniform(0, interval * self.jitter)
+        return due
+
+    def schedule(self, address, due):
+        """
+        Schedules a host, replacing any earlier schedule.
+
+        :param address: The address of the host.
+        :type address: str
+        :param due: Seconds since the epoch when the host is due.
+        :type due: float
+        """
+        self._due[address] = due
+        heapq.heappush(self._heap, (due, address))
+
+    def remove(self, address):
+        """
+        Removes a host from the schedule.
+
+        :param address: The address of the host.
+        :type address: str
+        """
+        self._due.pop(address, None)
+
+    def owns(self, address):
+        """
+        Returns if this worker is responsible for a host.
+
+        :param address: The address of the host.
+        :type address: str
+        :returns: True if owned, otherwise False
+        :rtype: bool
+        """
+        return self.members is None or self.members.owns(address)
+
+    def apply(self, event, now=None):
+        """
+        Reschedules a host after a change to its record.
+
+        :param event: A host event.
+        :type event: commissaire.events.Event
+        :param now: The current time. Default: time.time()
+        :type now: float
+        """
+        if event.address is None:
+            return
+        if event.data is None or not self.owns(event.address):
+            self.remove(event.address)
+            return
+        due = self.next_due(event.data, now)
+        # Hosts being worked on keep their schedule
+        if due is not None:
+            self.schedule(event.address, due)
+
+    def pop_due(self, now, limit):
+        """
+        Pops hosts which are due.
+
+        :param now: The current time.
+        :type now: float
+        :param limit: Most hosts to pop.
+        :type limit: int
+        :returns: The addresses of the due hosts.
+        :rtype: list
+        """
+        due = []
+        while self._heap and len(due) < limit and self._heap[0][0] <= now:
+            when, address = heapq.heappop(self._heap)
+            if self._due.get(address) != when:
+                # Rescheduled or removed since this entry was pushed
+                continue
+            del self._due[address]
+            due.append(address)
+        return due
+
+    def load(self, now=None):
+        """
+        Schedules all known hosts which are not already scheduled.
+
+        :param now: The current time. Default: time.time()
+        :type now: float
+        """
+        try:
+            hosts_dir = self.store.get('/commissaire/hosts/')
+        except etcd.EtcdKeyNotFound:
+            return
+        if not len(hosts_dir._children):
+            return
+        for host in hosts_dir.leaves:
+            data = json.loads(host.value)
+            address = data.get('address')
+            if (address is None or address in self._due or
+                    not self.owns(address)):
+                continue
+            due = self.next_due(data, now)
+            if due is not None:
+                self.schedule(address, due)
+
+    def tick(self, now=None):
+        """
+        Queues the hosts which are due, up to the rate.
+
+        :param now: The current time. Default: time.time()
+        :type now: float
+        :returns: The addresses which were queued.
+        :rtype: list
+        """
+        if now is None:
+            now = time.time()
+        queued = []
+        for address in self.pop_due(now, self.rate):
+            if not self.owns(address):
+                # Moved to another worker. Picked up again by load() if
+                # it comes back.
+                continue
+            try:
+                data = json.loads(self.store.get(
+                    '/commissaire/hosts/{0}'.format(address)).value)
+            except etcd.EtcdKeyNotFound:
+                # Deleted hosts simply fall out of the schedule
+                continue
+            if data.get('status') not in STATUS_FACTORS:
+                # Being worked on. Look again later.
+                self.schedule(address, now + self.interval * 0.25)
+                continue
+            lane = 'background'
+            if STATUS_FACTORS[data['status']] < 1:
+                lane = 'retry'
+            to_investigate = {'address': address}
+            if data['status'] in MIRRORED_STATUSES:
+                # Only the facts are refreshed. Bootstrapping again would
+                # fight the reflector over the status.
+                to_investigate['refresh'] = True
+            self.queue.put(
+                (to_investigate, data['ssh_priv_key']), lane=lane)
+            queued.append(address)
+            # The investigation updates last_check. Until it is reloaded
+            # the host is not due again for a full interval.
+            self.schedule(address, now + self.interval)
+        if queued:
+            self.logger.info('Queued {0} hosts for re-investigation.'.format(
+                len(queued)))
+        return queued
+
+
+def scheduler(queue, store, interval=3600, jitter=0.1, rate=10,
+              members=None, events=None, run_once=False):
+    """
+    Feeds hosts with stale facts into the investigation queue.
+
+    :param queue: Queue to feed.
+    :type queue: commissaire.queues.LaneQueue
+    :param store: Data store holding the hosts.
+    :type store: etcd.Client
+    :param interval: Seconds between investigations of an active host.
+    :type interval: int
+    :param jitter: Fraction of the interval to randomly spread by.
+    :type jitter: float
+    :param rate: Most hosts to queue per second.
+    :type rate: int
+    :param members: Live workers. Only owned hosts are scheduled.
+    :type members: commissaire.membership.Membership
+    :param events: Bus to follow host changes on. When given hosts are
+                   only reloaded after missed events or ring changes.
+    :type events: commissaire.events.EventBus
+    """
+    logger = logging.getLogger('scheduler')
+    logger.info('Scheduler started')
+
+    schedule = Scheduler(queue, store, interval, jitter, rate, members)
+    subscription = None
+    ring = None
+    reload = True
+    last_load = 0
+    while True:
+        now = time.time()
+        if events is not None and (
+                subscription is None or subscription.closed):
+            subscription = events.subscribe(
+                event_types=('host',), overflow='close')
+            # Anything missed is caught up by the reload
+            reload = True
+        if subscription is not None:
+            try:
+                for event in subscription.drain():
+                    if event.kind == 'resync':
+                        reload = True
+                    else:
+                        schedule.apply(event, now)
+            except SubscriptionClosed:
+                reload = True
+        if members is not None and members.ring is not ring:
+            # Hosts may have moved to this worker
+            ring = members.ring
+            reload = True
+        # Without events new hosts are only found by a periodic reload
+        if events is None and now - last_load >= min(interval, 60):
+            reload = True
+        if reload:
+            schedule.load(now)
+            last_load = now
+            reload = False
+        schedule.tick(now)
+
+        if run_once:
+            logger.info('Exiting due to run_once request.')
+            if subscription is not None:
+                subscription.close()
+            break
+        gevent.sleep(1)
@@ -0,0 +1,214 @@
+# Copyright (C) 2016  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Worker membership kept in etcd.
+
+Every commissaire process running background jobs registers itself as
+/commissaire/workers/<id> with a TTL and refreshes it while alive. The
+registration is the worker's lease. Once it expires the worker is
+considered gone and its claimed jobs are handed to the others.
+
+Hosts are sharded across the live workers with a consistent-hash ring so
+each host has one owning worker, and a worker joining or leaving only
+moves the hosts it gains or loses.
+"""
+
+import bisect
+import datetime
+import hashlib
+import json
+import logging
+import os
+import socket
+import sys
+import uuid
+
+import etcd
+import gevent
+
+
+#: Identifies this process to other workers
+WORKER_ID = '{0}-{1}-{2}'.format(
+    socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+#: Where workers register themselves
+WORKERS_DIR = '/commissaire/workers'
+
+
+def _hash(key):
+    """
+    Returns the position of a key on the ring.
+
+    :param key: The key to place.
+    :type key: str
+    :returns: A 64 bit position.
+    :rtype: int
+    """
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing:
+    """
+    Consistent-hash ring assigning keys to members.
+    """
+
+    def __init__(self, members, replicas=64):
+        """
+        Creates an instance of the HashRing.
+
+        :param members: The members to spread keys over.
+        :type members: list
+        :param replicas: Points per member. More spread keys more evenly.
+        :type replicas: int
+        """
+        self.members = sorted(members)
+        points = sorted(
+            (_hash('{0}-{1}'.format(member, x)), member)
+            for member in self.members for x in range(replicas))
+        self._points = [x[0] for x in points]
+        self._owners = [x[1] for x in points]
+
+    def owner(self, key):
+        """
+        Returns the member owning a key.
+
+        :param key: The key to look up.
+        :type key: str
+        :returns: The owning member or None if there are no members.
+        :rtype: str
+        """
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, _hash(key))
+        return self._owners[index % len(self._owners)]
+
+
+class Membership:
+    """
+    Registration of a worker and view of all live workers.
+    """
+
+    def __init__(self, store, worker_id=None, ttl=30):
+        """
+        Creates an instance of the Membership.
+
+        :param store: Data store holding the registrations.
+        :type store: etcd.Client
+        :param worker_id: Who registers. Default: WORKER_ID
+        :type worker_id: str
+        :param ttl: Seconds the lease lasts unless refreshed.
+        :type ttl: int
+        """
+        self.logger = logging.getLogger('membership')
+        self.store = store
+        self.worker_id = worker_id or WORKER_ID
+        self.ttl = ttl
+        self.key = '{0}/{1}'.format(WORKERS_DIR, self.worker_id)
+        #: Live workers as of the last heartbeat
+        self.ring = HashRing([])
+        self._value = json.dumps({
+            'hostname': socket.gethostname(),
+            'pid': os.getpid(),
+            'started': datetime.datetime.utcnow().isoformat(),
+        })
+
+    def register(self):
+        """
+        Registers the worker with a fresh lease.
+        """
+        self.store.write(self.key, self._value, ttl=self.ttl)
+        self.logger.info('Registered as {0}'.format(self.worker_id))
+        self.update_ring()
+
+    def refresh(self):
+        """
+        Extends the lease, registering again if it already expired.
+        """
+        try:
+            self.store.write(
+                self.key, self._value, ttl=self.ttl, prevExist=True)
+        except etcd.EtcdKeyNotFound:
+            # Others may have taken over our jobs by now
+            self.logger.warn('Lease of {0} expired. Registering again.'.format(
+                self.worker_id))
+            self.register()
+
+    def leave(self):
+        """
+        Removes the registration so others take over right away.
+        """
+        try:
+            self.store.delete(self.key)
+        except etcd.EtcdKeyNotFound:
+            pass
+        self.logger.info('{0} left'.format(self.worker_id))
+
+    def members(self):
+        """
+        Returns the live workers.
+
+        :returns: Sorted worker ids.
+        :rtype: list
+        """
+        try:
+            workers = self.store.read(WORKERS_DIR)
+        except etcd.EtcdKeyNotFound:
+            return []
+        return sorted(
+            x.key.rsplit('/', 1)[-1] for x in workers.leaves
+            if not x.dir and x.key != WORKERS_DIR)
+
+    def update_ring(self):
+        """
+        Rebuilds the ring if workers joined or left.
+        """
+        members = self.members()
+        if members != self.ring.members:
+            self.ring = HashRing(members)
+            self.logger.info('Sharding hosts across {0} workers'.format(
+                len(members)))
+
+    def owns(self, key):
+        """
+        Returns if this worker owns a key, such as a host address.
+
+        :param key: The key to look up.
+        :type key: str
+        :returns: True if owned or nothing is known about other workers.
+        :rtype: bool
+        """
+        owner = self.ring.owner(key)
+        return owner is None or owner == self.worker_id
+
+    def heartbeat(self, run_once=False):
+        """
+        Refreshes the lease and the ring until killed.
+
+        :param run_once: If the heartbeat should stop after one refresh.
+        :type run_once: bool
+        """
+        while True:
+            gevent.sleep(self.ttl / 3.0)
+            try:
+                self.refresh()
+                self.update_ring()
+            except Exception:
+                # etcd may come back before the lease runs out
+                _, exc_msg, _ = sys.exc_info()
+                self.logger.warn('Unable to refresh lease: {0}'.format(
+                    exc_msg))
+            if run_once:
+                self.logger.info('Exiting due to run_once request.')
+                break
@@ -35,6 +35,10 @@ class JSONify:
         :param resource: The Resource which has been intercepted.
         :type resource: commissaire.resource.Resource
         """
+        if resp.stream is not None:
+            # Streamed responses write their own body
+            return
+
         if 'model' in req.context.keys() and resp.body is None:
             try:
                 resp.body = req.context['model'].to_json()
@@ -44,6 +44,27 @@ class OSCmdBase:
     #: Kubernetes kube-proxy service name
     kubelet_proxy_service = 'kube-proxy'
 
+    #: Flannel package name
+    flannel_package = 'flannel'
+    #: Docker package name
+    docker_package = 'docker'
+    #: Kubernetes node package name
+    kube_package = 'kubernetes-node'
+
+    #: Commands which do nothing on this OS and may be skipped
+    noop_commands = ()
+
+    def is_noop(self, command):
+        """
+        Checks if a command does nothing on this OS.
+
+        :param command: The command as a list
+        :type command: list
+        :return: True if the command can be skipped, otherwise False
+        :rtype: bool
+        """
+        return list(command) in [list(x) for x in self.noop_commands]
+
     def restart(self):
         """
         Restart command. Must be overriden.
@@ -97,6 +118,16 @@ class OSCmdBase:
             '{0}.install_kube() must be overriden.'.format(
                 self.__class__.__name__))
 
+    def install_packages(self):
+        """
+        Install command for all bootstrap packages in one transaction.
+        Optional: returns None if the OS can not do this.
+
+        :return: The command to execute as a list or None
+        :rtype: list or None
+        """
+        return None
+
 
 def get_oscmd(os_type):
     """
@@ -26,6 +26,8 @@ class OSCmd(OSCmdBase):
 
     #: The type of Operating System
     os_type = 'atomic'
+    #: Commands which do nothing on Atomic and may be skipped
+    noop_commands = (['true'],)
 
     def restart(self):
         """
@@ -99,6 +101,15 @@ class OSCmd(OSCmdBase):
         """
         return ['systemctl', 'start', 'kubelet']
 
+    def install_packages(self):
+        """
+        Atomic install Flannel, Docker and Kube command.
+
+        :return: The command to execute as a list
+        :rtype: list
+        """
+        return ['true']
+
     def start_kube_proxy(self):
         """
         Atomic start Kube Proxy command.
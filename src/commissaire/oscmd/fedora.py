@@ -71,3 +71,14 @@ class OSCmd(OSCmdBase):
         :rtype: list
         """
         return ['dnf', 'install', '-y', 'kubernetes-node']
+
+    def install_packages(self):
+        """
+        Fedora install Flannel, Docker and Kube in one transaction command.
+
+        :return: The command to execute as a list
+        :rtype: list
+        """
+        return [
+            'dnf', 'install', '-y', self.flannel_package,
+            self.docker_package, self.kube_package]
@@ -62,3 +62,14 @@ class OSCmd(OSCmdBase):
         :rtype: list
         """
         return ['yum', 'install', '-y', 'flannel']
+
+    def install_packages(self):
+        """
+        RHEL install Flannel, Docker and Kube in one transaction command.
+
+        :return: The command to execute as a list
+        :rtype: list
+        """
+        return [
+            'yum', 'install', '-y', self.flannel_package,
+            self.docker_package, self.kube_package]
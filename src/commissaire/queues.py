@@ -16,14 +16,257 @@
 All global queues.
 """
 
-from gevent.queue import Queue
+from collections import deque
+
+from gevent.lock import Semaphore
+from gevent.queue import Empty, Queue
+
+from commissaire.events import EventBus
+
+
+class LaneQueue:
+    """
+    Queue with priority lanes and weighted fair dequeue.
+
+    Each lane is a FIFO. get() picks among the lanes with items using
+    smooth weighted round robin, so a busy low weight lane still gets its
+    share but can never starve the others.
+
+    When a key function is given, items are deduplicated by key. A pending
+    item is replaced by a newer one with the same key, keeping the higher
+    priority lane. Items whose key is still being worked on are parked
+    until done() is called for it.
+    """
+
+    #: Lane names and their weights
+    LANES = (
+        ('interactive', 4),
+        ('retry', 2),
+        ('background', 1),
+    )
+
+    def __init__(self, lanes=None, key=None):
+        """
+        Creates an instance of the LaneQueue.
+
+        :param lanes: (name, weight) tuples in priority order.
+        :type lanes: tuple
+        :param key: Returns the deduplication key of an item.
+        :type key: callable
+        """
+        if lanes is None:
+            lanes = self.LANES
+        self.weights = dict(lanes)
+        self.lanes = [name for name, weight in lanes]
+        self.key = key
+        #: lane -> keys in arrival order. May hold stale keys.
+        self._keys = dict((name, deque()) for name in self.lanes)
+        #: lane -> number of live keys
+        self._counts = dict((name, 0) for name in self.lanes)
+        self._credits = dict((name, 0) for name in self.lanes)
+        #: key -> [item, lane] waiting in a lane
+        self._pending = {}
+        #: key -> [item, lane] waiting for the key to be done
+        self._parked = {}
+        #: keys handed out by get() and not yet done
+        self._active = set()
+        self._serial = 0
+        self._done_callbacks = []
+        self._available = Semaphore(0)
+
+    def put(self, item, lane='interactive'):
+        """
+        Adds an item to a lane.
+
+        :param item: The item to add.
+        :param lane: The name of the lane.
+        :type lane: str
+        :raises: KeyError if the lane does not exist
+        """
+        if lane not in self._keys:
+            raise KeyError(lane)
+        if self.key is None:
+            # Every item is unique
+            self._serial += 1
+            key = self._serial
+        else:
+            key = self.key(item)
+
+        if key in self._active:
+            parked = self._parked.get(key)
+            if parked is not None and self._outranks(parked[1], lane):
+                lane = parked[1]
+            self._parked[key] = [item, lane]
+            return
+        self._enqueue(key, item, lane)
+
+    def put_nowait(self, item, lane='interactive'):
+        """
+        Adds an item to a lane. The queue is unbounded so this never blocks.
+        """
+        self.put(item, lane)
+
+    def _outranks(self, lane, other):
+        """
+        Checks if a lane has a higher priority than another.
+
+        :rtype: bool
+        """
+        return self.lanes.index(lane) < self.lanes.index(other)
+
+    def _enqueue(self, key, item, lane):
+        """
+        Makes an item available to get().
+        """
+        pending = self._pending.get(key)
+        if pending is not None:
+            # The latest item wins. It only moves up in priority.
+            pending[0] = item
+            if not self._outranks(lane, pending[1]):
+                return
+            self._counts[pending[1]] -= 1
+            pending[1] = lane
+        else:
+            self._pending[key] = [item, lane]
+            self._available.release()
+        self._keys[lane].append(key)
+        self._counts[lane] += 1
+
+    def _next_lane(self):
+        """
+        Picks the lane to dequeue from next.
+
+        :returns: The name of the lane.
+        :rtype: str
+        """
+        ready = []
+        for name in self.lanes:
+            if self._counts[name]:
+                ready.append(name)
+            else:
+                # Idle lanes do not save up credit
+                self._credits[name] = 0
+        total = 0
+        for name in ready:
+            self._credits[name] += self.weights[name]
+            total += self.weights[name]
+        # Earlier lanes win ties
+        lane = max(ready, key=lambda name: self._credits[name])
+        self._credits[lane] -= total
+        return lane
+
+    def get(self, block=True, timeout=None):
+        """
+        Removes and returns the next item.
+
+        :param block: Wait for an item if the queue is empty.
+        :type block: bool
+        :param timeout: Seconds to wait when blocking. Default: forever
+        :type timeout: int
+        :returns: The next item.
+        :raises: gevent.queue.Empty
+        """
+        if not self._available.acquire(blocking=block, timeout=timeout):
+            raise Empty()
+        lane = self._next_lane()
+        self._counts[lane] -= 1
+        while True:
+            key = self._keys[lane].popleft()
+            pending = self._pending.get(key)
+            # Skip keys which were served or moved to another lane
+            if pending is not None and pending[1] == lane:
+                break
+        del self._pending[key]
+        if self.key is not None:
+            self._active.add(key)
+        return pending[0]
+
+    def get_nowait(self):
+        """
+        Removes and returns the next item without waiting.
+
+        :raises: gevent.queue.Empty
+        """
+        return self.get(block=False)
+
+    def done(self, item):
+        """
+        Marks the work for an item as finished, releasing a parked item
+        with the same key.
+
+        :param item: The item returned by get().
+        """
+        if self.key is None:
+            return
+        key = self.key(item)
+        self._active.discard(key)
+        parked = self._parked.pop(key, None)
+        if parked is not None:
+            self._enqueue(key, parked[0], parked[1])
+        for callback in self._done_callbacks:
+            callback(item, parked is not None)
+
+    def add_done_callback(self, callback):
+        """
+        Registers a callable to run whenever done() is called.
+
+        :param callback: Called with the item and whether a parked item
+                         with the same key was queued again.
+        :type callback: callable
+        """
+        self._done_callbacks.append(callback)
+
+    def depth(self):
+        """
+        Returns the number of items waiting in each lane.
+
+        :returns: Lane name -> number of items.
+        :rtype: dict
+        """
+        return dict(self._counts)
+
+    def parked(self):
+        """
+        Returns the number of items waiting for their key to be done.
+
+        :rtype: int
+        """
+        return len(self._parked)
+
+    def qsize(self):
+        """
+        Returns the number of items waiting in all lanes.
+
+        :rtype: int
+        """
+        return len(self._pending)
+
+    def empty(self):
+        """
+        Checks if no items are waiting.
+
+        :rtype: bool
+        """
+        return self.qsize() == 0
+
+
+def investigation_key(item):
+    """
+    Returns the address an investigation queue item is for.
+
+    :param item: (host data, ssh_priv_key) tuple.
+    :type item: tuple
+    :returns: The address of the host.
+    :rtype: str
+    """
+    return item[0]['address']
+
 
 #: Input queue for the investigator thread(s)
-INVESTIGATE_QUEUE = Queue()
+INVESTIGATE_QUEUE = LaneQueue(key=investigation_key)
 
+#: Input queue for the node deregistration thread
+DEREGISTER_QUEUE = Queue()
 
-# ROUTER_QUEUE = Queue()
-# QUEUES = {
-#     "ALL": [Queue(), Queue()],
-#     "10.2.0.2": [Queue()],
-# }
+#: Host, cluster and operation changes for in-process consumers
+EVENT_BUS = EventBus()
@@ -39,70 +39,20 @@ from commissaire.handlers.clusters import (
     ClusterRestartResource, ClusterUpgradeResource)
 from commissaire.handlers.hosts import HostsResource, HostResource
 from commissaire.handlers.status import StatusResource
-from commissaire.queues import INVESTIGATE_QUEUE
-from commissaire.jobs import POOLS
+from commissaire.queues import (
+    DEREGISTER_QUEUE, EVENT_BUS, INVESTIGATE_QUEUE)
+from commissaire.jobs import POOLS, consumers
+from commissaire.jobs.deregister import deregister
 from commissaire.jobs.investigator import investigator
+from commissaire.jobs.reflector import reflector
+from commissaire.jobs.scheduler import scheduler
+from commissaire.membership import Membership
+from commissaire.transport.worker import (
+    WORKERS, RemoteWorkerPool, WorkerPool)
 from commissaire.authentication import httpauth
 from commissaire.middleware import JSONify
 
 
-# TODO: Move greenlet funcs to their own module
-
-
-'''
-def host_watcher(q, c):  # pragma: no cover
-    logger = logging.getLogger('watcher')
-    next_idx = None
-    logger.info('Starting watcher from latest index')
-    while True:
-        try:
-            change = c.watch('/testing/hosts/', index=next_idx, recursive=True)
-            logger.debug('Got change {0}'.format(change))
-            next_idx = change.etcd_index + 1
-            logger.debug('Last index: {0}. Next index: {1}'.format(
-                change.etcd_index, next_idx))
-            q.put(change)
-        except etcd.EtcdWatchTimedOut:
-            logger.debug('Etcd timeout. re-watching...')
-
-
-# TODO: multiprocess?
-def router(q):  # pragma: no cover
-    logger = logging.getLogger('router')
-    logger.info('Starting router')
-    while True:
-        sent_to = 0
-        change = q.get()
-        logger.debug('Got change {0}'.format(change))
-        for all_q in QUEUES['ALL']:
-            sent_to += 1
-            all_q.put(change)
-
-        logger.debug('Change for {0} is a "{1}"'.format(
-            change.etcd_index, change.action))
-        if change.action == 'delete':
-            address = json.loads(change._prev_node.value)['address']
-        else:
-            try:
-                data = json.loads(change.value)
-                address = data['address']
-            except TypeError:
-                logger.debug('Empty value. Setting to "{0}".')
-                data = {}
-
-        if address in QUEUES.keys():
-            for found_q in QUEUES[address]:
-                sent_to += 1
-                found_q.put(change)
-                logging.debug('Sent change for {0} to queue for {1}'.format(
-                    change.etcd_index, address))
-
-        logger.info('Sent change for {0} to {1} queues.'.format(
-            change.etcd_index, sent_to))
-
-'''
-
-
 def create_app(store):
     """
     Creates a new WSGI compliant commissaire application.
@@ -185,6 +135,22 @@ def main():  # pragma: no cover
     parser.add_argument(
         '--kube-uri', '-k', type=str, required=True,
         help='Full URI for kubernetes EX: http://127.0.0.1:8080')
+    parser.add_argument(
+        '--refresh-interval', type=int, default=3600,
+        help=('Seconds between fact refreshes of an active host. Failed '
+              'hosts are investigated again sooner. 0 disables'))
+    parser.add_argument(
+        '--refresh-rate', type=int, default=10,
+        help='Most hosts to queue for re-investigation per second')
+    parser.add_argument(
+        '--lease-ttl', type=int, default=30,
+        help='Seconds before jobs of an unresponsive worker are handed off')
+    parser.add_argument(
+        '--transport-workers', type=int, default=0,
+        help='Run transport operations in this many worker processes')
+    parser.add_argument(
+        '--transport-service', type=str,
+        help='Unix socket of a transport worker service to use')
     args = parser.parse_args()
 
     try:
@@ -212,6 +178,11 @@ def main():  # pragma: no cover
         parser.error('{0}\n'.format(err))
         raise SystemExit(1)
 
+    if args.transport_service:
+        WORKERS['pool'] = RemoteWorkerPool(args.transport_service)
+    elif args.transport_workers > 0:
+        WORKERS['pool'] = WorkerPool(args.transport_workers)
+
     interface = cli_etcd_or_default(
         'listeninterface', args.listen_interface, '0.0.0.0', ds)
     port = cli_etcd_or_default('listenport', args.listen_port, 8000, ds)
@@ -222,12 +193,26 @@ def main():  # pragma: no cover
         config.kubernetes['token'] = ds.get(
             '/commissaire/config/kubetoken').value
         logging.debug('Config: {0}'.format(config))
+        members = Membership(ds, ttl=args.lease_ttl)
+        members.register()
+        heartbeat_thread = gevent.spawn(members.heartbeat)
+        EVENT_BUS.start(ds)
         POOLS['investigator'].spawn(
             investigator, INVESTIGATE_QUEUE, config, ds)
+        reflector_thread = gevent.spawn(reflector, config, ds)
+        deregister_thread = gevent.spawn(
+            deregister, DEREGISTER_QUEUE, config, ds)
+        investigations_thread = gevent.spawn(
+            consumers.investigations, ds, INVESTIGATE_QUEUE, members=members)
+        operations_thread = gevent.spawn(
+            consumers.operations, ds, members=members)
+        if args.refresh_interval > 0:
+            gevent.spawn(
+                scheduler, INVESTIGATE_QUEUE, ds,
+                interval=args.refresh_interval, rate=args.refresh_rate,
+                members=members, events=EVENT_BUS)
     except etcd.EtcdKeyNotFound:
         parser.error('"/commissaire/config/kubetoken" must be set in etcd!')
-    # watch_thread = gevent.spawn(host_watcher, ROUTER_QUEUE, ds)
-    # router_thread = gevent.spawn(router, ROUTER_QUEUE)
 
     app = create_app(ds)
     try:
@@ -236,8 +221,15 @@ def main():  # pragma: no cover
         pass
 
     POOLS['investigator'].kill()
-    # watch_thread.kill()
-    # router_thread.kill()
+    reflector_thread.kill()
+    deregister_thread.kill()
+    investigations_thread.kill()
+    operations_thread.kill()
+    heartbeat_thread.kill()
+    EVENT_BUS.stop()
+    members.leave()
+    if isinstance(WORKERS['pool'], WorkerPool):
+        WORKERS['pool'].close()
 
 
 if __name__ == '__main__':  # pragma: no cover
@@ -16,14 +16,25 @@
 Ansible API transport.
 """
 
+import hashlib
 import jinja2
+import json
 import logging
 import os
+import shutil
+import sys
+import tarfile
 import tempfile
 
+import gevent
+
 from collections import namedtuple
+from jinja2 import meta
 from pkg_resources import resource_filename
 
+from gevent.event import AsyncResult
+from gevent.queue import Queue
+
 from ansible.parsing.dataloader import DataLoader
 from ansible.vars import VariableManager
 from ansible.inventory import Inventory, Host, Group
@@ -31,6 +42,8 @@ from ansible.playbook.play import Play
 from ansible.executor.task_queue_manager import TaskQueueManager
 from ansible.plugins.callback import CallbackBase
 
+from commissaire.transport.connections import ConnectionManager
+
 
 class LogForward(CallbackBase):
     """
@@ -51,6 +64,18 @@ class LogForward(CallbackBase):
         """
         super(LogForward, self).__init__()
         self.log = logging.getLogger('transport')
+        #: host name -> list of task results for the current play
+        self.results = {}
+
+    def _keep_result(self, result):
+        """
+        Keeps a task result for the host it ran on.
+
+        :param result: Ansible's result.
+        :type result: ansible.executor.task_result.TaskResult
+        """
+        self.results.setdefault(
+            result._host.get_name(), []).append(result._result)
 
     def v2_runner_on_failed(self, result, *args, **kwargs):
         """
@@ -63,6 +88,7 @@ class LogForward(CallbackBase):
         :param kwargs: All other ignored keyword arguments.
         :type kwargs: dict
         """
+        self._keep_result(result)
         if 'exception' in result._result.keys():
             self.log.warn(
                 'An exception occurred for {0}: {1}'.format(
@@ -77,6 +103,7 @@ class LogForward(CallbackBase):
         :type result: ansible.executor.task_result.TaskResult
         """
         self._clean_results(result._result, result._task.action)
+        self._keep_result(result)
         self.log.info('SUCCESS {0}: {1}'.format(
             result._host.get_name(), result._task.get_name().strip()))
         self.log.debug('{0}'.format(result.__dict__))
@@ -118,86 +145,405 @@ class LogForward(CallbackBase):
         self.log.debug('{0}'.format(task.__dict__))
 
 
-class Transport:
+class TemplateCache:
     """
-    Transport using Ansible.
+    Compiled bootstrap templates and their rendered output.
+
+    Templates are compiled once. Output which does not depend on host
+    variables is rendered once per set of variables it uses. Files are
+    written per operation, readable only by the owner, and removed once
+    the operation is done with them.
     """
 
-    def __init__(self):
+    #: Template variables which change from host to host
+    HOST_VARIABLES = ('bootstrap_ip',)
+
+    def __init__(self, template_dir=None):
         """
-        Creates an instance of the Transport.
+        Creates an instance of the TemplateCache.
+
+        :param template_dir: Directory holding the templates.
+        :type template_dir: str
         """
-        self.logger = logging.getLogger('transport')
-        self.Options = namedtuple(
-            'Options', ['connection', 'module_path', 'forks', 'remote_user',
-                        'private_key_file', 'ssh_common_args',
-                        'ssh_extra_args', 'sftp_extra_args', 'scp_extra_args',
-                        'become', 'become_method', 'become_user', 'verbosity',
-                        'check'])
-        # initialize needed objects
-        self.variable_manager = VariableManager()
-        self.loader = DataLoader()
-        self.passwords = {}
+        if template_dir is None:
+            template_dir = resource_filename('commissaire', 'data/templates/')
+        self.env = jinja2.Environment(
+            loader=jinja2.loaders.FileSystemLoader(template_dir),
+            cache_size=-1, auto_reload=False)
+        #: template name -> names of the variables it uses
+        self._variables = {}
+        #: (template name, variables digest) -> rendered output
+        self._rendered = {}
+
+    def variables(self, tpl_name):
+        """
+        Returns the names of the variables used by a template.
 
-    def _run(self, ip, key_file, play_source, expected_results=[0]):
+        :param tpl_name: The name of the template.
+        :type tpl_name: str
+        :returns: Sorted variable names.
+        :rtype: list
         """
-        Common code used for each run.
+        if tpl_name not in self._variables:
+            source = self.env.loader.get_source(self.env, tpl_name)[0]
+            self._variables[tpl_name] = sorted(
+                meta.find_undeclared_variables(self.env.parse(source)))
+        return self._variables[tpl_name]
 
-        :param ip: IP address to check.
-        :type ip: str
-        :param key_file: Full path the the file holding the private SSH key.
-        :type key_file: string
-        :param play_source: Ansible play.
-        :type play_source: dict
-        :param expected_results: List of expected return codes. Default: [0]
-        :type expected_results: list
-        :returns: Ansible exit code
-        :type: int
+    def is_host_specific(self, tpl_name):
+        """
+        Checks if a template uses any host variables.
+
+        :param tpl_name: The name of the template.
+        :type tpl_name: str
+        :returns: True if the output changes per host, otherwise False
+        :rtype: bool
+        """
+        for name in self.variables(tpl_name):
+            if name in self.HOST_VARIABLES:
+                return True
+        return False
+
+    def render(self, tpl_name, tpl_vars):
+        """
+        Renders a template, reusing host independent output.
+
+        :param tpl_name: The name of the template.
+        :type tpl_name: str
+        :param tpl_vars: Variables for the template.
+        :type tpl_vars: dict
+        :returns: The rendered template.
+        :rtype: str
+        """
+        if self.is_host_specific(tpl_name):
+            return self.env.get_template(tpl_name).render(tpl_vars)
+
+        used = [(name, tpl_vars.get(name)) for name in self.variables(
+            tpl_name)]
+        key = (tpl_name, hashlib.sha256(
+            json.dumps(used).encode('utf-8')).hexdigest())
+        if key not in self._rendered:
+            self._rendered[key] = self.env.get_template(
+                tpl_name).render(tpl_vars)
+        return self._rendered[key]
+
+    def render_files(self, tpl_names, tpl_vars):
         """
-        ssh_args = ('-o StrictHostKeyChecking=no -o '
-                    'ControlMaster=auto -o ControlPersist=60s')
-        options = self.Options(
+        Renders templates into files for one operation. The files are
+        only readable by the owner. Remove them with remove_files().
+
+        :param tpl_names: The names of the templates.
+        :type tpl_names: list
+        :param tpl_vars: Variables for the templates.
+        :type tpl_vars: dict
+        :returns: Template name -> full path to the rendered file.
+        :rtype: dict
+        """
+        # mkdtemp creates the directory accessible only by the owner
+        files_dir = tempfile.mkdtemp(prefix='commissaire-templates-')
+        configs = {}
+        for tpl_name in tpl_names:
+            path = os.path.join(files_dir, tpl_name)
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            try:
+                os.write(fd, self.render(tpl_name, tpl_vars).encode('utf-8'))
+            finally:
+                os.close(fd)
+            configs[tpl_name] = path
+        return configs
+
+    def remove_files(self, configs):
+        """
+        Removes the files written by render_files().
+
+        :param configs: The result of render_files().
+        :type configs: dict
+        """
+        for path in configs.values():
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+
+#: Process wide bootstrap template cache
+TEMPLATES = TemplateCache()
+
+
+#: Options passed to every TaskQueueManager
+Options = namedtuple(
+    'Options', ['connection', 'module_path', 'forks', 'remote_user',
+                'private_key_file', 'ssh_common_args',
+                'ssh_extra_args', 'sftp_extra_args', 'scp_extra_args',
+                'become', 'become_method', 'become_user', 'verbosity',
+                'check'])
+
+
+class Executor:
+    """
+    Long lived Ansible executor.
+
+    Plays are accepted through a queue and run one at a time against a
+    TaskQueueManager, DataLoader, VariableManager and Inventory which are
+    kept between plays. Facts and inventory entries for a host are evicted
+    as soon as its results are extracted. Everything is torn down and
+    created again after max_plays plays, or when more than max_cached_hosts
+    hosts are cached, so memory stays bounded.
+    """
+
+    def __init__(self, max_plays=100, connections=None, max_cached_hosts=100):
+        """
+        Creates an instance of the Executor.
+
+        :param max_plays: Number of plays to run before recycling.
+        :type max_plays: int
+        :param connections: SSH masters to use. Default: a new manager
+        :type connections: commissaire.transport.connections.ConnectionManager
+        :param max_cached_hosts: Number of cached hosts before recycling.
+        :type max_cached_hosts: int
+        """
+        self.logger = logging.getLogger('transport')
+        self.max_plays = max_plays
+        self.max_cached_hosts = max_cached_hosts
+        if connections is None:
+            connections = ConnectionManager()
+        self.connections = connections
+        ssh_args = self.connections.ssh_args
+        # The private key is set per host as ansible_ssh_private_key_file
+        self.options = Options(
             connection='ssh', module_path=None, forks=1,
-            remote_user='root', private_key_file=key_file,
+            remote_user='root', private_key_file=None,
             ssh_common_args=ssh_args, ssh_extra_args=ssh_args,
             sftp_extra_args=None, scp_extra_args=None,
             become=None, become_method=None, become_user=None,
             verbosity=None, check=False)
-        # create inventory and pass to var manager
-        inventory = Inventory(
+        self.passwords = {}
+        self.loader = DataLoader()
+        self.variable_manager = None
+        self.inventory = None
+        self.tqm = None
+        self.callback = LogForward()
+        self.plays_run = 0
+        self._queue = Queue()
+        self._worker = None
+        self._reset()
+
+    def _reset(self):
+        """
+        Creates fresh variable manager and inventory instances.
+        """
+        self.variable_manager = VariableManager()
+        self.inventory = Inventory(
             loader=self.loader,
             variable_manager=self.variable_manager,
-            host_list=ip)
-        # TODO: Fix this ... weird but works
-        group = Group(ip)
-        group.add_host(Host(ip, 22))
-        inventory.groups.update({ip: group})
-        # ---
+            host_list=[])
+        self.variable_manager.set_inventory(self.inventory)
+        self.plays_run = 0
+
+    def recycle(self):
+        """
+        Tears down the TaskQueueManager and drops all cached state.
+        """
+        self.logger.debug('Recycling the executor after {0} plays.'.format(
+            self.plays_run))
+        if self.tqm is not None:
+            self.tqm.cleanup()
+            self.tqm = None
+        self._reset()
+
+    def _add_host(self, ip, key_file):
+        """
+        Makes sure a host is in the inventory using the given key.
+
+        :param ip: IP address of the host.
+        :type ip: str
+        :param key_file: Full path the the file holding the private SSH key.
+        :type key_file: str
+        :returns: The host in the inventory.
+        :rtype: ansible.inventory.Host
+        """
+        group = self.inventory.groups.get(ip)
+        if group is None:
+            # TODO: Fix this ... weird but works
+            group = Group(ip)
+            group.add_host(Host(ip, 22))
+            self.inventory.groups.update({ip: group})
+            self.inventory.clear_pattern_cache()
+            # ---
+        host = group.get_hosts()[0]
+        host.set_variable('ansible_ssh_private_key_file', key_file)
+        return host
+
+    def cached_hosts(self):
+        """
+        Returns the number of hosts with cached facts.
+
+        :returns: The number of hosts.
+        :rtype: int
+        """
+        return len(self.variable_manager._fact_cache)
+
+    def _evict(self, ip):
+        """
+        Drops all facts, variables and inventory entries for a host.
 
-        self.variable_manager.set_inventory(inventory)
+        :param ip: IP address of the host.
+        :type ip: str
+        """
+        self.variable_manager._fact_cache.pop(ip, None)
+        for name in ('_nonpersistent_fact_cache', '_vars_cache'):
+            getattr(self.variable_manager, name, {}).pop(ip, None)
+        self.inventory.groups.pop(ip, None)
+        for name in ('_hosts_cache', '_vars_per_host'):
+            getattr(self.inventory, name, {}).pop(ip, None)
+        self.inventory.clear_pattern_cache()
+
+    def _execute(self, ip, key_file, play_source):
+        """
+        Runs a single play.
+
+        :param ip: IP address to run against.
+        :type ip: str
+        :param key_file: Full path the the file holding the private SSH key.
+        :type key_file: str
+        :param play_source: Ansible play.
+        :type play_source: dict
+        :returns: tuple -- (exitcode(int), facts(dict), results(list)).
+        """
+        if (self.plays_run >= self.max_plays or
+                self.cached_hosts() >= self.max_cached_hosts):
+            self.recycle()
+        self._add_host(ip, key_file)
         play = Play().load(
             play_source,
             variable_manager=self.variable_manager,
             loader=self.loader)
-        # actually run it
-        tqm = None
-        try:
-            tqm = TaskQueueManager(
-                inventory=inventory,
+
+        if self.tqm is None:
+            self.tqm = TaskQueueManager(
+                inventory=self.inventory,
                 variable_manager=self.variable_manager,
                 loader=self.loader,
-                options=options,
+                options=self.options,
                 passwords=self.passwords,
-                stdout_callback=LogForward(),
+                stdout_callback=self.callback,
             )
-            result = tqm.run(play)
+        self.callback.results = {}
+        self.plays_run += 1
+        try:
+            result = self.tqm.run(play)
+            if result != 0:
+                # Failed and unreachable hosts are remembered by the
+                # TaskQueueManager and would be skipped in later plays
+                self.tqm.cleanup()
+                self.tqm = None
+            # Copy out what the caller needs before the host is evicted
+            facts = dict(self.variable_manager._fact_cache.get(ip, {}))
+            results = self.callback.results.pop(ip, [])
         finally:
-            if tqm is not None:
-                tqm.cleanup()
+            self._evict(ip)
+        return (result, facts, results)
+
+    def _work(self):
+        """
+        Pulls plays off of the queue and runs them until the queue is empty.
+        """
+        while not self._queue.empty():
+            ip, key_file, play_source, async_result = self._queue.get()
+            try:
+                async_result.set(self._execute(ip, key_file, play_source))
+            except:
+                _, exc_msg, _ = sys.exc_info()
+                self.logger.warn(
+                    'Play for {0} raised {1}. Recycling.'.format(ip, exc_msg))
+                self.recycle()
+                async_result.set_exception(exc_msg)
+        self._worker = None
+
+    def run(self, ip, key_file, play_source):
+        """
+        Queues a play and waits for the result.
+
+        :param ip: IP address to run against.
+        :type ip: str
+        :param key_file: Full path the the file holding the private SSH key.
+        :type key_file: str
+        :param play_source: Ansible play.
+        :type play_source: dict
+        :returns: tuple -- (exitcode(int), facts(dict), results(list)).
+        """
+        async_result = AsyncResult()
+        self._queue.put((ip, key_file, play_source, async_result))
+        if self._worker is None:
+            self._worker = gevent.spawn(self._work)
+        return async_result.get()
+
+
+class Transport:
+    """
+    Transport using Ansible.
+    """
+
+    #: Fact subsets gathered by get_info() when fast is requested. The
+    #: minimal facts are always gathered. Ansible drops exclusions such as
+    #: !all after adding the requested subsets, so none are used here.
+    FAST_GATHER_SUBSET = 'hardware'
+    #: Suffix of bundled configs until they are moved into place
+    BUNDLE_SUFFIX = '.commissaire-new'
+
+    def __init__(self, executor=None):
+        """
+        Creates an instance of the Transport.
+
+        :param executor: Executor to run plays with. Default: a new Executor
+        :type executor: commissaire.transport.ansibleapi.Executor
+        """
+        self.logger = logging.getLogger('transport')
+        if executor is None:
+            executor = Executor()
+        self.executor = executor
+
+    @property
+    def variable_manager(self):
+        """
+        The VariableManager currently used by the executor.
+        """
+        return self.executor.variable_manager
+
+    def prewarm(self, hosts):
+        """
+        Opens SSH masters for hosts ahead of running plays on them.
+
+        :param hosts: List of (ip, key_file) tuples.
+        :type hosts: list
+        :returns: The IP addresses which have a live master.
+        :rtype: list
+        """
+        return self.executor.connections.prewarm(hosts)
+
+    def recycle(self):
+        """
+        Drops all cached Ansible state held by this transport.
+        """
+        self.executor.recycle()
+
+    def _run(self, ip, key_file, play_source, expected_results=[0]):
+        """
+        Common code used for each run.
+
+        :param ip: IP address to check.
+        :type ip: str
+        :param key_file: Full path the the file holding the private SSH key.
+        :type key_file: string
+        :param play_source: Ansible play.
+        :type play_source: dict
+        :param expected_results: List of expected return codes. Default: [0]
+        :type expected_results: list
+        :returns: Ansible exit code
+        :type: int
+        """
+        result, fact_cache, task_results = self.executor.run(
+            ip, key_file, play_source)
 
         if result in expected_results:
             self.logger.debug('{0}: Good result {1}'.format(ip, result))
-            fact_cache = self.variable_manager._fact_cache.get(ip, {})
             return (result, fact_cache)
 
         # TODO: Do something :-)
@@ -256,7 +602,7 @@ class Transport:
         }
         return self._run(ip, key_file, play_source, [0, 2])
 
-    def get_info(self, ip, key_file):
+    def get_info(self, ip, key_file, fast=False):
         """
         Get's information from the host via ansible.
 
@@ -264,6 +610,8 @@ class Transport:
         :type ip: str
         :param key_file: Full path the the file holding the private SSH key.
         :type key_file: str
+        :param fast: If only the facts commissaire uses should be gathered.
+        :type fast: bool
         :returns: tuple -- (exitcode(int), facts(dict)).
         """
         # create play with tasks
@@ -274,6 +622,10 @@ class Transport:
             'tasks': []
 
         }
+        if fast:
+            # Everything we pull out below lives in the minimal and
+            # hardware subsets, so skip network, virtual, facter, etc.
+            play_source['gather_subset'] = self.FAST_GATHER_SUBSET
         result, fact_cache = self._run(ip, key_file, play_source)
         facts = {}
         facts['os'] = fact_cache['ansible_distribution'].lower()
@@ -297,6 +649,294 @@ class Transport:
 
         return (result, facts)
 
+    def _command_task(self, name, command, oscmd):
+        """
+        Builds a command task unless the command is a no-op for the OS.
+
+        :param name: The name of the task.
+        :type name: str
+        :param command: The command to execute as a list.
+        :type command: list
+        :param oscmd: OSCmd instance the command came from.
+        :type oscmd: commissaire.oscmd.OSCmdBase
+        :returns: The task or None if it should be skipped.
+        :rtype: dict or None
+        """
+        if oscmd.is_noop(command):
+            self.logger.debug('Skipping no-op task "{0}" for {1}'.format(
+                name, oscmd.os_type))
+            return None
+        return {
+            'name': name,
+            'action': {
+                'module': 'command',
+                'args': " ".join(command),
+            }
+        }
+
+    def _sync_task(self, name, src, dest):
+        """
+        Builds a task which synchronizes a file to the host.
+
+        :param name: The name of the task.
+        :type name: str
+        :param src: Full local path of the file.
+        :type src: str
+        :param dest: Full remote path of the file.
+        :type dest: str
+        :returns: The task.
+        :rtype: dict
+        """
+        return {
+            'name': name,
+            'action': {
+                'module': 'synchronize',
+                'args': {
+                    'dest': dest,
+                    'src': src,
+                }
+            }
+        }
+
+    def _service_task(self, name, service):
+        """
+        Builds a task which enables and starts a service.
+
+        :param name: The name of the task.
+        :type name: str
+        :param service: The name of the service.
+        :type service: str
+        :returns: The task.
+        :rtype: dict
+        """
+        return {
+            'name': name,
+            'action': {
+                'module': 'service',
+                'args': {
+                    'name': service,
+                    'enabled': 'yes',
+                    'state': 'started',
+                }
+            }
+        }
+
+    def _check_bootstrap(self, ip, key_file, oscmd):
+        """
+        Reads the bootstrap related state of a host in one round trip.
+
+        :param ip: IP address to check.
+        :type ip: str
+        :param key_file: Full path the the file holding the private SSH key.
+        :type key_file: str
+        :param oscmd: OSCmd instance to use
+        :type oscmd: commissaire.oscmd.OSCmdBase
+        :returns: The state of the host or None if it is unknown.
+        :rtype: dict or None
+        """
+        files = (
+            oscmd.flanneld_config, oscmd.docker_config,
+            oscmd.kubernetes_config, oscmd.kubernetes_kubeconfig,
+            oscmd.kubelet_config)
+        packages = (
+            oscmd.flannel_package, oscmd.docker_package, oscmd.kube_package)
+        services = (
+            oscmd.flannel_service, oscmd.docker_service,
+            oscmd.kubelet_service, oscmd.kubelet_proxy_service)
+        script = '; '.join((
+            'echo "#files"',
+            'sha256sum {0} 2>/dev/null'.format(
+                ' '.join([str(x) for x in files])),
+            'echo "#packages"',
+            "rpm -q --qf '%{{NAME}}\\n' {0} 2>/dev/null".format(
+                ' '.join([str(x) for x in packages])),
+            'echo "#services"',
+            ('for s in {0}; do echo "$s $(systemctl is-active $s)'
+             ' $(systemctl is-enabled $s)"; done').format(
+                 ' '.join([str(x) for x in services])),
+            'true'))
+        play_source = {
+            'name': 'bootstrap check',
+            'hosts': ip,
+            'gather_facts': 'no',
+            'tasks': [{
+                'name': 'Check bootstrap state',
+                'action': {
+                    'module': 'shell',
+                    'args': script,
+                }
+            }]
+        }
+        try:
+            result, facts, task_results = self.executor.run(
+                ip, key_file, play_source)
+            stdout = task_results[0]['stdout']
+        except:
+            _, exc_msg, _ = sys.exc_info()
+            self.logger.warn(
+                'Unable to check the bootstrap state of {0}: {1}'.format(
+                    ip, exc_msg))
+            return None
+
+        state = {'files': {}, 'packages': [], 'services': {}}
+        section = None
+        for line in stdout.splitlines():
+            if line.startswith('#'):
+                section = line[1:]
+                continue
+            parts = line.split()
+            if section == 'files' and len(parts) == 2:
+                state['files'][parts[1]] = parts[0]
+            elif section == 'packages' and len(parts) == 1:
+                state['packages'].append(parts[0])
+            elif section == 'services' and parts:
+                state['services'][parts[0]] = parts[1:]
+        if section != 'services':
+            self.logger.warn(
+                'Incomplete bootstrap state for {0}: {1}'.format(ip, stdout))
+            return None
+        self.logger.debug('Bootstrap state for {0}: {1}'.format(ip, state))
+        return state
+
+    def _mkarchive(self):
+        """
+        Creates an empty local file for a config bundle.
+
+        :returns: Full path to the file.
+        :rtype: str
+        """
+        fd, archive = tempfile.mkstemp(
+            prefix='commissaire-bootstrap-', suffix='.tar')
+        os.close(fd)
+        return archive
+
+    def _bundle_configs(self, archive, files):
+        """
+        Packs rendered configs into one archive. Each file is stored next
+        to its destination with a temporary suffix so it can be moved into
+        place atomically once unpacked.
+
+        :param archive: Full local path of the archive to write.
+        :type archive: str
+        :param files: List of (full local path, full remote path, mode)
+                      tuples.
+        :type files: list
+        :returns: The command which unpacks the archive on the host.
+        :rtype: str
+        """
+        remote_archive = '/tmp/{0}'.format(os.path.basename(archive))
+        tar = tarfile.open(archive, 'w')
+        try:
+            for src, dest, mode in files:
+                info = tar.gettarinfo(
+                    src, (dest + self.BUNDLE_SUFFIX).lstrip('/'))
+                info.mode = mode
+                info.uid = info.gid = 0
+                info.uname = info.gname = 'root'
+                with open(src, 'rb') as f:
+                    tar.addfile(info, f)
+        finally:
+            tar.close()
+
+        moves = ['mv -f {0}{1} {0}'.format(dest, self.BUNDLE_SUFFIX)
+                 for src, dest, mode in files]
+        return '{0}; rc=$?; rm -f {1}; exit $rc'.format(
+            ' && '.join(
+                ['tar -xpf {0} -C /'.format(remote_archive)] + moves),
+            remote_archive)
+
+    def _bootstrap_tasks(self, oscmd, configs, state=None, archive=None):
+        """
+        Builds the tasks for the bootstrap play. When the state of the
+        host is known only the steps which differ from it are included.
+
+        :param oscmd: OSCmd instance to use
+        :type oscmd: commissaire.oscmd.OSCmdBase
+        :param configs: Template name -> full path to the rendered file.
+        :type configs: dict
+        :param state: The state from _check_bootstrap().
+        :type state: dict or None
+        :param archive: Full local path to bundle changed configs into.
+        :type archive: str
+        :returns: The tasks.
+        :rtype: list
+        """
+        def installed(*packages):
+            if state is None:
+                return False
+            for package in packages:
+                if package not in state['packages']:
+                    return False
+            return True
+
+        def converged(tpl_name, dest):
+            if state is None:
+                return False
+            with open(configs[tpl_name], 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            return state['files'].get(dest) == digest
+
+        def service(name, service_name):
+            if state is not None and state['services'].get(
+                    service_name) == ['active', 'enabled']:
+                return None
+            return self._service_task(name, service_name)
+
+        tasks = []
+        install_packages = oscmd.install_packages()
+        if install_packages is not None:
+            # One package transaction instead of one per component
+            if not installed(
+                    oscmd.flannel_package, oscmd.docker_package,
+                    oscmd.kube_package):
+                tasks.append(self._command_task(
+                    'Install Packages', install_packages, oscmd))
+        else:
+            if not installed(oscmd.flannel_package):
+                tasks.append(self._command_task(
+                    'Install Flannel', oscmd.install_flannel(), oscmd))
+            if not installed(oscmd.docker_package):
+                tasks.append(self._command_task(
+                    'Install Docker', oscmd.install_docker(), oscmd))
+            if not installed(oscmd.kube_package):
+                tasks.append(self._command_task(
+                    'Install Kubernetes Node', oscmd.install_kube(), oscmd))
+
+        # All changed configs go over in a single transfer. The kubeconfig
+        # carries the bearer token so only root may read it.
+        files = []
+        for tpl_name, dest, mode in (
+                ('flanneld', oscmd.flanneld_config, 0o644),
+                ('docker', oscmd.docker_config, 0o644),
+                ('kube_config', oscmd.kubernetes_config, 0o644),
+                ('kubeconfig', oscmd.kubernetes_kubeconfig, 0o600),
+                ('kubelet', oscmd.kubelet_config, 0o644)):
+            if not converged(tpl_name, dest):
+                files.append((configs[tpl_name], dest, mode))
+        if files:
+            if archive is None:
+                archive = self._mkarchive()
+            unpack = self._bundle_configs(archive, files)
+            tasks.append(self._sync_task(
+                'Transfer Configuration', archive,
+                '/tmp/{0}'.format(os.path.basename(archive))))
+            tasks.append({
+                'name': 'Install Configuration',
+                'action': {
+                    'module': 'shell',
+                    'args': unpack,
+                }
+            })
+
+        tasks += [
+            service('Enable and Start Flannel', oscmd.flannel_service),
+            service('Enable and Start Docker', oscmd.docker_service),
+            service('Enable and Start Kubelet', oscmd.kubelet_service),
+            service(
+                'Enable and Start Kube Proxy', oscmd.kubelet_proxy_service),
+        ]
+        return [task for task in tasks if task is not None]
+
     def bootstrap(self, ip, key_file, config, oscmd):
         """
         Bootstraps a host via ansible.
@@ -318,8 +958,6 @@ class Transport:
         # TODO: I'd love to use ansibles "template" but it, as well as copy
         # always fails when used in tasks in 2.0.0.2.
         # Fill out templates
-        tpl_loader = jinja2.loaders.FileSystemLoader(
-            resource_filename('commissaire', 'data/templates/'))
         tpl_vars = {
             'bootstrap_ip': ip,
             'kubernetes_api_server_host': config.kubernetes['uri'].hostname,
@@ -331,143 +969,30 @@ class Transport:
             'etcd_port': config.etcd['uri'].port,
             'flannel_key': '/atomic01/network'  # TODO: Where do we get this?
         }
-        tpl_env = jinja2.Environment()
-        configs = {}
-        for tpl_name in (
-                'docker', 'flanneld', 'kubelet', 'kube_config', 'kubeconfig'):
-            f = tempfile.NamedTemporaryFile(prefix=tpl_name, delete=False)
-            f.write(tpl_loader.load(tpl_env, tpl_name).render(tpl_vars))
-            f.close()
-            configs[tpl_name] = f.name
+        configs = TEMPLATES.render_files(
+            ('docker', 'flanneld', 'kubelet', 'kube_config', 'kubeconfig'),
+            tpl_vars)
 
         # ---
 
-        play_source = {
-            'name': 'bootstrap',
-            'hosts': ip,
-            'gather_facts': 'no',
-            'tasks': [
-                {
-                    'name': 'Install Flannel',
-                    'action': {
-                        'module': 'command',
-                        'args': " ".join(oscmd.install_flannel()),
-                    }
-                },
-                {
-                    'name': 'Configure Flannel',
-                    'action': {
-                        'module': 'synchronize',
-                        'args': {
-                            'dest': oscmd.flanneld_config,
-                            'src': configs['flanneld'],
-                        }
-                    }
-                },
-                {
-                    'name': 'Enable and Start Flannel',
-                    'action': {
-                        'module': 'service',
-                        'args': {
-                            'name': oscmd.flannel_service,
-                            'enabled': 'yes',
-                            'state': 'started',
-                        }
-                    }
-                },
-                {
-                    'name': 'Install Docker',
-                    'action': {
-                        'module': 'command',
-                        'args': " ".join(oscmd.install_docker()),
-                    }
-                },
-                {
-                    'name': 'Configure Docker',
-                    'action': {
-                        'module': 'synchronize',
-                        'args': {
-                            'dest': oscmd.docker_config,
-                            'src': configs['docker'],
-                        }
-                    }
-                },
-                {
-                    'name': 'Enable and Start Docker',
-                    'action': {
-                        'module': 'service',
-                        'args': {
-                            'name': oscmd.docker_service,
-                            'enabled': 'yes',
-                            'state': 'started',
-                        }
-                    }
-                },
-                {
-                    'name': 'Install Kubernetes Node',
-                    'action': {
-                        'module': 'command',
-                        'args': " ".join(oscmd.install_kube()),
-                    }
-                },
-                {
-                    'name': 'Configure Kubernetes Node',
-                    'action': {
-                        'module': 'synchronize',
-                        'args': {
-                            'dest': oscmd.kubernetes_config,
-                            'src': configs['kube_config'],
-                        }
-                    }
-                },
-                {
-                    'name': 'Add Kubernetes kubeconfig',
-                    'action': {
-                        'module': 'synchronize',
-                        'args': {
-                            'dest': oscmd.kubernetes_kubeconfig,
-                            'src': configs['kubeconfig'],
-                        }
-                    }
-                },
-                {
-                    'name': 'Configure Kubernetes kubelet',
-                    'action': {
-                        'module': 'synchronize',
-                        'args': {
-                            'dest': oscmd.kubelet_config,
-                            'src': configs['kubelet'],
-                        }
-                    }
-                },
-                {
-                    'name': 'Enable and Start Kubelet',
-                    'action': {
-                        'module': 'service',
-                        'args': {
-                            'name': oscmd.kubelet_service,
-                            'enabled': 'yes',
-                            'state': 'started',
-                        }
-                    }
-                },
-                {
-                    'name': 'Enable and Start Kube Proxy',
-                    'action': {
-                        'module': 'service',
-                        'args': {
-                            'name': oscmd.kubelet_proxy_service,
-                            'enabled': 'yes',
-                            'state': 'started',
-                        }
-                    }
-                },
-            ]
-        }
-
-        results = self._run(ip, key_file, play_source, [0])
-
-        # Clean out the temporary configs
-        map(os.unlink, configs.values())
+        archive = self._mkarchive()
+        try:
+            state = self._check_bootstrap(ip, key_file, oscmd)
+            tasks = self._bootstrap_tasks(oscmd, configs, state, archive)
+            if not tasks:
+                self.logger.info(
+                    '{0} is already bootstrapped. Nothing to do.'.format(ip))
+                return (0, {})
+
+            play_source = {
+                'name': 'bootstrap',
+                'hosts': ip,
+                'gather_facts': 'no',
+                'tasks': tasks,
+            }
+            results = self._run(ip, key_file, play_source, [0])
+        finally:
+            os.unlink(archive)
+            TEMPLATES.remove_files(configs)
 
         return results
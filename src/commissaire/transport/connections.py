@@ -0,0 +1,244 @@
+# Copyright (C) 2016  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+SSH ControlMaster connection management.
+"""
+
+import atexit
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+from gevent import subprocess
+from gevent.pool import Pool
+
+
+#: Names the control directory for processes started by its creator
+CONTROL_DIR_ENV = 'COMMISSAIRE_SSH_CONTROL_DIR'
+
+#: Control directory shared by every ConnectionManager in the process
+CONTROL_DIR = {
+    'path': None,
+}
+
+
+def shared_control_dir():
+    """
+    Returns the shared control directory, creating it on first use. Worker
+    processes started afterwards inherit it through CONTROL_DIR_ENV, so a
+    master opened by any of them is used by all. The creating process
+    removes it on exit.
+
+    :returns: Full path to the control directory.
+    :rtype: str
+    """
+    if CONTROL_DIR['path'] is None:
+        path = os.environ.get(CONTROL_DIR_ENV)
+        if path is None:
+            path = tempfile.mkdtemp(prefix='commissaire-ssh-')
+            os.environ[CONTROL_DIR_ENV] = path
+            atexit.register(remove_control_dir, path)
+        CONTROL_DIR['path'] = path
+    return CONTROL_DIR['path']
+
+
+def remove_control_dir(path):
+    """
+    Stops the masters in a control directory and removes it.
+
+    :param path: Full path to the control directory.
+    :type path: str
+    """
+    try:
+        ConnectionManager(path).close_all()
+    except Exception:
+        _, exc_msg, _ = sys.exc_info()
+        logging.getLogger('transport').warn(
+            'Unable to stop SSH masters in {0}: {1}'.format(path, exc_msg))
+    shutil.rmtree(path, ignore_errors=True)
+
+
+class ConnectionManager:
+    """
+    Owns a directory of SSH ControlMaster sockets and the masters behind them.
+    """
+
+    def __init__(self, control_dir=None, persist='10m', user='root',
+                 port=22, concurrency=10):
+        """
+        Creates an instance of the ConnectionManager.
+
+        :param control_dir: Directory for control sockets. Default: shared
+        :type control_dir: str
+        :param persist: How long idle masters stay open (ControlPersist).
+        :type persist: str
+        :param user: The remote user to connect as.
+        :type user: str
+        :param port: The remote SSH port.
+        :type port: int
+        :param concurrency: Number of masters to open at the same time.
+        :type concurrency: int
+        """
+        self.logger = logging.getLogger('transport')
+        if control_dir is None:
+            control_dir = shared_control_dir()
+        self.control_dir = control_dir
+        self.persist = persist
+        self.user = user
+        self.port = port
+        self.concurrency = concurrency
+
+    @property
+    def ssh_args(self):
+        """
+        SSH arguments which share the sockets owned by this manager.
+        """
+        return ('-o StrictHostKeyChecking=no -o ControlMaster=auto '
+                '-o ControlPersist={0} -o ControlPath={1}'.format(
+                    self.persist,
+                    os.path.join(self.control_dir, '%r@%h:%p')))
+
+    def control_path(self, ip):
+        """
+        Returns the control socket path for a host.
+
+        :param ip: IP address of the host.
+        :type ip: str
+        :returns: Full path to the control socket.
+        :rtype: str
+        """
+        return os.path.join(self.control_dir, '{0}@{1}:{2}'.format(
+            self.user, ip, self.port))
+
+    def _ssh(self, ip, *args):
+        """
+        Builds an ssh command for a host using this manager's socket.
+
+        :param ip: IP address of the host.
+        :type ip: str
+        :param args: Extra ssh arguments.
+        :type args: tuple
+        :returns: The command as a list.
+        :rtype: list
+        """
+        command = [
+            'ssh', '-o', 'StrictHostKeyChecking=no',
+            '-o', 'BatchMode=yes',
+            '-o', 'ControlPath={0}'.format(self.control_path(ip)),
+            '-p', str(self.port), '-l', self.user]
+        command.extend(args)
+        command.append(ip)
+        return command
+
+    def _call(self, command):
+        """
+        Runs a command without blocking other greenlets.
+
+        :param command: The command to run.
+        :type command: list
+        :returns: The exit code.
+        :rtype: int
+        """
+        self.logger.debug('Executing {0}'.format(command))
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call(
+                command, stdin=devnull, stdout=devnull, stderr=devnull)
+
+    def is_alive(self, ip):
+        """
+        Checks if a host has a live master.
+
+        :param ip: IP address of the host.
+        :type ip: str
+        :returns: True if a live master exists, otherwise False
+        :rtype: bool
+        """
+        if not os.path.exists(self.control_path(ip)):
+            return False
+        return self._call(self._ssh(ip, '-O', 'check')) == 0
+
+    def live_hosts(self):
+        """
+        Returns the hosts which currently have a live master.
+
+        :returns: List of IP addresses.
+        :rtype: list
+        """
+        hosts = []
+        for name in os.listdir(self.control_dir):
+            try:
+                ip = name.split('@', 1)[1].rsplit(':', 1)[0]
+            except IndexError:
+                continue
+            if self.is_alive(ip):
+                hosts.append(ip)
+        return hosts
+
+    def open(self, ip, key_file):
+        """
+        Opens a master for a host if one is not already running.
+
+        :param ip: IP address of the host.
+        :type ip: str
+        :param key_file: Full path the the file holding the private SSH key.
+        :type key_file: str
+        :returns: True if a master is running, otherwise False
+        :rtype: bool
+        """
+        if self.is_alive(ip):
+            return True
+        result = self._call(self._ssh(
+            ip, '-i', key_file, '-f', '-N',
+            '-o', 'ControlMaster=yes',
+            '-o', 'ControlPersist={0}'.format(self.persist)))
+        if result != 0:
+            self.logger.warn(
+                'Unable to open an SSH master for {0}: {1}'.format(
+                    ip, result))
+            return False
+        self.logger.debug('Opened an SSH master for {0}'.format(ip))
+        return True
+
+    def prewarm(self, hosts):
+        """
+        Opens masters for many hosts in parallel.
+
+        :param hosts: List of (ip, key_file) tuples.
+        :type hosts: list
+        :returns: The IP addresses which have a live master.
+        :rtype: list
+        """
+        pool = Pool(self.concurrency)
+        results = pool.map(lambda host: (host[0], self.open(*host)), hosts)
+        return [ip for ip, alive in results if alive]
+
+    def close(self, ip):
+        """
+        Stops the master for a host.
+
+        :param ip: IP address of the host.
+        :type ip: str
+        """
+        if os.path.exists(self.control_path(ip)):
+            self._call(self._ssh(ip, '-O', 'exit'))
+
+    def close_all(self):
+        """
+        Stops all masters owned by this manager.
+        """
+        for ip in self.live_hosts():
+            self.close(ip)
@@ -0,0 +1,126 @@
+# Copyright (C) 2016  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+SSH private key handling.
+"""
+
+import hashlib
+import logging
+import os
+import sys
+import tempfile
+
+from commissaire.compat.b64 import base64
+
+
+#: Memory backed directory used for keys when available
+TMPFS_DIR = '/dev/shm'
+
+
+class KeyProvider:
+    """
+    Hands out reference counted key files for base64 encoded private keys.
+
+    Each unique key is decoded and written once, preferably to tmpfs, and
+    the file is shared by every caller using that key. The file is removed
+    when the last reference is released.
+    """
+
+    def __init__(self, key_dir=None):
+        """
+        Creates an instance of the KeyProvider.
+
+        :param key_dir: Directory to hold key files. Default: new tmpdir
+                        created when the first key is acquired
+        :type key_dir: str
+        """
+        self.logger = logging.getLogger('transport')
+        self.key_dir = key_dir
+        #: digest -> [key_file, references]
+        self._keys = {}
+        #: key_file -> digest
+        self._files = {}
+
+    def acquire(self, ssh_priv_key):
+        """
+        Returns a key file for the key, writing it only if needed.
+
+        :param ssh_priv_key: The base64 encoded private key.
+        :type ssh_priv_key: str
+        :returns: Full path to the file holding the private key.
+        :rtype: str
+        """
+        encoded = ssh_priv_key.encode('ascii')
+        digest = hashlib.sha256(encoded).hexdigest()
+        if digest in self._keys:
+            self._keys[digest][1] += 1
+            return self._keys[digest][0]
+
+        if self.key_dir is None:
+            parent = None
+            if os.path.isdir(TMPFS_DIR) and os.access(TMPFS_DIR, os.W_OK):
+                parent = TMPFS_DIR
+            self.key_dir = tempfile.mkdtemp(
+                prefix='commissaire-keys-', dir=parent)
+        key_file = os.path.join(self.key_dir, digest)
+        fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.write(fd, base64.decodebytes(encoded))
+        finally:
+            os.close(fd)
+        self.logger.debug('Wrote key file {0}'.format(key_file))
+        self._keys[digest] = [key_file, 1]
+        self._files[key_file] = digest
+        return key_file
+
+    def release(self, key_file):
+        """
+        Releases a reference to a key file, removing it if unused.
+
+        :param key_file: Full path to the key file.
+        :type key_file: str
+        """
+        digest = self._files.get(key_file)
+        if digest is None:
+            self.logger.warn(
+                'Release of unknown key file {0}'.format(key_file))
+            return
+        self._keys[digest][1] -= 1
+        if self._keys[digest][1] > 0:
+            return
+
+        del self._keys[digest]
+        del self._files[key_file]
+        try:
+            os.unlink(key_file)
+            self.logger.debug('Removed key file {0}'.format(key_file))
+        except:
+            _, exc_msg, _ = sys.exc_info()
+            self.logger.warn(
+                'Unable to remove the key file: '
+                '{0}. Exception:{1}'.format(key_file, exc_msg))
+
+    def in_use(self):
+        """
+        Returns the number of key files currently on disk.
+
+        :returns: The number of key files.
+        :rtype: int
+        """
+        return len(self._keys)
+
+
+#: Process wide key provider
+KEYS = KeyProvider()
@@ -0,0 +1,413 @@
+# Copyright (C) 2016  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Process isolated transport workers.
+
+Ansible forks and blocks while a play runs. Running it inside the API
+process stalls every other greenlet, so transport operations can instead
+be sent to worker processes as newline delimited JSON over pipes. The
+API process waits on the pipes cooperatively. The workers may also live
+in a separate host local service reached through a unix socket.
+"""
+
+import json
+import logging
+import os
+import socket as _socket
+import sys
+
+from gevent import socket, subprocess
+from gevent.queue import Queue
+from gevent.server import StreamServer
+
+from commissaire.compat.urlparser import urlparse
+from commissaire.config import Config
+from commissaire.oscmd import get_oscmd
+from commissaire.transport import ansibleapi, connections
+
+
+#: Worker pool used by get_transport(). None means run in process.
+WORKERS = {
+    'pool': None,
+}
+
+#: Transport methods which may be called in a worker
+METHODS = ('get_info', 'bootstrap', 'upgrade', 'restart', 'prewarm')
+
+
+def config_to_dict(config):
+    """
+    Returns the parts of a Config needed by the transport.
+
+    :param config: Configuration information.
+    :type config: commissaire.config.Config
+    :returns: A JSON serializable structure.
+    :rtype: dict
+    """
+    return {
+        'etcd': {
+            'uri': config.etcd['uri'].geturl(),
+        },
+        'kubernetes': {
+            'uri': config.kubernetes['uri'].geturl(),
+            'token': config.kubernetes['token'],
+        },
+    }
+
+
+def config_from_dict(data):
+    """
+    Creates a Config from the result of config_to_dict().
+
+    :param data: The structure from config_to_dict().
+    :type data: dict
+    :returns: Configuration information.
+    :rtype: commissaire.config.Config
+    """
+    return Config(
+        etcd={
+            'uri': urlparse(data['etcd']['uri']),
+        },
+        kubernetes={
+            'uri': urlparse(data['kubernetes']['uri']),
+            'token': data['kubernetes']['token'],
+        })
+
+
+def handle(transport, request):
+    """
+    Runs a single transport request.
+
+    :param transport: The transport to run the request with.
+    :type transport: commissaire.transport.ansibleapi.Transport
+    :param request: The request.
+    :type request: dict
+    :returns: The response.
+    :rtype: dict
+    """
+    method = request.get('method')
+    if method not in METHODS:
+        return {'error': 'Unknown transport method {0}'.format(method)}
+    args = list(request.get('args', []))
+    try:
+        if method == 'bootstrap':
+            args[2] = config_from_dict(args[2])
+            args[3] = get_oscmd(args[3])()
+        elif method in ('upgrade', 'restart'):
+            args[2] = get_oscmd(args[2])()
+        result = getattr(transport, method)(
+            *args, **request.get('kwargs', {}))
+    except:
+        _, exc_msg, _ = sys.exc_info()
+        return {'error': '{0}'.format(exc_msg)}
+    return {'result': result}
+
+
+def serve_pipe(transport, infile, outfile):
+    """
+    Answers requests read from infile on outfile until infile closes.
+
+    :param transport: The transport to run requests with.
+    :type transport: commissaire.transport.ansibleapi.Transport
+    :param infile: Where requests are read from.
+    :type infile: file
+    :param outfile: Where responses are written to.
+    :type outfile: file
+    """
+    for line in iter(infile.readline, ''):
+        try:
+            response = handle(transport, json.loads(line))
+        except ValueError:
+            response = {'error': 'Invalid request'}
+        outfile.write(json.dumps(response) + '\n')
+        outfile.flush()
+
+
+class WorkerPool:
+    """
+    Pool of local worker processes running transport requests.
+    """
+
+    def __init__(self, size=2, command=None):
+        """
+        Creates an instance of the WorkerPool and starts the workers.
+
+        :param size: The number of worker processes.
+        :type size: int
+        :param command: Command which starts a worker.
+        :type command: list
+        """
+        self.logger = logging.getLogger('transport')
+        self.size = size
+        if command is None:
+            command = [sys.executable, '-m', 'commissaire.transport.worker']
+        self.command = command
+        # Workers inherit the control directory so an SSH master opened
+        # or prewarmed by one of them is used by all
+        connections.shared_control_dir()
+        self._idle = Queue()
+        for x in range(0, size):
+            self._idle.put(self._spawn())
+
+    def _spawn(self):
+        """
+        Starts a worker process.
+
+        :returns: The worker process.
+        :rtype: gevent.subprocess.Popen
+        """
+        worker = subprocess.Popen(
+            self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            close_fds=True)
+        self.logger.debug('Started transport worker {0}'.format(worker.pid))
+        return worker
+
+    def request(self, request):
+        """
+        Sends a request to an idle worker and waits for the response.
+
+        :param request: The request.
+        :type request: dict
+        :returns: The response.
+        :rtype: dict
+        :raises: Exception
+        """
+        worker = self._idle.get()
+        try:
+            worker.stdin.write(
+                (json.dumps(request) + '\n').encode('utf-8'))
+            worker.stdin.flush()
+            line = worker.stdout.readline()
+            if not line:
+                raise Exception('Transport worker {0} exited'.format(
+                    worker.pid))
+            return json.loads(line.decode('utf-8'))
+        except:
+            # Never hand out a worker in an unknown state
+            self.logger.warn('Replacing transport worker {0}'.format(
+                worker.pid))
+            self._stop(worker)
+            worker = self._spawn()
+            raise
+        finally:
+            self._idle.put(worker)
+
+    def _stop(self, worker):
+        """
+        Stops a worker process.
+
+        :param worker: The worker process.
+        :type worker: gevent.subprocess.Popen
+        """
+        try:
+            worker.stdin.close()
+            worker.kill()
+            worker.wait()
+        except:
+            pass
+
+    def close(self):
+        """
+        Stops all idle worker processes.
+        """
+        while not self._idle.empty():
+            self._stop(self._idle.get())
+
+
+class RemoteWorkerPool:
+    """
+    Sends transport requests to a worker service on a unix socket.
+    """
+
+    def __init__(self, path):
+        """
+        Creates an instance of the RemoteWorkerPool.
+
+        :param path: Full path to the service's unix socket.
+        :type path: str
+        """
+        self.path = path
+
+    def request(self, request):
+        """
+        Sends a request to the service and waits for the response.
+
+        :param request: The request.
+        :type request: dict
+        :returns: The response.
+        :rtype: dict
+        :raises: Exception
+        """
+        sock = socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+            sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+            line = sock.makefile('rb').readline()
+        finally:
+            sock.close()
+        if not line:
+            raise Exception('Transport service at {0} closed early'.format(
+                self.path))
+        return json.loads(line.decode('utf-8'))
+
+
+def call(pool, method, *args, **kwargs):
+    """
+    Runs a transport method through a pool.
+
+    :param pool: The pool to use.
+    :type pool: WorkerPool or RemoteWorkerPool
+    :param method: The name of the transport method.
+    :type method: str
+    :param args: The arguments for the method.
+    :type args: tuple
+    :param kwargs: The keyword arguments for the method.
+    :type kwargs: dict
+    :returns: The result of the method.
+    :raises: Exception
+    """
+    response = pool.request({
+        'method': method,
+        'args': args,
+        'kwargs': kwargs,
+    })
+    if 'error' in response:
+        raise Exception(response['error'])
+    return response['result']
+
+
+class ProcessTransport:
+    """
+    Transport which runs every operation in a worker process.
+    """
+
+    def __init__(self, pool):
+        """
+        Creates an instance of the ProcessTransport.
+
+        :param pool: The pool to send operations to.
+        :type pool: WorkerPool or RemoteWorkerPool
+        """
+        self.pool = pool
+
+    def prewarm(self, hosts):
+        """
+        See commissaire.transport.ansibleapi.Transport.prewarm.
+        """
+        return call(self.pool, 'prewarm', [list(x) for x in hosts])
+
+    def get_info(self, ip, key_file, fast=False):
+        """
+        See commissaire.transport.ansibleapi.Transport.get_info.
+        """
+        return tuple(call(self.pool, 'get_info', ip, key_file, fast=fast))
+
+    def bootstrap(self, ip, key_file, config, oscmd):
+        """
+        See commissaire.transport.ansibleapi.Transport.bootstrap.
+        """
+        return tuple(call(
+            self.pool, 'bootstrap', ip, key_file,
+            config_to_dict(config), oscmd.os_type))
+
+    def upgrade(self, ip, key_file, oscmd):
+        """
+        See commissaire.transport.ansibleapi.Transport.upgrade.
+        """
+        return tuple(call(
+            self.pool, 'upgrade', ip, key_file, oscmd.os_type))
+
+    def restart(self, ip, key_file, oscmd):
+        """
+        See commissaire.transport.ansibleapi.Transport.restart.
+        """
+        return tuple(call(
+            self.pool, 'restart', ip, key_file, oscmd.os_type))
+
+
+def get_transport():
+    """
+    Returns a transport, using worker processes when a pool is configured.
+
+    :returns: A transport.
+    :rtype: ProcessTransport or commissaire.transport.ansibleapi.Transport
+    """
+    if WORKERS['pool'] is None:
+        return ansibleapi.Transport()
+    return ProcessTransport(WORKERS['pool'])
+
+
+def serve_socket(path, pool):
+    """
+    Runs the worker service on a unix socket.
+
+    :param path: Full path to the unix socket.
+    :type path: str
+    :param pool: The worker pool running the requests.
+    :type pool: WorkerPool
+    """
+    logger = logging.getLogger('transport')
+
+    def answer(sock, address):
+        line = sock.makefile('rb').readline()
+        try:
+            response = pool.request(json.loads(line.decode('utf-8')))
+        except:
+            _, exc_msg, _ = sys.exc_info()
+            response = {'error': '{0}'.format(exc_msg)}
+        sock.sendall((json.dumps(response) + '\n').encode('utf-8'))
+
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    listener.bind(path)
+    os.chmod(path, 0o600)
+    listener.listen(128)
+    logger.info('Transport service listening on {0}'.format(path))
+    StreamServer(listener, answer).serve_forever()
+
+
+def main():  # pragma: no cover
+    """
+    Worker entry point. Without arguments requests are answered over
+    stdin/stdout. With --listen a service with a pool of workers is run.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--listen', '-l', type=str,
+        help='Run as a service on this unix socket')
+    parser.add_argument(
+        '--workers', '-w', type=int, default=2,
+        help='Number of worker processes when running as a service')
+    args = parser.parse_args()
+
+    if args.listen:
+        pool = WorkerPool(args.workers)
+        try:
+            serve_socket(args.listen, pool)
+        finally:
+            pool.close()
+        return
+
+    # Keep anything Ansible prints away from the responses
+    outfile = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    serve_pipe(ansibleapi.Transport(), sys.stdin, outfile)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
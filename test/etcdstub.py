@@ -0,0 +1,340 @@
+# Copyright (C) 2016  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Local stand-in for the etcd v2 keys API.
+
+Enough of etcd for several commissaire processes to share a store in
+tests: get, set, append, delete, compare-and-swap, TTLs and watches.
+
+The stub is served by greenlets. Clients in the same process must use
+cooperative sockets, see cooperative_sockets().
+"""
+
+import datetime
+import json
+import time
+
+import etcd
+import gevent
+import mock
+
+from gevent import socket
+from gevent.event import Event
+from gevent.pywsgi import WSGIServer
+
+try:
+    from urllib.parse import parse_qs
+except ImportError:
+    from urlparse import parse_qs
+
+
+#: errorCode -> (HTTP status, message)
+ERRORS = {
+    100: ('404 Not Found', 'Key not found'),
+    101: ('412 Precondition Failed', 'Compare failed'),
+    102: ('403 Forbidden', 'Not a file'),
+    105: ('412 Precondition Failed', 'Key already exists'),
+}
+
+
+def cooperative_sockets():
+    """
+    Returns a patch making new etcd client connections use gevent
+    sockets. Unlike monkey patching it only lasts until it is stopped.
+
+    :returns: The patch. Not started.
+    :rtype: mock._patch
+    """
+    return mock.patch('urllib3.util.connection.socket', socket)
+
+
+class EtcdError(Exception):
+    """
+    An error to answer with.
+    """
+
+    def __init__(self, code, cause):
+        Exception.__init__(self, code, cause)
+        self.code = code
+        self.cause = cause
+
+
+class EtcdStub:
+    """
+    Serves an in-memory etcd on a local port.
+    """
+
+    def __init__(self):
+        self.index = 1
+        #: key -> {'value', 'createdIndex', 'modifiedIndex', 'expires'}
+        self.nodes = {}
+        #: directory -> createdIndex
+        self.dirs = {'/': 0}
+        #: (index, action, node, prevNode) for watches
+        self.history = []
+        self._changed = Event()
+        self.server = WSGIServer(('127.0.0.1', 0), self, log=None)
+        self._reaper = None
+
+    @property
+    def port(self):
+        """
+        The port being served on.
+        """
+        return self.server.server_port
+
+    def start(self):
+        """
+        Starts serving and expiring keys.
+        """
+        self.server.start()
+        self._reaper = gevent.spawn(self._reap)
+
+    def stop(self):
+        """
+        Stops serving.
+        """
+        self._reaper.kill()
+        self.server.stop(timeout=1)
+
+    def client(self):
+        """
+        Returns a client for the stub.
+        """
+        return etcd.Client(host='127.0.0.1', port=self.port)
+
+    def _render(self, key, recursive=False, top=True):
+        """
+        Returns the JSON form of a key.
+        """
+        if key in self.nodes:
+            node = self.nodes[key]
+            result = {
+                'key': key,
+                'value': node['value'],
+                'createdIndex': node['createdIndex'],
+                'modifiedIndex': node['modifiedIndex'],
+            }
+            if node['expires'] is not None:
+                result['ttl'] = max(1, int(node['expires'] - time.time()))
+                result['expiration'] = datetime.datetime.utcfromtimestamp(
+                    node['expires']).isoformat() + 'Z'
+            return result
+        result = {
+            'key': key,
+            'dir': True,
+            'createdIndex': self.dirs[key],
+            'modifiedIndex': self.dirs[key],
+        }
+        if top or recursive:
+            result['nodes'] = [
+                self._render(child, recursive, False)
+                for child in sorted(self._children(key))]
+        return result
+
+    def _children(self, key):
+        """
+        Returns the keys directly under a directory.
+        """
+        prefix = key.rstrip('/') + '/'
+        return [x for x in list(self.nodes) + list(self.dirs)
+                if x != key and x.startswith(prefix) and
+                '/' not in x[len(prefix):]]
+
+    def _exists(self, key):
+        """
+        Returns True if the key or directory exists.
+        """
+        return key in self.nodes or key in self.dirs
+
+    def _notify(self, action, key, node, prev=None):
+        """
+        Records a change and wakes up watchers.
+        """
+        self.history.append((self.index, action, node, prev))
+        changed, self._changed = self._changed, Event()
+        changed.set()
+
+    def _mkdirs(self, key):
+        """
+        Creates the parent directories of a key.
+        """
+        parts = key.strip('/').split('/')[:-1]
+        for i in range(len(parts)):
+            path = '/' + '/'.join(parts[:i + 1])
+            self.dirs.setdefault(path, self.index)
+
+    def _set(self, key, value, params, action='set'):
+        """
+        Writes a key after checking any conditions.
+        """
+        if key in self.dirs:
+            raise EtcdError(102, key)
+        prev = self.nodes.get(key)
+        prev_exist = params.get('prevExist')
+        if prev_exist == 'false' and prev is not None:
+            raise EtcdError(105, key)
+        if prev_exist == 'true' and prev is None:
+            raise EtcdError(100, key)
+        for name, field in (('prevValue', 'value'),
+                            ('prevIndex', 'modifiedIndex')):
+            if name in params:
+                if prev is None:
+                    raise EtcdError(100, key)
+                if str(prev[field]) != params[name]:
+                    raise EtcdError(101, key)
+        if action == 'set':
+            if prev_exist is not None:
+                action = 'update' if prev_exist == 'true' else 'create'
+            elif 'prevValue' in params or 'prevIndex' in params:
+                action = 'compareAndSwap'
+        prev_node = self._render(key) if prev is not None else None
+        self.index += 1
+        self._mkdirs(key)
+        ttl = params.get('ttl')
+        self.nodes[key] = {
+            'value': value,
+            'createdIndex': (
+                prev['createdIndex'] if prev is not None else self.index),
+            'modifiedIndex': self.index,
+            'expires': time.time() + int(ttl) if ttl else None,
+        }
+        node = self._render(key)
+        self._notify(action, key, node, prev_node)
+        return action, node, prev_node
+
+    def _delete(self, key, params, action='delete'):
+        """
+        Deletes a key after checking any conditions.
+        """
+        if key in self.dirs:
+            prev_node = self._render(key, recursive=True)
+            self.index += 1
+            for child in [x for x in list(self.nodes) + list(self.dirs)
+                          if x == key or x.startswith(key + '/')]:
+                self.nodes.pop(child, None)
+                self.dirs.pop(child, None)
+            node = {'key': key, 'dir': True, 'modifiedIndex': self.index}
+            self._notify(action, key, node, prev_node)
+            return action, node, prev_node
+        prev = self.nodes.get(key)
+        if prev is None:
+            raise EtcdError(100, key)
+        for name, field in (('prevValue', 'value'),
+                            ('prevIndex', 'modifiedIndex')):
+            if name in params and str(prev[field]) != params[name]:
+                raise EtcdError(101, key)
+        prev_node = self._render(key)
+        self.index += 1
+        del self.nodes[key]
+        node = {'key': key, 'modifiedIndex': self.index}
+        self._notify(action, key, node, prev_node)
+        return action, node, prev_node
+
+    def _reap(self):
+        """
+        Expires keys whose TTL ran out.
+        """
+        while True:
+            now = time.time()
+            for key, node in list(self.nodes.items()):
+                if node['expires'] is not None and node['expires'] <= now:
+                    self._delete(key, {}, 'expire')
+            gevent.sleep(0.05)
+
+    def _watch(self, key, params):
+        """
+        Waits for the first change to a key at or after waitIndex.
+        """
+        wait_index = int(params.get('waitIndex', self.index + 1))
+        recursive = params.get('recursive') == 'true'
+        while True:
+            for index, action, node, prev in self.history:
+                if index < wait_index:
+                    continue
+                if node['key'] == key or (
+                        recursive and
+                        node['key'].startswith(key.rstrip('/') + '/')):
+                    return action, node, prev
+            self._changed.wait()
+
+    def __call__(self, environ, start_response):
+        """
+        Answers one etcd API request.
+        """
+        path = environ['PATH_INFO']
+        if path == '/version':
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            return [json.dumps({
+                'etcdserver': '2.3.0', 'etcdcluster': '2.3.0'}).encode()]
+        key = '/' + path[len('/v2/keys/'):].strip('/')
+        params = dict(
+            (k, v[0]) for k, v in parse_qs(environ['QUERY_STRING']).items())
+        method = environ['REQUEST_METHOD']
+        if method in ('PUT', 'POST'):
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            body = environ['wsgi.input'].read(length).decode('utf-8')
+            params.update(
+                (k, v[0]) for k, v in parse_qs(body).items())
+        status = '200 OK'
+        try:
+            if method == 'GET' and params.get('wait') == 'true':
+                action, node, prev = self._watch(key, params)
+            elif method == 'GET':
+                if not self._exists(key):
+                    raise EtcdError(100, key)
+                action, prev = 'get', None
+                node = self._render(
+                    key, recursive=params.get('recursive') == 'true')
+            elif method == 'PUT' and params.get('dir') == 'true':
+                if self._exists(key):
+                    raise EtcdError(102, key)
+                self.index += 1
+                self._mkdirs(key)
+                self.dirs[key] = self.index
+                action, node, prev = 'set', self._render(key), None
+                status = '201 Created'
+            elif method == 'PUT':
+                action, node, prev = self._set(
+                    key, params.pop('value', ''), params)
+                if prev is None:
+                    status = '201 Created'
+            elif method == 'POST':
+                self.dirs.setdefault(key, self.index)
+                self._mkdirs(key)
+                action, node, prev = self._set(
+                    '{0}/{1:020d}'.format(key, self.index + 1),
+                    params.pop('value', ''), params, 'create')
+                status = '201 Created'
+            elif method == 'DELETE':
+                action, node, prev = self._delete(key, params)
+            else:
+                start_response('405 Method Not Allowed', [])
+                return [b'']
+        except EtcdError as error:
+            status, message = ERRORS[error.code]
+            start_response(status, [
+                ('Content-Type', 'application/json'),
+                ('X-Etcd-Index', str(self.index))])
+            return [json.dumps({
+                'errorCode': error.code, 'message': message,
+                'cause': error.cause, 'index': self.index}).encode()]
+        result = {'action': action, 'node': node}
+        if prev is not None:
+            result['prevNode'] = prev
+        start_response(status, [
+            ('Content-Type', 'application/json'),
+            ('X-Etcd-Index', str(self.index))])
+        return [json.dumps(result).encode()]
@@ -16,12 +16,18 @@
 Test cases for the commissaire.oscmd module.
 """
 
+import json
+
+import gevent
+
+from gevent.queue import Queue
 from mock import MagicMock
 
 from . import TestCase
 from commissaire.compat.urlparser import urlparse
 from commissaire.config import Config
-from commissaire.containermgr.kubernetes import KubeContainerManager
+from commissaire.containermgr.kubernetes import (
+    KubeContainerManager, get_container_manager)
 
 
 class Test_KubeContainerManager(TestCase):
@@ -53,3 +59,201 @@ class Test_KubeContainerManager(TestCase):
         self.assertTrue(kube_container_mgr.node_registered('test'))
         self.assertFalse(kube_container_mgr.node_registered('test'))
         self.assertFalse(kube_container_mgr.node_registered('test'))
+
+    def test_remove_node(self):
+        """
+        Verify that KubeContainerManager().remove_node() works as expected.
+        """
+        config = Config(
+            kubernetes={
+                'uri': urlparse('http://127.0.0.1:8080'),
+                'token': 'token',
+            }
+        )
+        kube_container_mgr = KubeContainerManager(config)
+        # Missing nodes count as removed. Errors do not.
+        kube_container_mgr.con = MagicMock()
+        kube_container_mgr.con.delete = MagicMock(side_effect=(
+            MagicMock(status_code=200),
+            MagicMock(status_code=404),
+            MagicMock(status_code=500)))
+
+        self.assertTrue(kube_container_mgr.remove_node('test'))
+        self.assertTrue(kube_container_mgr.remove_node('test'))
+        self.assertFalse(kube_container_mgr.remove_node('test'))
+        kube_container_mgr.con.delete.assert_called_with(
+            'http://127.0.0.1:8080/api/v1/nodes/test')
+
+    def test_connection_pool(self):
+        """
+        Verify connections are pooled and the token header is reused.
+        """
+        config = Config(
+            kubernetes={
+                'uri': urlparse('http://127.0.0.1:8080'),
+                'token': 'token',
+            }
+        )
+        kube_container_mgr = KubeContainerManager(config, pool_maxsize=5)
+        adapter = kube_container_mgr.con.get_adapter('http://127.0.0.1:8080')
+        self.assertEquals(5, adapter._pool_maxsize)
+        self.assertTrue(adapter._pool_block)
+        self.assertEquals(
+            'Bearer token',
+            kube_container_mgr.con.headers['Authorization'])
+
+    def test_get_container_manager(self):
+        """
+        Verify get_container_manager shares one manager per configuration.
+        """
+        config = Config(
+            kubernetes={
+                'uri': urlparse('http://127.0.0.1:8080'),
+                'token': 'token',
+            }
+        )
+        manager = get_container_manager(config)
+        self.assertTrue(manager is get_container_manager(config))
+        config.kubernetes['token'] = 'other'
+        other = get_container_manager(config)
+        self.assertFalse(manager is other)
+        self.assertEquals(
+            'Bearer other', other.con.headers['Authorization'])
+
+
+class FakeResponse:
+    """
+    Minimal requests.Response for the node list and watch.
+    """
+
+    def __init__(self, body=None, lines=None):
+        self.status_code = 200
+        self.body = body
+        self.lines = lines
+        self.closed = False
+
+    def json(self):
+        return self.body
+
+    def iter_lines(self, chunk_size=None):
+        return self.lines
+
+    def close(self):
+        self.closed = True
+
+
+class FakeApiServer:
+    """
+    Minimal Kubernetes apiserver serving the node list and watch.
+    """
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.events = Queue()
+        self.requests = []
+        self.responses = []
+
+    def get(self, part, params={}, **kwargs):
+        self.requests.append(params)
+        if params.get('watch') == 'true':
+            resp = FakeResponse(lines=self._stream())
+        else:
+            resp = FakeResponse(body={
+                'kind': 'NodeList',
+                'metadata': {'resourceVersion': '1'},
+                'items': [{'metadata': {'name': x}} for x in self.nodes],
+            })
+        self.responses.append(resp)
+        return resp
+
+    def _stream(self):
+        while True:
+            yield (json.dumps(self.events.get()) + '\n').encode('utf-8')
+
+
+class Test_KubeContainerManagerWatch(TestCase):
+    """
+    Tests for the node watch of the KubeContainerManager class.
+    """
+
+    def before(self):
+        """
+        Creates a manager using a fake apiserver.
+        """
+        self.apiserver = FakeApiServer(['10.2.0.2'])
+        config = Config(
+            kubernetes={
+                'uri': urlparse('http://127.0.0.1:8080'),
+                'token': 'token',
+            }
+        )
+        self.kube_container_mgr = KubeContainerManager(config)
+        self.kube_container_mgr._get = self.apiserver.get
+
+    def after(self):
+        """
+        Stops the watch.
+        """
+        self.kube_container_mgr.stop_watch()
+
+    def test_wait_for_listed_node(self):
+        """
+        Verify nodes which are already registered are found by the list.
+        """
+        self.assertTrue(self.kube_container_mgr.wait_for_node('10.2.0.2', 1))
+
+    def test_wait_for_added_node(self):
+        """
+        Verify added nodes are seen through the watch without polling.
+        """
+        self.assertFalse(
+            self.kube_container_mgr.wait_for_node('10.2.0.3', 0.1))
+        self.apiserver.events.put({
+            'type': 'ADDED',
+            'object': {'metadata': {'name': '10.2.0.3'}}})
+        self.assertTrue(self.kube_container_mgr.wait_for_node('10.2.0.3', 1))
+        # One list and one watch no matter how often callers wait
+        self.assertEquals(2, len(self.apiserver.requests))
+        self.assertEquals('1', self.apiserver.requests[1]['resourceVersion'])
+
+    def test_wait_for_deleted_node(self):
+        """
+        Verify deleted nodes are no longer registered.
+        """
+        self.assertTrue(self.kube_container_mgr.wait_for_node('10.2.0.2', 1))
+        self.apiserver.events.put({
+            'type': 'DELETED',
+            'object': {'metadata': {'name': '10.2.0.2'}}})
+        gevent.sleep(0.1)
+        self.assertFalse(
+            self.kube_container_mgr.wait_for_node('10.2.0.2', 0.1))
+
+    def test_listeners(self):
+        """
+        Verify listeners receive the listed nodes and watch events.
+        """
+        received = []
+        self.kube_container_mgr.add_listener(
+            lambda event_type, node: received.append(
+                (event_type, node['metadata']['name'])))
+        self.kube_container_mgr.wait_for_node('10.2.0.2', 1)
+        self.apiserver.events.put({
+            'type': 'MODIFIED',
+            'object': {'metadata': {'name': '10.2.0.2'}}})
+        gevent.sleep(0.1)
+        self.assertEquals(
+            [('ADDED', '10.2.0.2'), ('MODIFIED', '10.2.0.2')], received)
+
+    def test_watch_closes_stream(self):
+        """
+        Verify an ended watch closes its stream before watching again.
+        """
+        self.assertTrue(self.kube_container_mgr.wait_for_node('10.2.0.2', 1))
+        self.apiserver.events.put({
+            'type': 'ERROR',
+            'object': {'code': 410}})
+        gevent.sleep(0.1)
+        # list, watch, list, watch
+        self.assertEquals(4, len(self.apiserver.requests))
+        self.assertTrue(self.apiserver.responses[1].closed)
+        self.assertFalse(self.apiserver.responses[3].closed)
@@ -0,0 +1,209 @@
+# Copyright (C) 2016  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Test cases for the commissaire.events module.
+"""
+
+import json
+
+import etcd
+
+from gevent.queue import Empty
+
+from . import TestCase
+from .etcdstub import EtcdStub, cooperative_sockets
+from commissaire.events import Event, EventBus, SubscriptionClosed
+
+
+def host_event(address, action='set', prev=True):
+    """
+    Returns an event for a host record.
+    """
+    value = json.dumps({'address': address, 'status': 'active'})
+    return Event(
+        action, '/commissaire/hosts/{0}'.format(address), 10,
+        None if action == 'delete' else value, value if prev else None)
+
+
+class Test_Event(TestCase):
+    """
+    Tests for the Event class.
+    """
+
+    def test_event_types(self):
+        """
+        Verify changes are classified by kind and change.
+        """
+        self.assertEquals(
+            'host.added', host_event('10.2.0.2', prev=False).event_type)
+        self.assertEquals(
+            'host.modified', host_event('10.2.0.2').event_type)
+        deleted = host_event('10.2.0.2', 'delete')
+        self.assertEquals('host.deleted', deleted.event_type)
+        self.assertEquals('10.2.0.2', deleted.address)
+        self.assertEquals(None, deleted.data)
+
+        restart = Event(
+            'set', '/commissaire/cluster/development/restart', 11, '{}')
+        self.assertEquals('operation.added', restart.event_type)
+        self.assertEquals('development', restart.cluster)
+        self.assertEquals(
+            'worker.deleted',
+            Event('expire', '/commissaire/workers/a', 12).event_type)
+        tombstone = Event(
+            'set', '/commissaire/deleted/hosts/10.2.0.2', 12, '{}')
+        self.assertEquals('tombstone.added', tombstone.event_type)
+        self.assertEquals('10.2.0.2', tombstone.address)
+        self.assertEquals(
+            'resync', Event('resync', '/commissaire', 13).event_type)
+
+
+class Test_EventBus(TestCase):
+    """
+    Tests for the EventBus and Subscription classes.
+    """
+
+    def before(self):
+        """
+        Sets up a bus with a cluster holding one host.
+        """
+        self.bus = EventBus()
+        self.bus.publish(Event(
+            'set', '/commissaire/clusters/development', 1,
+            json.dumps({'hostset': ['10.2.0.2']})))
+
+    def test_subscriptions(self):
+        """
+        Verify events only reach matching subscriptions.
+        """
+        everything = self.bus.subscribe()
+        by_address = self.bus.subscribe(address='10.2.0.3')
+        by_cluster = self.bus.subscribe(cluster='development')
+        by_type = self.bus.subscribe(event_types=('host.deleted', 'cluster'))
+
+        self.assertEquals(2, self.bus.publish(host_event('10.2.0.2')))
+        self.assertEquals(
+            3, self.bus.publish(host_event('10.2.0.3', 'delete')))
+        self.assertEquals(3, self.bus.publish(Event(
+            'set', '/commissaire/clusters/development', 2,
+            json.dumps({'hostset': ['10.2.0.3']}),
+            json.dumps({'hostset': ['10.2.0.2']}))))
+
+        self.assertEquals(3, len(everything.drain()))
+        self.assertEquals(
+            ['host.deleted'], [x.event_type for x in by_address.drain()])
+        self.assertEquals(
+            ['host.modified', 'cluster.modified'],
+            [x.event_type for x in by_cluster.drain()])
+        self.assertEquals(
+            ['host.deleted', 'cluster.modified'],
+            [x.event_type for x in by_type.drain()])
+
+        # The cluster now holds 10.2.0.3
+        self.bus.publish(host_event('10.2.0.3'))
+        self.assertEquals(1, len(by_cluster.drain()))
+
+    def test_overflow(self):
+        """
+        Verify each overflow policy.
+        """
+        oldest = self.bus.subscribe(maxsize=2)
+        newest = self.bus.subscribe(maxsize=2, overflow='drop_newest')
+        closing = self.bus.subscribe(maxsize=2, overflow='close')
+        for x in range(3):
+            self.bus.publish(host_event('10.2.0.{0}'.format(x)))
+
+        self.assertEquals(
+            ['10.2.0.1', '10.2.0.2'], [x.address for x in oldest.drain()])
+        self.assertEquals(1, oldest.dropped)
+        self.assertEquals(
+            ['10.2.0.0', '10.2.0.1'], [x.address for x in newest.drain()])
+        self.assertEquals(1, newest.dropped)
+        self.assertTrue(closing.closed)
+        self.assertRaises(SubscriptionClosed, closing.get)
+        # The closed subscription no longer receives anything
+        self.assertEquals(2, self.bus.publish(Event(
+            'set', '/commissaire/other', 3, '{}')))
+        self.assertRaises(ValueError, self.bus.subscribe, overflow='block')
+
+    def test_close(self):
+        """
+        Verify closed subscriptions stop receiving events.
+        """
+        subscription = self.bus.subscribe()
+        subscription.close()
+        self.assertEquals(0, self.bus.publish(host_event('10.2.0.2')))
+        self.assertEquals([], list(subscription))
+
+    def test_resync(self):
+        """
+        Verify every subscription hears about missed events.
+        """
+        subscription = self.bus.subscribe(address='10.2.0.2')
+        self.bus.publish(Event('resync', '/commissaire', 5))
+        self.assertEquals('resync', subscription.get(timeout=1).event_type)
+
+
+class Test_EventBusWatch(TestCase):
+    """
+    Tests for the etcd watch of the EventBus class.
+    """
+
+    def before(self):
+        """
+        Starts a local etcd stand-in and a bus watching it.
+        """
+        self.sockets = cooperative_sockets()
+        self.sockets.start()
+        self.etcd = EtcdStub()
+        self.etcd.start()
+        self.store = self.etcd.client()
+        self.store.write('/commissaire/clusters/development', json.dumps(
+            {'status': 'ok', 'hostset': ['10.2.0.2']}))
+        self.bus = EventBus()
+        self.bus.start(self.store)
+
+    def after(self):
+        """
+        Stops the bus and the etcd stand-in.
+        """
+        self.bus.stop()
+        self.etcd.stop()
+        self.sockets.stop()
+
+    def test_watch(self):
+        """
+        Verify one watch delivers every change in order.
+        """
+        subscription = self.bus.subscribe(cluster='development')
+        self.assertRaises(Empty, subscription.get, timeout=0.1)
+        self.assertEquals(set(['10.2.0.2']), self.bus.hostset('development'))
+
+        key = '/commissaire/hosts/10.2.0.2'
+        self.store.write(key, json.dumps({'address': '10.2.0.2'}))
+        self.store.write('/commissaire/hosts/10.2.0.3', json.dumps(
+            {'address': '10.2.0.3'}))
+        self.store.write(
+            '/commissaire/cluster/development/restart', '{}')
+        self.store.delete(key)
+
+        events = [subscription.get(timeout=1) for x in range(3)]
+        self.assertEquals(
+            ['host.added', 'operation.added', 'host.deleted'],
+            [x.event_type for x in events])
+        self.assertEquals('10.2.0.2', events[2].address)
+        self.assertEquals(
+            sorted(x.index for x in events), [x.index for x in events])
+        self.assertRaises(etcd.EtcdKeyNotFound, self.store.read, key)
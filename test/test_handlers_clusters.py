@@ -22,7 +22,8 @@ import etcd
 import falcon
 
 from . import TestCase
-from mock import MagicMock
+from mock import MagicMock, patch
+from commissaire.events import Event, EventBus
 from commissaire.handlers import clusters
 from commissaire.middleware import JSONify
 
@@ -301,6 +302,45 @@ class Test_ClusterRestartResource(TestCase):
         self.assertEqual(falcon.HTTP_204, self.srmock.status)
         self.assertEqual([], body)  # Empty data'''
 
+    def test_cluster_restart_stream(self):
+        """
+        Verify streaming a cluster restart until it finishes.
+        """
+        key = '/commissaire/cluster/development/restart'
+        status = {
+            'status': 'in_process', 'restarted': [],
+            'in_process': ['10.2.0.2'], 'started_at': '', 'finished_at': None}
+        self.datasource.get.side_effect = (
+            None, MagicMock(value=json.dumps(status), modifiedIndex=5))
+        bus = EventBus()
+        with patch('commissaire.handlers.clusters.EVENT_BUS', bus):
+            body = self.simulate_request(
+                '/api/v0/cluster/development/restart',
+                headers={'Accept': 'text/event-stream'})
+            self.assertEqual(falcon.HTTP_200, self.srmock.status)
+            self.assertIn(
+                ('content-type', 'text/event-stream'), self.srmock.headers)
+
+            # Other operations and clusters are not sent
+            bus.publish(Event(
+                'set', '/commissaire/cluster/other/restart', 6, '{}'))
+            bus.publish(Event(
+                'set', '/commissaire/cluster/development/upgrade', 7, '{}'))
+            status['restarted'] = status.pop('in_process')
+            status['in_process'] = []
+            status['status'] = 'finished'
+            status['finished_at'] = '2016-01-01T00:00:00'
+            bus.publish(Event('set', key, 8, json.dumps(status), '{}'))
+
+            events = list(body)
+        self.assertEquals(2, len(events))
+        self.assertTrue(events[0].startswith(b'id: 5\nevent: status\n'))
+        self.assertTrue(events[1].startswith(b'id: 8\nevent: status\n'))
+        self.assertEquals(
+            status, json.loads(events[1].decode().split('data: ')[1]))
+        # The stream ended with the restart
+        self.assertEquals([], bus._subscriptions)
+
     def test_cluster_restart_create(self):
         """
         Verify creating a cluster restart.
@@ -314,6 +354,11 @@ class Test_ClusterRestartResource(TestCase):
         self.assertEquals('in_process', result['status'])
         self.assertEquals([], result['restarted'])
         self.assertEquals([], result['in_process'])
+        # The restart should be queued as a durable job
+        self.datasource.write.assert_called_once_with(
+            '/commissaire/jobs/clusterexec/items',
+            json.dumps({'cluster': 'development', 'command': 'restart'}),
+            append=True)
 
 
 class Test_ClusterHostsResource(TestCase):
@@ -585,6 +630,24 @@ class Test_ClusterUpgradeResource(TestCase):
         self.assertEqual(falcon.HTTP_204, self.srmock.status)
         self.assertEqual([], body)  # Empty data
 
+    def test_cluster_upgrade_stream(self):
+        """
+        Verify streaming a finished cluster upgrade ends right away.
+        """
+        self.datasource.get.side_effect = (
+            None, MagicMock(value=self.aupgrade, modifiedIndex=5))
+        bus = EventBus()
+        with patch('commissaire.handlers.clusters.EVENT_BUS', bus):
+            body = self.simulate_request(
+                '/api/v0/cluster/development/upgrade',
+                headers={'Accept': 'text/event-stream'})
+            events = list(body)
+        self.assertEquals(1, len(events))
+        self.assertEquals(
+            json.loads(self.aupgrade),
+            json.loads(events[0].decode().split('data: ')[1]))
+        self.assertEquals([], bus._subscriptions)
+
     def test_cluster_create(self):
         """
         Verify creating a cluster.
@@ -599,6 +662,16 @@ class Test_ClusterUpgradeResource(TestCase):
             self.assertEquals('{}', body[0])
 
         # Verify with creation
+        calls = []
+
+        def record(name):
+            def call(*args, **kwargs):
+                calls.append(name)
+                return MagicMock(key='/commissaire/jobs/clusterexec/items/1')
+            return call
+
+        self.datasource.set.side_effect = record('set')
+        self.datasource.write.side_effect = record('write')
         body = self.simulate_request(
             '/api/v0/cluster/development/upgrade',
             method='PUT',
@@ -609,3 +682,10 @@ class Test_ClusterUpgradeResource(TestCase):
         self.assertEquals('7.0.2', result['upgrade_to'])
         self.assertEquals([], result['upgraded'])
         self.assertEquals([], result['in_process'])
+        # The upgrade should be queued as a durable job
+        self.assertEquals(1, self.datasource.write.call_count)
+        job = json.loads(self.datasource.write.call_args[0][1])
+        self.assertEquals('upgrade', job['command'])
+        self.assertEquals('7.0.2', job['upgrade_to'])
+        # after the status it updates was written
+        self.assertEquals(['set', 'write'], calls)
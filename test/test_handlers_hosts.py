@@ -20,9 +20,12 @@ import json
 
 import etcd
 import falcon
+import gevent
+import mock
 
 from . import TestCase
 from mock import MagicMock
+from commissaire.events import Event, EventBus
 from commissaire.handlers import hosts
 from commissaire.middleware import JSONify
 
@@ -132,6 +135,236 @@ class Test_HostsResource(TestCase):
         self.assertEqual(self.srmock.status, falcon.HTTP_404)
         self.assertEqual('{}', body[0])
 
+    def host_dir(self, index, hosts):
+        """
+        Returns a hosts directory result at an etcd index.
+        """
+        children = [
+            MagicMock(value=self.etcd_host.replace('10.2.0.2', address),
+                      modifiedIndex=modified)
+            for address, modified in hosts]
+        return MagicMock(
+            etcd.EtcdResult, etcd_index=index,
+            _children=children, leaves=children)
+
+    def test_hosts_changes(self):
+        """
+        Verify listing Hosts changed after an index.
+        """
+        tombstones = [
+            MagicMock(key='/commissaire/deleted/hosts/10.2.0.9',
+                      modifiedIndex=8),
+            # Deleted before and added again
+            MagicMock(key='/commissaire/deleted/hosts/10.2.0.3',
+                      modifiedIndex=6),
+            MagicMock(key='/commissaire/deleted/hosts/10.2.0.8',
+                      modifiedIndex=3)]
+        self.datasource.get.side_effect = (
+            self.host_dir(9, [('10.2.0.2', 7), ('10.2.0.3', 4)]),
+            MagicMock(etcd.EtcdResult, _children=tombstones,
+                      leaves=tombstones),
+            MagicMock(value='3'))
+
+        body = self.simulate_request('/api/v0/hosts', query_string='since=5')
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+        self.assertEqual({
+            'index': 9,
+            'hosts': [json.loads(self.ahost)],
+            'deleted': ['10.2.0.9'],
+            'resync': False}, json.loads(body[0]))
+
+        # Verify clients behind the horizon get every host
+        self.datasource.get.side_effect = (
+            self.host_dir(9, [('10.2.0.2', 7), ('10.2.0.3', 4)]),
+            etcd.EtcdKeyNotFound, MagicMock(value='6'))
+        body = self.simulate_request('/api/v0/hosts', query_string='since=5')
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+        result = json.loads(body[0])
+        self.assertTrue(result['resync'])
+        self.assertEqual(
+            ['10.2.0.2', '10.2.0.3'], [x['address'] for x in result['hosts']])
+        self.assertEqual([], result['deleted'])
+
+        # Verify a bad index is refused
+        self.simulate_request('/api/v0/hosts', query_string='since=old')
+        self.assertEqual(self.srmock.status, falcon.HTTP_400)
+
+    def test_hosts_changes_wait(self):
+        """
+        Verify waiting for Hosts to change.
+        """
+        self.datasource.get.side_effect = (
+            self.host_dir(9, [('10.2.0.2', 7)]), etcd.EtcdKeyNotFound,
+            etcd.EtcdKeyNotFound,
+            self.host_dir(10, [('10.2.0.2', 10)]), etcd.EtcdKeyNotFound,
+            etcd.EtcdKeyNotFound)
+        bus = EventBus()
+        gevent.spawn_later(0.1, bus.publish, Event(
+            'set', '/commissaire/hosts/10.2.0.2', 10,
+            self.etcd_host, self.etcd_host))
+        with mock.patch('commissaire.handlers.hosts.EVENT_BUS', bus):
+            body = self.simulate_request(
+                '/api/v0/hosts', query_string='since=9&wait=true')
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+        self.assertEqual({
+            'index': 10,
+            'hosts': [json.loads(self.ahost)],
+            'deleted': [],
+            'resync': False}, json.loads(body[0]))
+        self.assertEqual([], bus._subscriptions)
+
+        # Verify nothing changing returns no changes once the timeout is up
+        self.datasource.get.side_effect = (
+            self.host_dir(10, [('10.2.0.2', 10)]), etcd.EtcdKeyNotFound,
+            etcd.EtcdKeyNotFound)
+        with mock.patch('commissaire.handlers.hosts.EVENT_BUS', bus):
+            body = self.simulate_request(
+                '/api/v0/hosts', query_string='since=10&wait=true&timeout=1')
+        self.assertEqual(
+            {'index': 10, 'hosts': [], 'deleted': [], 'resync': False},
+            json.loads(body[0]))
+
+    def test_hosts_changes_wait_for_tombstone(self):
+        """
+        Verify waiting sees a deletion once its tombstone is written.
+        """
+        tombstones = [
+            MagicMock(key='/commissaire/deleted/hosts/10.2.0.3',
+                      modifiedIndex=11)]
+        self.datasource.get.side_effect = (
+            # The host is gone but the tombstone is not written yet
+            self.host_dir(10, [('10.2.0.2', 7)]), etcd.EtcdKeyNotFound,
+            etcd.EtcdKeyNotFound,
+            self.host_dir(11, [('10.2.0.2', 7)]),
+            MagicMock(etcd.EtcdResult, _children=tombstones,
+                      leaves=tombstones),
+            etcd.EtcdKeyNotFound)
+        bus = EventBus()
+        gevent.spawn_later(0.1, bus.publish, Event(
+            'set', '/commissaire/deleted/hosts/10.2.0.3', 11,
+            json.dumps({'deleted': 0})))
+        with mock.patch('commissaire.handlers.hosts.EVENT_BUS', bus):
+            body = self.simulate_request(
+                '/api/v0/hosts', query_string='since=10&wait=true&timeout=5')
+        self.assertEqual({
+            'index': 11,
+            'hosts': [],
+            'deleted': ['10.2.0.3'],
+            'resync': False}, json.loads(body[0]))
+
+    def test_prune_tombstones(self):
+        """
+        Verify old tombstones are removed after moving the horizon.
+        """
+        now = 1451606400.0
+        tombstones = [
+            MagicMock(key='/commissaire/deleted/hosts/10.2.0.3',
+                      value=json.dumps({'deleted': now - 60}),
+                      modifiedIndex=12),
+            MagicMock(key='/commissaire/deleted/hosts/10.2.0.4',
+                      value=json.dumps({
+                          'deleted': now - hosts.HOST_TOMBSTONE_TTL}),
+                      modifiedIndex=8),
+            # Written before tombstones carried a time
+            MagicMock(key='/commissaire/deleted/hosts/10.2.0.5',
+                      value='', modifiedIndex=5)]
+        store = MagicMock(name='store')
+        store.get.side_effect = (
+            MagicMock(etcd.EtcdResult, _children=tombstones,
+                      leaves=tombstones),
+            etcd.EtcdKeyNotFound)
+        self.assertEquals(2, hosts.prune_tombstones(store, now))
+        # Anyone behind the newest pruned tombstone gets a full listing
+        store.write.assert_called_once_with(
+            hosts.HOST_TOMBSTONES_HORIZON, '8', prevExist=False)
+        self.assertEquals([
+            mock.call('/commissaire/deleted/hosts/10.2.0.4', prevIndex=8),
+            mock.call('/commissaire/deleted/hosts/10.2.0.5', prevIndex=5)],
+            store.delete.call_args_list)
+
+    def test_hosts_register(self):
+        """
+        Verify registering a batch of Hosts.
+        """
+        self.datasource.write = MagicMock(name='write')
+        existing = [MagicMock(key='/commissaire/hosts/10.2.0.2')]
+        self.datasource.get.side_effect = (
+            MagicMock(etcd.EtcdResult, _children=existing, leaves=existing),
+            MagicMock(value='{"status": "ok", "hostset": ["10.2.0.2"]}',
+                      modifiedIndex=3),
+            etcd.EtcdKeyNotFound)
+        key = 'dGVzdAo='
+        batch = [
+            {'address': '10.2.0.4', 'ssh_priv_key': key,
+             'cluster': 'development'},
+            {'address': '10.2.0.3', 'ssh_priv_key': key,
+             'cluster': 'development'},
+            {'address': '10.2.0.2', 'ssh_priv_key': key},
+            {'address': '10.2.0.3', 'ssh_priv_key': key},
+            {'address': '10.2.0.5', 'ssh_priv_key': key, 'cluster': 'nope'},
+            {'ssh_priv_key': key},
+        ]
+        body = self.simulate_request(
+            '/api/v0/hosts', method='POST', body=json.dumps(batch))
+        self.assertEqual(self.srmock.status, '207 Multi-Status')
+        results = json.loads(body[0])
+        self.assertEqual(
+            [201, 201, 409, 400, 409, 400], [x['status'] for x in results])
+        self.assertEqual('investigating', results[0]['host']['status'])
+        self.assertNotIn('ssh_priv_key', results[0]['host'])
+        self.assertEqual(None, results[2]['host'])
+
+        # Two hosts, one cluster update and two investigations
+        writes = [x[0][0] for x in self.datasource.write.call_args_list]
+        self.assertEqual(
+            ['/commissaire/hosts/10.2.0.3', '/commissaire/hosts/10.2.0.4'],
+            sorted(writes[:2]))
+        self.assertEqual('/commissaire/clusters/development', writes[2])
+        self.assertEqual(
+            ['10.2.0.2', '10.2.0.3', '10.2.0.4'],
+            json.loads(self.datasource.write.call_args_list[2][0][1])[
+                'hostset'])
+        self.assertEqual(
+            {'prevIndex': 3}, self.datasource.write.call_args_list[2][1])
+        self.assertEqual(
+            ['/commissaire/jobs/investigate/items'] * 2, writes[3:])
+
+    def test_hosts_register_cluster_changed(self):
+        """
+        Verify a Cluster changing while registering Hosts is read again.
+        """
+        def write(key, value, **kwargs):
+            if kwargs.get('prevIndex') == 3:
+                raise etcd.EtcdCompareFailed()
+            return MagicMock(key=key)
+
+        self.datasource.write = MagicMock(name='write', side_effect=write)
+        self.datasource.get.side_effect = (
+            etcd.EtcdKeyNotFound,
+            MagicMock(value='{"status": "ok", "hostset": []}',
+                      modifiedIndex=3),
+            MagicMock(value='{"status": "ok", "hostset": ["10.2.0.9"]}',
+                      modifiedIndex=4))
+        body = self.simulate_request(
+            '/api/v0/hosts', method='POST', body=json.dumps([
+                {'address': '10.2.0.2', 'ssh_priv_key': 'dGVzdAo=',
+                 'cluster': 'development'}]))
+        self.assertEqual(self.srmock.status, falcon.HTTP_201)
+        self.assertEqual(None, json.loads(body[0])[0]['error'])
+        cluster = self.datasource.write.call_args_list[2]
+        self.assertEqual({'prevIndex': 4}, cluster[1])
+        self.assertEqual(
+            ['10.2.0.2', '10.2.0.9'], json.loads(cluster[0][1])['hostset'])
+
+    def test_hosts_register_bad_batch(self):
+        """
+        Verify batches which are not a list of hosts are refused.
+        """
+        for batch in ('', '{}', '[]', json.dumps([{}] * 1001)):
+            self.simulate_request('/api/v0/hosts', method='POST', body=batch)
+            self.assertEqual(self.srmock.status, falcon.HTTP_400)
+        self.assertEqual(0, self.datasource.get.call_count)
+
 
 class Test_Host(TestCase):
     """
@@ -189,6 +422,7 @@ class Test_HostResource(TestCase):
         self.datasource.delete.return_value = self.return_value
         self.datasource.set = MagicMock(name='set')
         self.datasource.set.return_value = self.return_value
+        self.datasource.write = MagicMock(name='write')
         self.resource = hosts.HostResource(self.datasource)
         self.api.add_route('/api/v0/host/{address}', self.resource)
 
@@ -228,20 +462,36 @@ class Test_HostResource(TestCase):
         self.datasource.get.side_effect = (
             MagicMock(value=self.etcd_host), clusters_return_value)
 
-        # Verify deleting of an existing host works
-        body = self.simulate_request('/api/v0/host/10.2.0.2', method='DELETE')
-        # datasource's delete should have been called once
-        self.assertEquals(1, self.datasource.delete.call_count)
-        self.assertEqual(self.srmock.status, falcon.HTTP_410)
-        self.assertEqual({}, json.loads(body[0]))
-
-        # Verify deleting of a non existing host returns the proper result
-        self.datasource.delete.reset_mock()
-        self.datasource.delete.side_effect = etcd.EtcdKeyNotFound
-        body = self.simulate_request('/api/v0/host/10.9.9.9', method='DELETE')
-        self.assertEquals(1, self.datasource.delete.call_count)
-        self.assertEqual(self.srmock.status, falcon.HTTP_404)
-        self.assertEqual({}, json.loads(body[0]))
+        with mock.patch.object(hosts, 'DEREGISTER_QUEUE') as _dq, \
+                mock.patch.object(hosts, 'prune_tombstones') as _pt, \
+                mock.patch.dict(hosts.TOMBSTONES, {'pruned': 0}):
+            # Verify deleting of an existing host works
+            body = self.simulate_request(
+                '/api/v0/host/10.2.0.2', method='DELETE')
+            # Old tombstones are pruned now and then
+            self.assertEquals(1, _pt.call_count)
+            # datasource's delete should have been called once
+            self.assertEquals(1, self.datasource.delete.call_count)
+            self.assertEqual(self.srmock.status, falcon.HTTP_410)
+            self.assertEqual({}, json.loads(body[0]))
+            # The node should be queued for removal
+            _dq.put.assert_called_once_with('10.2.0.2')
+            # Delta listings should see the deletion
+            self.assertEquals(1, self.datasource.set.call_count)
+            key, value = self.datasource.set.call_args[0]
+            self.assertEquals('/commissaire/deleted/hosts/10.2.0.2', key)
+            self.assertTrue('deleted' in json.loads(value))
+
+            # Verify deleting of a non existing host returns the proper result
+            self.datasource.delete.reset_mock()
+            _dq.reset_mock()
+            self.datasource.delete.side_effect = etcd.EtcdKeyNotFound
+            body = self.simulate_request(
+                '/api/v0/host/10.9.9.9', method='DELETE')
+            self.assertEquals(1, self.datasource.delete.call_count)
+            self.assertEqual(self.srmock.status, falcon.HTTP_404)
+            self.assertEqual({}, json.loads(body[0]))
+            self.assertEquals(0, _dq.put.call_count)
 
     def test_host_create(self):
         """
@@ -259,6 +509,13 @@ class Test_HostResource(TestCase):
         self.assertEquals(2, self.datasource.set.call_count)
         self.assertEqual(self.srmock.status, falcon.HTTP_201)
         self.assertEqual(json.loads(self.ahost), json.loads(body[0]))
+        # The investigation should be queued as a durable job
+        self.assertEquals(
+            '/commissaire/jobs/investigate/items',
+            self.datasource.write.call_args[0][0])
+        job = json.loads(self.datasource.write.call_args[0][1])
+        self.assertEquals('10.2.0.2', job['host']['address'])
+        self.assertEquals('dGVzdAo=', job['ssh_priv_key'])
 
         # Make sure creation fails if the cluster doesn't exist
         self.datasource.get.side_effect = etcd.EtcdKeyNotFound
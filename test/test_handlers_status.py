@@ -54,7 +54,8 @@ class Test_StatusResource(TestCase):
     Tests for the Status resource.
     """
     astatus = ('{"etcd": {"status": "OK"}, "investigator": {"status": '
-               '"OK", "info": {"size": 1, "in_use": 1, "errors": []}}, '
+               '"OK", "info": {"size": 1, "in_use": 1, "errors": [], '
+               '"queue": {"interactive": 0, "retry": 0, "background": 0}}}, '
                '"clusterexecpool": {"status": "OK", "info": '
                '{"size": 1, "in_use": 1, "errors": []}}}')
 
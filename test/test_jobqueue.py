@@ -0,0 +1,168 @@
+# Copyright (C) 2016  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Test cases for the commissaire.jobqueue module.
+"""
+
+import json
+
+import etcd
+import mock
+
+from . import TestCase
+from commissaire.jobqueue import EtcdQueue, Job, enqueue
+
+
+def make_items(*jobs):
+    """
+    Returns a read result holding the given (id, payload) jobs.
+    """
+    items = mock.MagicMock(etcd_index=7)
+    items.leaves = [
+        mock.MagicMock(
+            key='/commissaire/jobs/test/items/{0}'.format(job_id),
+            value=json.dumps(payload), dir=False)
+        for job_id, payload in jobs]
+    return items
+
+
+class Test_EtcdQueue(TestCase):
+    """
+    Tests for the EtcdQueue class.
+    """
+
+    def before(self):
+        """
+        Sets up a fresh queue for each test.
+        """
+        self.store = mock.MagicMock(name='store')
+        self.queue = EtcdQueue(self.store, 'test', owner='worker1')
+
+    def test_enqueue(self):
+        """
+        Verify jobs are appended as in-order keys.
+        """
+        self.store.write.return_value = mock.MagicMock(
+            key='/commissaire/jobs/test/items/00000000000000000010')
+        key = enqueue(self.store, 'test', {'a': 1})
+        self.store.write.assert_called_once_with(
+            '/commissaire/jobs/test/items', json.dumps({'a': 1}),
+            append=True)
+        self.assertEquals(
+            '/commissaire/jobs/test/items/00000000000000000010', key)
+
+    def test_claim(self):
+        """
+        Verify the oldest unclaimed job is claimed with a TTL.
+        """
+        self.store.read.return_value = make_items(
+            ('1', {'a': 1}), ('2', {'a': 2}))
+        self.store.write.side_effect = [etcd.EtcdAlreadyExist, None]
+        job = self.queue.claim()
+        self.assertEquals('2', job.id)
+        self.assertEquals({'a': 2}, job.payload)
+        self.store.write.assert_called_with(
+            '/commissaire/jobs/test/claims/2', 'worker1',
+            ttl=300, prevExist=False)
+        self.assertEquals(7, self.queue._index)
+
+    def test_claim_empty(self):
+        """
+        Verify nothing is claimed from a missing or fully claimed queue.
+        """
+        self.store.read.side_effect = etcd.EtcdKeyNotFound
+        self.assertIsNone(self.queue.claim())
+
+        self.store.read.side_effect = None
+        self.store.read.return_value = make_items(('1', {}))
+        self.store.write.side_effect = etcd.EtcdAlreadyExist
+        self.assertIsNone(self.queue.claim())
+
+    def claimed_by(self, owner):
+        """
+        Returns a read result holding one job claimed by owner.
+        """
+        items = make_items(('1', {'a': 1}))
+        items.leaves.append(mock.MagicMock(
+            key='/commissaire/jobs/test/claims/1', value=owner, dir=False))
+        return items
+
+    def test_claim_hands_off(self):
+        """
+        Verify jobs claimed by workers which left are taken over.
+        """
+        self.queue.members = mock.MagicMock()
+        self.queue.members.members.return_value = ['worker1']
+        self.store.read.return_value = self.claimed_by('worker2')
+        self.assertEquals('1', self.queue.claim().id)
+        self.store.delete.assert_called_once_with(
+            '/commissaire/jobs/test/claims/1', prevValue='worker2')
+
+    def test_claim_without_members(self):
+        """
+        Verify claims are left alone when no workers can be seen.
+        """
+        self.queue.members = mock.MagicMock()
+        self.queue.members.members.return_value = []
+        self.store.read.return_value = self.claimed_by('worker2')
+        self.assertIsNone(self.queue.claim())
+        self.assertEquals(0, self.store.delete.call_count)
+        self.assertEquals(0, self.store.write.call_count)
+
+    def test_get_waits(self):
+        """
+        Verify get watches the queue from the last seen index.
+        """
+        self.store.read.side_effect = [
+            make_items(), etcd.EtcdConnectionFailed, make_items(('1', {}))]
+        job = self.queue.get(timeout=1)
+        self.assertEquals('1', job.id)
+        self.store.read.assert_any_call(
+            '/commissaire/jobs/test', wait=True, recursive=True,
+            timeout=1, waitIndex=8)
+
+    def test_extend(self):
+        """
+        Verify claims are only extended while still held.
+        """
+        job = Job('/commissaire/jobs/test/items/1', {})
+        self.assertTrue(self.queue.extend(job))
+        self.store.write.assert_called_once_with(
+            '/commissaire/jobs/test/claims/1', 'worker1',
+            ttl=300, prevValue='worker1')
+
+        self.store.write.side_effect = etcd.EtcdCompareFailed
+        self.assertFalse(self.queue.extend(job))
+
+    def test_ack(self):
+        """
+        Verify finished jobs and their claims are removed.
+        """
+        job = Job('/commissaire/jobs/test/items/1', {})
+        self.store.delete.side_effect = [None, etcd.EtcdKeyNotFound]
+        self.queue.ack(job)
+        self.assertEquals(
+            [mock.call('/commissaire/jobs/test/items/1'),
+             mock.call('/commissaire/jobs/test/claims/1')],
+            self.store.delete.call_args_list)
+
+    def test_release(self):
+        """
+        Verify only our own claim is released.
+        """
+        job = Job('/commissaire/jobs/test/items/1', {})
+        self.queue.release(job)
+        self.store.delete.assert_called_once_with(
+            '/commissaire/jobs/test/claims/1', prevValue='worker1')
@@ -80,3 +80,22 @@ class Test_JobsClusterExec(TestCase):
                 self.assertEquals(1, store.get.call_count)
                 # We should have 4 sets for 1 host
                 self.assertEquals(3, store.set.call_count)
+
+    def test_clusterexec_releases_keys_on_error(self):
+        """
+        Verify key files are released when the command raises.
+        """
+        with mock.patch('commissaire.transport.ansibleapi.Transport') as _tp:
+            _tp().restart.side_effect = Exception('unreachable')
+
+            child = {'value': self.etcd_host}
+            store = etcd.Client()
+            store.get = MagicMock('get')
+            store.get.return_value = MagicMock(_children=[child])
+            store.set = MagicMock('set')
+
+            with mock.patch('commissaire.jobs.clusterexec.KEYS') as _keys:
+                _keys.acquire.return_value = '/tmp/key'
+                self.assertRaises(
+                    Exception, clusterexec, 'default', 'restart', store)
+                _keys.release.assert_called_once_with('/tmp/key')
@@ -0,0 +1,124 @@
+# Copyright (C) 2016  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Test cases for the commissaire.jobs.consumers module.
+"""
+
+import gevent
+import mock
+
+from . import TestCase
+from commissaire.jobqueue import Job
+from commissaire.jobs import consumers
+from commissaire.queues import LaneQueue, investigation_key
+from gevent.queue import Queue
+
+
+def make_job(job_id, address):
+    """
+    Returns an investigation job for an address.
+    """
+    return Job(
+        '/commissaire/jobs/investigate/items/{0}'.format(job_id),
+        {'host': {'address': address}, 'ssh_priv_key': 'dGVzdAo='})
+
+
+class Test_JobsConsumers(TestCase):
+    """
+    Tests for the durable queue consumers.
+    """
+
+    def test_investigations(self):
+        """
+        Verify claimed jobs are queued and acknowledged once done.
+        """
+        q = LaneQueue(key=investigation_key)
+        job = make_job('1', '10.2.0.2')
+        with mock.patch('commissaire.jobs.consumers.EtcdQueue') as _eq:
+            _eq().get.return_value = job
+            consumers.investigations(mock.MagicMock(), q, run_once=True)
+            entry = q.get()
+            self.assertEquals(
+                ({'address': '10.2.0.2'}, 'dGVzdAo='), entry)
+            self.assertEquals(0, _eq().ack.call_count)
+            q.done(entry)
+            _eq().ack.assert_called_once_with(job)
+
+    def test_investigations_requeued(self):
+        """
+        Verify the newest job for a host is kept while its entry waits in
+        the queue again.
+        """
+        q = LaneQueue(key=investigation_key)
+        claims = Queue()
+        jobs = [make_job('1', '10.2.0.2'), make_job('2', '10.2.0.2')]
+        with mock.patch('commissaire.jobs.consumers.EtcdQueue') as _eq:
+            _eq().get.side_effect = lambda: claims.get()
+            consumer = gevent.spawn(
+                consumers.investigations, mock.MagicMock(), q)
+            claims.put(jobs[0])
+            entry = q.get()
+            # Claimed again while the investigation is running
+            claims.put(jobs[1])
+            gevent.sleep(0)
+            q.done(entry)
+            _eq().ack.assert_called_once_with(jobs[0])
+            q.done(q.get())
+            _eq().ack.assert_called_with(jobs[1])
+            consumer.kill()
+
+    def test_investigations_owned(self):
+        """
+        Verify only jobs for hosts owned by this worker are claimed.
+        """
+        q = LaneQueue(key=investigation_key)
+        members = mock.MagicMock()
+        members.owns.side_effect = lambda address: address == '10.2.0.2'
+        with mock.patch('commissaire.jobs.consumers.EtcdQueue') as _eq:
+            _eq.return_value.get.return_value = make_job('1', '10.2.0.2')
+            consumers.investigations(
+                mock.MagicMock(), q, members=members, run_once=True)
+            accept = _eq.call_args[1]['accept']
+        self.assertTrue(accept(make_job('1', '10.2.0.2').payload))
+        self.assertFalse(accept(make_job('2', '10.2.0.3').payload))
+
+    def test_run_operation(self):
+        """
+        Verify operations are acknowledged even if they fail.
+        """
+        jobs = mock.MagicMock()
+        job = Job('/commissaire/jobs/clusterexec/items/1',
+                  {'cluster': 'development', 'command': 'restart'})
+        store = mock.MagicMock()
+        with mock.patch('commissaire.jobs.consumers.clusterexec') as _ce:
+            _ce.side_effect = Exception('failed')
+            consumers.run_operation(jobs, job, store)
+            _ce.assert_called_once_with('development', 'restart', store)
+        jobs.ack.assert_called_once_with(job)
+
+    def test_operations(self):
+        """
+        Verify operations are only claimed when the pool has room.
+        """
+        job = Job('/commissaire/jobs/clusterexec/items/1',
+                  {'cluster': 'development', 'command': 'upgrade'})
+        pool = mock.MagicMock()
+        with mock.patch('commissaire.jobs.consumers.EtcdQueue') as _eq, \
+                mock.patch.dict(consumers.POOLS, {'clusterexecpool': pool}):
+            _eq().get.return_value = job
+            consumers.operations(mock.MagicMock(), run_once=True)
+            pool.wait_available.assert_called_once_with()
+            pool.spawn.assert_called_once_with(
+                consumers.run_operation, _eq(), job, mock.ANY)
@@ -0,0 +1,110 @@
+# Copyright (C) 2016  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Test cases for the commissaire.jobs.deregister module.
+"""
+
+import etcd
+import gevent
+import mock
+
+from . import TestCase
+from commissaire.jobs.deregister import deregister
+from gevent.queue import Queue
+from mock import MagicMock
+
+
+class Test_JobsDeregister(TestCase):
+    """
+    Tests for the deregister job.
+    """
+
+    def make_store(self, *addresses):
+        """
+        Returns a store holding hosts with the given addresses.
+        """
+        keys = ['/commissaire/hosts/{0}'.format(x) for x in addresses]
+
+        def get(key):
+            if key not in keys:
+                raise etcd.EtcdKeyNotFound
+            return MagicMock(key=key)
+
+        store = etcd.Client()
+        store.get = MagicMock(side_effect=get)
+        return store
+
+    def test_deregister_batches(self):
+        """
+        Verify queued nodes are removed together and duplicates dropped.
+        """
+        q = Queue()
+        for address in ('10.2.0.2', '10.2.0.3', '10.2.0.2', '10.2.0.4'):
+            q.put(address)
+        with mock.patch(
+                'commissaire.jobs.deregister.get_container_manager') as _gcm:
+            _gcm().remove_node.return_value = True
+            deregister(q, {}, self.make_store(), run_once=True)
+
+            self.assertEquals(
+                ['10.2.0.2', '10.2.0.3', '10.2.0.4'],
+                sorted(x[0][0] for x in _gcm().remove_node.call_args_list))
+        self.assertTrue(q.empty())
+
+    def test_deregister_batch_size(self):
+        """
+        Verify batches are limited to batch_size.
+        """
+        q = Queue()
+        for address in ('10.2.0.2', '10.2.0.3', '10.2.0.4'):
+            q.put(address)
+        with mock.patch(
+                'commissaire.jobs.deregister.get_container_manager') as _gcm:
+            _gcm().remove_node.return_value = True
+            deregister(
+                q, {}, self.make_store(), batch_size=2, run_once=True)
+            self.assertEquals(2, _gcm().remove_node.call_count)
+        self.assertEquals(1, q.qsize())
+
+    def test_deregister_retries(self):
+        """
+        Verify failed removals are queued again after a delay.
+        """
+        q = Queue()
+        q.put('10.2.0.2')
+        with mock.patch(
+                'commissaire.jobs.deregister.get_container_manager') as _gcm:
+            _gcm().remove_node.side_effect = Exception('down')
+            deregister(
+                q, {}, self.make_store(), retry_delay=0, run_once=True)
+            gevent.sleep(0)
+            self.assertEquals('10.2.0.2', q.get(timeout=1))
+
+    def test_deregister_skips_readded_hosts(self):
+        """
+        Verify hosts added again before a retry stay registered.
+        """
+        q = Queue()
+        q.put('10.2.0.2')
+        q.put('10.2.0.3')
+        with mock.patch(
+                'commissaire.jobs.deregister.get_container_manager') as _gcm:
+            _gcm().remove_node.return_value = True
+            deregister(
+                q, {}, self.make_store('10.2.0.2'), retry_delay=0,
+                run_once=True)
+            _gcm().remove_node.assert_called_once_with('10.2.0.3')
+        gevent.sleep(0)
+        self.assertTrue(q.empty())
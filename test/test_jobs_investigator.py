@@ -16,34 +16,20 @@
 Test cases for the commissaire.jobs.investigator module.
 """
 
+import json
+
 import etcd
 import mock
-import os
 
 from . import TestCase
 from commissaire.compat.urlparser import urlparse
 
-from commissaire.jobs.investigator import clean_up_key, investigator
-from gevent.queue import Queue
+from commissaire.jobs.investigator import investigator
+from commissaire.queues import LaneQueue, investigation_key
+from commissaire.transport.keys import KEYS
 from mock import MagicMock
 
 
-class Test_CleanUpKey(TestCase):
-    """
-    Tests for clean_up_key function.
-    """
-
-    def test_clean_up_key(self):
-        """
-        Verify clean_up_key removes a given file.
-        """
-        f = open('clean_up_key_test_file', 'w')
-        f.close()
-        self.assertTrue(os.stat(f.name))
-        clean_up_key(f.name)
-        self.assertRaises(OSError, os.stat, f.name)
-
-
 class Test_JobsInvestigator(TestCase):
     """
     Tests for the investigator job.
@@ -69,7 +55,7 @@ class Test_JobsInvestigator(TestCase):
                 }
             )
 
-            q = Queue()
+            q = LaneQueue(key=investigation_key)
             client = etcd.Client()
             client.get = MagicMock('get')
             client.get.return_value = MagicMock(value=self.etcd_host)
@@ -96,3 +82,121 @@ class Test_JobsInvestigator(TestCase):
 
             self.assertEquals(1, client.get.call_count)
             self.assertEquals(2, client.set.call_count)
+            # The key file should have been released
+            self.assertEquals(0, KEYS.in_use())
+            # and the host should no longer be in progress
+            q.put(({'address': '10.0.0.2'}, ssh_priv_key))
+            self.assertEquals(1, q.qsize())
+
+    def test_investigator_refresh(self):
+        """
+        Verify a refresh only updates facts and last_check.
+        """
+        with mock.patch('commissaire.transport.ansibleapi.Transport') as _tp:
+            _tp().get_info.return_value = (0, {'cpus': 4})
+
+            q = LaneQueue(key=investigation_key)
+            host = MagicMock(
+                value=self.etcd_host.replace('available', 'active'),
+                modifiedIndex=7)
+            client = etcd.Client()
+            client.get = MagicMock('get')
+            client.get.return_value = host
+            client.set = MagicMock('set')
+            client.write = MagicMock('write')
+
+            q.put_nowait(({'address': '10.2.0.2', 'refresh': True},
+                          'dGVzdAo='))
+            investigator(q, {}, client, True)
+
+            self.assertEquals(0, _tp().bootstrap.call_count)
+            self.assertEquals(0, client.set.call_count)
+            key, value = client.write.call_args[0]
+            self.assertEquals('/commissaire/hosts/10.2.0.2', key)
+            self.assertEquals(
+                {'prevIndex': 7}, client.write.call_args[1])
+            data = json.loads(value)
+            self.assertEquals('active', data['status'])
+            self.assertEquals(4, data['cpus'])
+            self.assertNotEquals(
+                '2015-12-17T15:48:18.710454', data['last_check'])
+            self.assertEquals(0, KEYS.in_use())
+
+    def test_investigator_refresh_changed(self):
+        """
+        Verify a refresh re-reads a host changed while it was written.
+        """
+        with mock.patch('commissaire.transport.ansibleapi.Transport') as _tp:
+            _tp().get_info.return_value = (0, {'cpus': 4})
+
+            q = LaneQueue(key=investigation_key)
+            client = etcd.Client()
+            client.get = MagicMock('get')
+            client.get.side_effect = [
+                MagicMock(value=self.etcd_host.replace(
+                    'available', 'active'), modifiedIndex=7),
+                MagicMock(value=self.etcd_host.replace(
+                    'available', 'active'), modifiedIndex=7),
+                MagicMock(value=self.etcd_host.replace(
+                    'available', 'inactive'), modifiedIndex=8),
+            ]
+            client.write = MagicMock('write')
+            client.write.side_effect = [etcd.EtcdCompareFailed, None]
+
+            q.put_nowait(({'address': '10.2.0.2', 'refresh': True},
+                          'dGVzdAo='))
+            investigator(q, {}, client, True)
+
+            self.assertEquals(2, client.write.call_count)
+            self.assertEquals(
+                {'prevIndex': 8}, client.write.call_args[1])
+            # The status written by the reflector is kept
+            self.assertEquals(
+                'inactive',
+                json.loads(client.write.call_args[0][1])['status'])
+
+    def test_investigator_refresh_new_host(self):
+        """
+        Verify a refresh of a host which is not set up investigates it.
+        """
+        with mock.patch('commissaire.transport.ansibleapi.Transport') as _tp:
+            _tp().get_info.return_value = (0, {'os': 'fedora'})
+            _tp().bootstrap.return_value = (0, {})
+
+            q = LaneQueue(key=investigation_key)
+            client = etcd.Client()
+            client.get = MagicMock('get')
+            client.get.return_value = MagicMock(value=self.etcd_host)
+            client.set = MagicMock('set')
+            client.write = MagicMock('write')
+
+            q.put_nowait(({'address': '10.2.0.2', 'refresh': True},
+                          'dGVzdAo='))
+            with mock.patch(
+                    'commissaire.jobs.investigator.get_container_manager'):
+                investigator(q, {}, client, True)
+
+            self.assertEquals(1, _tp().bootstrap.call_count)
+            self.assertEquals(0, client.write.call_count)
+
+    def test_investigator_deleted_host(self):
+        """
+        Verify a host deleted before its job runs is skipped.
+        """
+        with mock.patch('commissaire.transport.ansibleapi.Transport') as _tp:
+            q = LaneQueue(key=investigation_key)
+            client = etcd.Client()
+            client.get = MagicMock('get')
+            client.get.side_effect = etcd.EtcdKeyNotFound
+            client.set = MagicMock('set')
+
+            q.put_nowait(({'address': '10.2.0.2'}, 'dGVzdAo='))
+            investigator(q, {}, client, True)
+
+            self.assertEquals(0, _tp().get_info.call_count)
+            self.assertEquals(0, client.set.call_count)
+            # The key file should have been released
+            self.assertEquals(0, KEYS.in_use())
+            # and the host should no longer be in progress
+            q.put(({'address': '10.2.0.2'}, 'dGVzdAo='))
+            self.assertEquals(1, q.qsize())
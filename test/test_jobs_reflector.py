@@ -0,0 +1,164 @@
+# Copyright (C) 2016  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Test cases for the commissaire.jobs.reflector module.
+"""
+
+import json
+
+import etcd
+import mock
+
+from . import TestCase
+from commissaire.jobs.reflector import (
+    apply_statuses, changed_statuses, node_status, reflector)
+from mock import MagicMock
+
+
+def make_node(name, ready):
+    """
+    Returns a node object with a Ready condition.
+    """
+    return {
+        'metadata': {'name': name},
+        'status': {
+            'conditions': [
+                {'type': 'OutOfDisk', 'status': 'False'},
+                {'type': 'Ready', 'status': ready},
+            ],
+        },
+    }
+
+
+class Test_JobsReflector(TestCase):
+    """
+    Tests for the reflector job.
+    """
+
+    def make_store(self, *hosts):
+        """
+        Returns a store holding the given (address, status) hosts.
+        """
+        records = {}
+        for index, (address, status) in enumerate(hosts):
+            key = '/commissaire/hosts/{0}'.format(address)
+            records[key] = MagicMock(
+                key=key,
+                value=json.dumps({'address': address, 'status': status}),
+                modifiedIndex=index)
+
+        def get(key):
+            if key not in records:
+                raise etcd.EtcdKeyNotFound
+            return records[key]
+
+        store = etcd.Client()
+        store.get = MagicMock(side_effect=get)
+        store.write = MagicMock()
+        return store
+
+    def test_node_status(self):
+        """
+        Verify node readiness maps to host statuses.
+        """
+        self.assertEquals(
+            'active', node_status('ADDED', make_node('a', 'True')))
+        self.assertEquals(
+            'inactive', node_status('MODIFIED', make_node('a', 'False')))
+        self.assertEquals(
+            'inactive', node_status('MODIFIED', make_node('a', 'Unknown')))
+        self.assertEquals(
+            'inactive', node_status('DELETED', make_node('a', 'True')))
+        self.assertEquals(
+            'inactive', node_status('ADDED', {'metadata': {'name': 'a'}}))
+
+    def test_apply_statuses(self):
+        """
+        Verify only changed hosts past bootstrapping are written.
+        """
+        store = self.make_store(
+            ('10.2.0.2', 'active'),
+            ('10.2.0.3', 'inactive'),
+            ('10.2.0.4', 'bootstrapping'),
+            ('10.2.0.5', 'active'),
+            ('10.2.0.6', 'active'))
+        updated = apply_statuses(store, {
+            '10.2.0.2': 'inactive',
+            '10.2.0.3': 'active',
+            '10.2.0.4': 'active',
+            '10.2.0.5': 'active',
+        })
+        self.assertEquals(['10.2.0.2', '10.2.0.3'], sorted(updated))
+        # Hosts without node events are never read
+        self.assertEquals(
+            ['/commissaire/hosts/10.2.0.{0}'.format(x) for x in range(2, 6)],
+            sorted([x[0][0] for x in store.get.call_args_list]))
+        self.assertEquals(2, store.write.call_count)
+        store.write.assert_any_call(
+            '/commissaire/hosts/10.2.0.2',
+            json.dumps({'address': '10.2.0.2', 'status': 'inactive'}),
+            prevIndex=0)
+
+    def test_apply_statuses_skips_changed_hosts(self):
+        """
+        Verify hosts changed since they were read are left alone.
+        """
+        store = self.make_store(('10.2.0.2', 'active'))
+        store.write.side_effect = etcd.EtcdCompareFailed
+        self.assertEquals([], apply_statuses(store, {'10.2.0.2': 'inactive'}))
+
+    def test_apply_statuses_without_hosts(self):
+        """
+        Verify nodes which are not commissaire hosts are skipped.
+        """
+        store = self.make_store()
+        self.assertEquals([], apply_statuses(store, {'10.2.0.2': 'active'}))
+        self.assertEquals(0, store.write.call_count)
+
+    def test_changed_statuses(self):
+        """
+        Verify only readiness changes are passed on.
+        """
+        known = {}
+        self.assertEquals({'10.2.0.2': 'inactive'}, changed_statuses(known, [
+            ('ADDED', make_node('10.2.0.2', 'True')),
+            ('MODIFIED', make_node('10.2.0.2', 'False'))]))
+        # Heartbeats do not change readiness
+        self.assertEquals({}, changed_statuses(known, [
+            ('MODIFIED', make_node('10.2.0.2', 'False')),
+            ('MODIFIED', make_node('10.2.0.2', 'False'))]))
+        self.assertEquals({'10.2.0.2': 'active'}, changed_statuses(known, [
+            ('MODIFIED', make_node('10.2.0.2', 'True'))]))
+        self.assertEquals({'10.2.0.2': 'active'}, known)
+
+    def test_reflector(self):
+        """
+        Verify the reflector applies the latest event for each node.
+        """
+        store = self.make_store(('10.2.0.2', 'active'))
+        with mock.patch(
+                'commissaire.jobs.reflector.get_container_manager') as _gcm:
+            def watch():
+                listener = _gcm().add_listener.call_args[0][0]
+                listener('ADDED', make_node('10.2.0.2', 'True'))
+                listener('MODIFIED', make_node('10.2.0.2', 'False'))
+
+            _gcm().watch.side_effect = watch
+            reflector({}, store, interval=0, run_once=True)
+
+        self.assertEquals(1, store.write.call_count)
+        self.assertEquals(
+            'inactive',
+            json.loads(store.write.call_args[0][1])['status'])
@@ -0,0 +1,261 @@
+# Copyright (C) 2016  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Test cases for the commissaire.jobs.scheduler module.
+"""
+
+import json
+
+import etcd
+import mock
+
+from . import TestCase
+from commissaire.events import Event, EventBus
+from commissaire.jobs.scheduler import Scheduler, _timestamp, scheduler
+from commissaire.queues import LaneQueue
+from mock import MagicMock
+
+
+class Test_Scheduler(TestCase):
+    """
+    Tests for the Scheduler class.
+    """
+
+    #: 2016-01-01T00:00:00 in seconds since the epoch
+    now = 1451606400.0
+
+    def make_store(self, *hosts):
+        """
+        Returns a store holding the given host records.
+        """
+        leaves = [MagicMock(value=json.dumps(x)) for x in hosts]
+        by_key = dict(
+            ('/commissaire/hosts/{0}'.format(x['address']),
+             MagicMock(value=json.dumps(x))) for x in hosts)
+
+        def get(key):
+            if key == '/commissaire/hosts/':
+                return MagicMock(_children=leaves, leaves=leaves)
+            if key not in by_key:
+                raise etcd.EtcdKeyNotFound
+            return by_key[key]
+
+        store = etcd.Client()
+        store.get = MagicMock(side_effect=get)
+        return store
+
+    def host(self, address, status='active',
+             last_check='2016-01-01T00:00:00.000000'):
+        return {
+            'address': address, 'status': status,
+            'last_check': last_check, 'ssh_priv_key': 'dGVzdAo='}
+
+    def test_timestamp(self):
+        """
+        Verify last_check values are converted to epoch seconds.
+        """
+        self.assertEquals(
+            self.now, _timestamp('2016-01-01T00:00:00.000000'))
+        self.assertEquals(0, _timestamp(None))
+        self.assertEquals(0, _timestamp('garbage'))
+
+    def test_next_due(self):
+        """
+        Verify due times follow last_check, status and jitter.
+        """
+        schedule = Scheduler(LaneQueue(), None, interval=100, jitter=0.1)
+        due = schedule.next_due(self.host('a'), self.now)
+        self.assertTrue(self.now + 90 <= due <= self.now + 110)
+        due = schedule.next_due(self.host('a', 'failed'), self.now)
+        self.assertTrue(self.now + 22.5 <= due <= self.now + 27.5)
+        # Hosts being worked on are not scheduled
+        self.assertEquals(
+            None, schedule.next_due(self.host('a', 'investigating')))
+        # Overdue hosts are spread over the jitter window
+        due = schedule.next_due(self.host('a', last_check=None), self.now)
+        self.assertTrue(self.now <= due <= self.now + 11)
+
+    def test_pop_due(self):
+        """
+        Verify hosts pop in due order, limited and without stale entries.
+        """
+        schedule = Scheduler(LaneQueue(), None)
+        schedule.schedule('a', 3)
+        schedule.schedule('b', 1)
+        schedule.schedule('c', 2)
+        schedule.schedule('c', 10)
+        schedule.schedule('d', 4)
+        schedule.remove('d')
+        self.assertEquals(['b'], schedule.pop_due(5, 1))
+        self.assertEquals(['a'], schedule.pop_due(5, 10))
+        self.assertEquals([], schedule.pop_due(5, 10))
+        self.assertEquals(['c'], schedule.pop_due(10, 10))
+        self.assertEquals(0, len(schedule))
+
+    def test_tick(self):
+        """
+        Verify due hosts are queued at the rate and rescheduled.
+        """
+        q = LaneQueue()
+        store = self.make_store(
+            self.host('10.2.0.2'), self.host('10.2.0.3'),
+            self.host('10.2.0.4', 'bootstrapping'))
+        schedule = Scheduler(q, store, interval=100, rate=1)
+        schedule.schedule('10.2.0.2', self.now)
+        schedule.schedule('10.2.0.3', self.now)
+        schedule.schedule('10.2.0.4', self.now - 1)
+        schedule.schedule('10.2.0.5', self.now - 2)
+
+        # Deleted and busy hosts are not queued
+        self.assertEquals([], schedule.tick(self.now))
+        self.assertEquals([], schedule.tick(self.now))
+        self.assertEquals(['10.2.0.2'], schedule.tick(self.now))
+        self.assertEquals(
+            ({'address': '10.2.0.2', 'refresh': True}, 'dGVzdAo='), q.get())
+        self.assertEquals(['10.2.0.3'], schedule.tick(self.now))
+        self.assertEquals(['10.2.0.3'], [q.get()[0]['address']])
+        self.assertTrue(q.empty())
+        # The deleted host fell out. The rest are scheduled again.
+        self.assertEquals(3, len(schedule))
+
+    def test_tick_lanes(self):
+        """
+        Verify failing hosts are retried ahead of background refreshes.
+        """
+        q = LaneQueue()
+        store = self.make_store(
+            self.host('10.2.0.2'), self.host('10.2.0.3', 'failed'))
+        schedule = Scheduler(q, store)
+        schedule.schedule('10.2.0.2', self.now)
+        schedule.schedule('10.2.0.3', self.now)
+        schedule.tick(self.now)
+        self.assertEquals(
+            {'interactive': 0, 'retry': 1, 'background': 1}, q.depth())
+        # Both are scheduled again for after their investigation
+        self.assertEquals(2, len(schedule))
+        # Only the failed host is set up again from scratch
+        self.assertEquals({'address': '10.2.0.3'}, q.get()[0])
+        self.assertEquals(
+            {'address': '10.2.0.2', 'refresh': True}, q.get()[0])
+
+    def test_owned_hosts(self):
+        """
+        Verify only hosts owned by this worker are scheduled and queued.
+        """
+        q = LaneQueue()
+        store = self.make_store(self.host('10.2.0.2'), self.host('10.2.0.3'))
+        members = MagicMock()
+        members.owns.side_effect = lambda address: address == '10.2.0.2'
+        schedule = Scheduler(q, store, members=members)
+        schedule.load(self.now)
+        self.assertEquals(1, len(schedule))
+        # 10.2.0.2 moves to another worker after being scheduled
+        members.owns.side_effect = lambda address: False
+        self.assertEquals([], schedule.tick(self.now + 3600 * 2))
+        self.assertEquals(0, len(schedule))
+
+    def test_scheduler(self):
+        """
+        Verify the scheduler job loads hosts and queues overdue ones.
+        """
+        q = LaneQueue()
+        store = self.make_store(
+            self.host('10.2.0.2', last_check='2015-01-01T00:00:00.000000'),
+            self.host('10.2.0.3', 'investigating'))
+        scheduler(q, store, jitter=0, run_once=True)
+        self.assertEquals('10.2.0.2', q.get(timeout=1)[0]['address'])
+        self.assertTrue(q.empty())
+
+    def test_apply(self):
+        """
+        Verify host changes reschedule or remove hosts.
+        """
+        schedule = Scheduler(LaneQueue(), self.make_store(), jitter=0)
+        key = '/commissaire/hosts/10.2.0.2'
+        schedule.apply(Event('set', key, 2, json.dumps(self.host(
+            '10.2.0.2', last_check='2016-01-01T00:00:00.000000'))), self.now)
+        self.assertEquals(self.now + 3600, schedule._due['10.2.0.2'])
+        # Busy hosts keep their schedule
+        schedule.apply(Event('set', key, 3, json.dumps(
+            self.host('10.2.0.2', 'investigating'))), self.now)
+        self.assertEquals(self.now + 3600, schedule._due['10.2.0.2'])
+        schedule.apply(Event('delete', key, 4, None, json.dumps(
+            self.host('10.2.0.2'))), self.now)
+        self.assertEquals(0, len(schedule))
+
+    def test_scheduler_events(self):
+        """
+        Verify the scheduler follows host changes from the event bus.
+        """
+        q = LaneQueue()
+        bus = EventBus()
+        subscribe = bus.subscribe
+
+        def subscribed(**kwargs):
+            subscription = subscribe(**kwargs)
+            # Added after the hosts were loaded
+            bus.publish(Event(
+                'set', '/commissaire/hosts/10.2.0.2', 2, json.dumps(
+                    self.host('10.2.0.2',
+                              last_check='2015-01-01T00:00:00.000000'))))
+            return subscription
+
+        bus.subscribe = subscribed
+        store = self.make_store(
+            self.host('10.2.0.2', last_check='2015-01-01T00:00:00.000000'))
+        get = store.get.side_effect
+
+        def unlisted(key):
+            if key == '/commissaire/hosts/':
+                raise etcd.EtcdKeyNotFound
+            return get(key)
+
+        store.get.side_effect = unlisted
+        scheduler(q, store, jitter=0, events=bus, run_once=True)
+        self.assertEquals('10.2.0.2', q.get(timeout=1)[0]['address'])
+        self.assertEquals([], bus._subscriptions)
+
+    def test_scheduler_events_skip_reloads(self):
+        """
+        Verify with events hosts are only reloaded when the ring changes.
+        """
+        class Stop(Exception):
+            pass
+
+        store = self.make_store(self.host('10.2.0.2'))
+        members = MagicMock(ring=object())
+        members.owns.return_value = True
+        slept = []
+
+        def sleep(seconds):
+            slept.append(seconds)
+            if len(slept) == 3:
+                # A worker joined or left
+                members.ring = object()
+            elif len(slept) == 6:
+                raise Stop()
+
+        with mock.patch('commissaire.jobs.scheduler.time') as _time:
+            # Two minutes pass between loops
+            _time.time.side_effect = lambda: self.now + 120 * len(slept)
+            with mock.patch('commissaire.jobs.scheduler.gevent') as _gevent:
+                _gevent.sleep.side_effect = sleep
+                self.assertRaises(
+                    Stop, scheduler, LaneQueue(), store, jitter=0,
+                    members=members, events=EventBus())
+
+        loads = [x for x in store.get.call_args_list
+                 if x[0][0] == '/commissaire/hosts/']
+        self.assertEquals(2, len(loads))
@@ -0,0 +1,241 @@
+# Copyright (C) 2016  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Test cases for the commissaire.membership module.
+"""
+
+import os
+import sys
+
+import gevent
+
+from gevent import subprocess
+
+from . import TestCase
+from .etcdstub import EtcdStub, cooperative_sockets
+from commissaire.jobqueue import EtcdQueue, enqueue
+from commissaire.membership import HashRing, Membership
+
+
+#: A worker process draining the 'test' queue. Jobs asking it to crash
+#: make the first worker handling them exit without acknowledging.
+WORKER = [sys.executable, '-c', (
+    'from gevent.monkey import patch_all\n'
+    'patch_all()\n'
+    'import os, sys, etcd, gevent\n'
+    'from commissaire.jobqueue import EtcdQueue\n'
+    'from commissaire.membership import HashRing, Membership\n'
+    'store = etcd.Client(port=int(sys.argv[1]))\n'
+    'members = Membership(store, sys.argv[2], ttl=2)\n'
+    'members.register()\n'
+    'gevent.spawn(members.heartbeat)\n'
+    'jobs = EtcdQueue(store, "test", owner=sys.argv[2], members=members)\n'
+    'while True:\n'
+    '    job = jobs.get(timeout=0.5)\n'
+    '    handled = "/handled/" + job.id\n'
+    '    store.write(handled, sys.argv[2], append=True)\n'
+    '    if job.payload.get("crash"):\n'
+    '        if len(store.read(handled)._children) == 1:\n'
+    '            os._exit(1)\n'
+    '    jobs.ack(job)\n'
+)]
+
+
+class Test_HashRing(TestCase):
+    """
+    Tests for the HashRing class.
+    """
+
+    def test_owner(self):
+        """
+        Verify keys are spread over all members.
+        """
+        self.assertEquals(None, HashRing([]).owner('10.2.0.2'))
+        ring = HashRing(['a', 'b', 'c', 'd'])
+        owners = [ring.owner('10.2.{0}.{1}'.format(x // 250, x % 250))
+                  for x in range(1000)]
+        for member in ('a', 'b', 'c', 'd'):
+            # Roughly a quarter each
+            self.assertTrue(150 < owners.count(member) < 350)
+        # The order members are given in does not matter
+        self.assertEquals(
+            owners[0], HashRing(['d', 'c', 'b', 'a']).owner('10.2.0.0'))
+
+    def test_minimal_reassignment(self):
+        """
+        Verify only keys of a leaving member or taken by a joining member
+        move.
+        """
+        keys = ['10.2.{0}.{1}'.format(x // 250, x % 250) for x in range(1000)]
+        before = HashRing(['a', 'b', 'c', 'd'])
+        joined = HashRing(['a', 'b', 'c', 'd', 'e'])
+        left = HashRing(['a', 'b', 'c'])
+        moved = 0
+        for key in keys:
+            if before.owner(key) != joined.owner(key):
+                self.assertEquals('e', joined.owner(key))
+                moved += 1
+            if before.owner(key) != 'd':
+                self.assertEquals(before.owner(key), left.owner(key))
+        self.assertTrue(100 < moved < 300)
+
+
+class Test_Membership(TestCase):
+    """
+    Tests for the Membership class.
+    """
+
+    def before(self):
+        """
+        Starts a local etcd stand-in.
+        """
+        self.sockets = cooperative_sockets()
+        self.sockets.start()
+        self.etcd = EtcdStub()
+        self.etcd.start()
+        self.store = self.etcd.client()
+
+    def after(self):
+        """
+        Stops the etcd stand-in.
+        """
+        self.etcd.stop()
+        self.sockets.stop()
+
+    def test_members(self):
+        """
+        Verify registered workers are members until they leave.
+        """
+        self.assertEquals([], Membership(self.store, 'a').members())
+        a = Membership(self.store, 'a')
+        b = Membership(self.store, 'b')
+        b.register()
+        a.register()
+        self.assertEquals(['a', 'b'], a.members())
+        b.leave()
+        self.assertEquals(['a'], a.members())
+
+    def test_lease_expires(self):
+        """
+        Verify workers drop out once their lease runs out.
+        """
+        a = Membership(self.store, 'a', ttl=1)
+        a.register()
+        gevent.sleep(1.2)
+        self.assertEquals([], a.members())
+        # Refreshing an expired lease registers again
+        a.refresh()
+        self.assertEquals(['a'], a.members())
+
+    def test_heartbeat(self):
+        """
+        Verify the heartbeat keeps the lease alive.
+        """
+        a = Membership(self.store, 'a', ttl=1)
+        a.register()
+        heartbeat = gevent.spawn(a.heartbeat)
+        gevent.sleep(1.5)
+        self.assertEquals(['a'], a.members())
+        heartbeat.kill()
+
+    def test_hand_off(self):
+        """
+        Verify claims of expired workers are handed off and claims of live
+        workers are not.
+        """
+        a = Membership(self.store, 'a', ttl=1)
+        b = Membership(self.store, 'b', ttl=1)
+        a.register()
+        b.register()
+        enqueue(self.store, 'test', {})
+        jobs_a = EtcdQueue(self.store, 'test', owner='a', members=a)
+        jobs_b = EtcdQueue(self.store, 'test', owner='b', members=b)
+        job = jobs_a.claim()
+        self.assertEquals(None, jobs_b.claim())
+        # a stops heartbeating
+        gevent.sleep(1.2)
+        b.refresh()
+        self.assertEquals(job.key, jobs_b.claim().key)
+        self.assertFalse(jobs_a.extend(job))
+        self.assertEquals(
+            'b', self.store.read(jobs_b._claim_key(job.id)).value)
+
+    def test_owns(self):
+        """
+        Verify every host is owned by exactly one registered worker.
+        """
+        workers = [Membership(self.store, x) for x in ('a', 'b', 'c')]
+        self.assertTrue(workers[0].owns('10.2.0.2'))
+        for worker in workers:
+            worker.register()
+        for worker in workers:
+            worker.update_ring()
+        for x in range(50):
+            address = '10.2.0.{0}'.format(x)
+            self.assertEquals(
+                1, len([w for w in workers if w.owns(address)]))
+
+    def test_accept(self):
+        """
+        Verify jobs are only claimed when accepted.
+        """
+        enqueue(self.store, 'test', {'address': '10.2.0.2'})
+        enqueue(self.store, 'test', {'address': '10.2.0.3'})
+        jobs = EtcdQueue(
+            self.store, 'test',
+            accept=lambda payload: payload['address'] == '10.2.0.3')
+        self.assertEquals({'address': '10.2.0.3'}, jobs.claim().payload)
+        self.assertEquals(None, jobs.claim())
+
+    def test_workers(self):
+        """
+        Verify several worker processes drain a queue, each job handled by
+        one worker, and jobs of a dead worker are handed to the others.
+        """
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        for x in range(20):
+            enqueue(self.store, 'test', {'crash': x == 5})
+        workers = [
+            subprocess.Popen(
+                WORKER + [str(self.etcd.port), 'worker{0}'.format(x)],
+                env=env)
+            for x in range(3)]
+        try:
+            with gevent.Timeout(30):
+                while True:
+                    items = self.store.read('/commissaire/jobs/test/items')
+                    if not items._children:
+                        break
+                    gevent.sleep(0.2)
+        finally:
+            for worker in workers:
+                if worker.poll() is None:
+                    worker.kill()
+                worker.wait()
+
+        handled = self.store.read('/handled', recursive=True)
+        owners = {}
+        for job in handled._children:
+            owners[job['key']] = [x['value'] for x in job['nodes']]
+        self.assertEquals(20, len(owners))
+        for owner in owners.values():
+            if len(owner) > 1:
+                # Only the crashed job is handled twice, by another worker
+                self.assertEquals(2, len(owner))
+                self.assertNotEqual(owner[0], owner[1])
+        self.assertEquals(1, len([x for x in owners.values() if len(x) > 1]))
+        # Only the worker handling the crashing job first went away
+        self.assertEquals(
+            1, len([x for x in workers if x.returncode == 1]))
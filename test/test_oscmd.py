@@ -53,6 +53,18 @@ class Test_OSCmdBase(_Test_OSCmd):
                 NotImplementedError,
                 getattr(self.instance, meth))
 
+    def test_oscmd_install_packages(self):
+        """
+        Verify OSCmdBase does not provide a combined install by default.
+        """
+        self.assertEquals(None, self.instance.install_packages())
+
+    def test_oscmd_is_noop(self):
+        """
+        Verify OSCmdBase has no no-op commands.
+        """
+        self.assertFalse(self.instance.is_noop(['true']))
+
 
 class Test_get_oscmd(TestCase):
 
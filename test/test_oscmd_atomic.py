@@ -37,6 +37,19 @@ class Test_Atomic_OSCmd(TestCase):
         """
         for meth in ('restart', 'upgrade', 'install_docker',
                      'start_docker', 'install_flannel', 'start_flannel',
-                     'install_kube', 'start_kube', 'start_kube_proxy'):
+                     'install_kube', 'start_kube', 'start_kube_proxy',
+                     'install_packages'):
             cmd = getattr(self.instance, meth)()
             self.assertEquals(list, type(cmd))
+
+    def test_atomic_oscmd_noop_commands(self):
+        """
+        Verify Atomic's install commands are no-ops.
+        """
+        for meth in ('install_docker', 'install_flannel', 'install_kube',
+                     'install_packages'):
+            self.assertTrue(
+                self.instance.is_noop(getattr(self.instance, meth)()))
+        for meth in ('restart', 'upgrade', 'start_docker'):
+            self.assertFalse(
+                self.instance.is_noop(getattr(self.instance, meth)()))
@@ -31,6 +31,6 @@ class Test_RHEL_OSCmd(_Test_OSCmd):
         """
         Verify RHEL's OSCmd returns proper data on restart.
         """
-        for meth in self.expected_methods:
+        for meth in self.expected_methods + ('install_packages',):
             cmd = getattr(self.instance, meth)()
             self.assertEquals(list, type(cmd))
@@ -0,0 +1,146 @@
+# Copyright (C) 2016  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Test cases for the commissaire.queues module.
+"""
+
+import gevent
+
+from . import TestCase
+from commissaire.queues import LaneQueue, investigation_key
+from gevent.queue import Empty
+
+
+class Test_LaneQueue(TestCase):
+    """
+    Tests for the LaneQueue class.
+    """
+
+    def before(self):
+        """
+        Sets up a fresh instance of the class before each run.
+        """
+        self.queue = LaneQueue()
+
+    def test_fifo_within_lane(self):
+        """
+        Verify a single lane behaves like a FIFO.
+        """
+        for x in range(0, 3):
+            self.queue.put(x)
+        self.assertEquals([0, 1, 2], [self.queue.get() for x in range(3)])
+        self.assertTrue(self.queue.empty())
+
+    def test_weighted_fair_dequeue(self):
+        """
+        Verify lanes are served by weight and none is starved.
+        """
+        for x in range(0, 7):
+            for lane in ('background', 'retry', 'interactive'):
+                self.queue.put(lane, lane=lane)
+        self.assertEquals(
+            {'interactive': 7, 'retry': 7, 'background': 7},
+            self.queue.depth())
+
+        served = [self.queue.get() for x in range(0, 7)]
+        self.assertEquals('interactive', served[0])
+        self.assertEquals(4, served.count('interactive'))
+        self.assertEquals(2, served.count('retry'))
+        self.assertEquals(1, served.count('background'))
+        self.assertEquals(14, self.queue.qsize())
+
+    def test_new_interactive_work_jumps_ahead(self):
+        """
+        Verify a new host is not stuck behind a bulk refresh.
+        """
+        for x in range(0, 100):
+            self.queue.put(x, lane='background')
+        self.queue.get()
+        self.queue.put('new')
+        self.assertEquals('new', self.queue.get())
+
+    def test_get_blocks(self):
+        """
+        Verify get waits for items and honors timeouts.
+        """
+        self.assertRaises(Empty, self.queue.get_nowait)
+        self.assertRaises(Empty, self.queue.get, timeout=0.01)
+        gevent.spawn_later(0.01, self.queue.put, 'late', 'retry')
+        self.assertEquals('late', self.queue.get(timeout=1))
+
+    def test_unknown_lane(self):
+        """
+        Verify unknown lanes are rejected.
+        """
+        self.assertRaises(KeyError, self.queue.put, 'x', 'missing')
+        self.assertTrue(self.queue.empty())
+
+
+class Test_LaneQueueKeyed(TestCase):
+    """
+    Tests for the deduplication of the LaneQueue class.
+    """
+
+    def before(self):
+        """
+        Sets up a fresh instance of the class before each run.
+        """
+        self.queue = LaneQueue(key=investigation_key)
+
+    def entry(self, address, key='a'):
+        return ({'address': address}, key)
+
+    def test_latest_pending_entry_wins(self):
+        """
+        Verify pending entries for the same address are merged.
+        """
+        self.queue.put(self.entry('10.2.0.2', 'old'))
+        self.queue.put(self.entry('10.2.0.3'))
+        self.queue.put(self.entry('10.2.0.2', 'new'))
+        self.assertEquals(2, self.queue.qsize())
+        self.assertEquals(self.entry('10.2.0.2', 'new'), self.queue.get())
+        self.assertEquals(self.entry('10.2.0.3'), self.queue.get())
+        self.assertTrue(self.queue.empty())
+
+    def test_merge_keeps_higher_lane(self):
+        """
+        Verify merged entries keep the higher priority lane.
+        """
+        self.queue.put(self.entry('10.2.0.2', 'old'), lane='background')
+        self.queue.put(self.entry('10.2.0.2', 'new'), lane='interactive')
+        self.queue.put(self.entry('10.2.0.2', 'newer'), lane='background')
+        self.assertEquals(
+            {'interactive': 1, 'retry': 0, 'background': 0},
+            self.queue.depth())
+        self.assertEquals(self.entry('10.2.0.2', 'newer'), self.queue.get())
+        self.assertTrue(self.queue.empty())
+        self.assertRaises(Empty, self.queue.get_nowait)
+
+    def test_in_progress_entries_are_parked(self):
+        """
+        Verify entries for hosts in progress wait until they are done.
+        """
+        self.queue.put(self.entry('10.2.0.2'))
+        running = self.queue.get()
+        self.queue.put(self.entry('10.2.0.2', 'first'))
+        self.queue.put(self.entry('10.2.0.2', 'second'))
+        self.assertTrue(self.queue.empty())
+        self.assertEquals(1, self.queue.parked())
+
+        self.queue.done(running)
+        self.assertEquals(0, self.queue.parked())
+        self.assertEquals(self.entry('10.2.0.2', 'second'), self.queue.get())
+        self.queue.done(self.entry('10.2.0.2'))
+        self.assertTrue(self.queue.empty())
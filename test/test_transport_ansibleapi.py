@@ -16,17 +16,23 @@
 Test cases for the commissaire.transport.ansibleapi module.
 """
 
+import gc
+import hashlib
 import logging
+import os
+import stat
+import tarfile
 
 from . import TestCase, get_fixture_file_path
 
 from ansible.executor.task_result import TaskResult
 from ansible.inventory import Host
+from ansible.module_utils import facts as module_facts
 from ansible.playbook.task import Task
 from commissaire.compat.urlparser import urlparse
 from commissaire.config import Config
 from commissaire.transport import ansibleapi
-from commissaire.oscmd import OSCmdBase
+from commissaire.oscmd import OSCmdBase, get_oscmd
 from mock import MagicMock, patch
 
 
@@ -98,18 +104,17 @@ class Test_Transport(TestCase):
             _tqm().run.return_value = 0
 
             transport = ansibleapi.Transport()
-            fact_cache = {
-                '10.2.0.2': {
-                    'ansible_distribution': 'Fedora',
-                    'ansible_processor_cores': 2,
-                    'ansible_memory_mb': {
-                        'real': {
-                            'total': 987654321,
-                        }
-                    },
-                    'ansible_mounts': [{'size_total': 123456789}],
+            host_facts = {
+                'ansible_distribution': 'Fedora',
+                'ansible_processor_cores': 2,
+                'ansible_memory_mb': {
+                    'real': {
+                        'total': 987654321,
+                    }
                 },
+                'ansible_mounts': [{'size_total': 123456789}],
             }
+            fact_cache = {'10.2.0.2': host_facts}
             transport.variable_manager._fact_cache = fact_cache
             result, facts = transport.get_info('10.2.0.2', get_fixture_file_path('test/fake_key'))
             # We should have a successful response
@@ -117,13 +122,78 @@ class Test_Transport(TestCase):
             # We should match the expected facts
             self.assertEquals(
                 {
-                    'os': fact_cache['10.2.0.2']['ansible_distribution'].lower(),
-                    'cpus': fact_cache['10.2.0.2']['ansible_processor_cores'],
-                    'memory': fact_cache['10.2.0.2']['ansible_memory_mb']['real']['total'],
-                    'space': fact_cache['10.2.0.2']['ansible_mounts'][0]['size_total'],
+                    'os': host_facts['ansible_distribution'].lower(),
+                    'cpus': host_facts['ansible_processor_cores'],
+                    'memory': host_facts['ansible_memory_mb']['real']['total'],
+                    'space': host_facts['ansible_mounts'][0]['size_total'],
                 },
                 facts
             )
+            # The facts are not kept once read
+            self.assertFalse('10.2.0.2' in fact_cache)
+
+    def test_get_info_fast(self):
+        """
+        Verify Transport().get_info with fast only gathers a fact subset.
+        """
+        with patch('commissaire.transport.ansibleapi.TaskQueueManager') as _tqm:
+            _tqm().run.return_value = 0
+
+            with patch('commissaire.transport.ansibleapi.Play') as _play:
+                transport = ansibleapi.Transport()
+                fact_cache = {
+                    '10.2.0.2': {
+                        'ansible_distribution': 'RedHat',
+                        'ansible_processor_cores': 2,
+                        'ansible_memory_mb': {
+                            'real': {
+                                'total': 987654321,
+                            }
+                        },
+                        'ansible_mounts': [
+                            {'size_total': 100}, {'size_total': 23}],
+                        'ansible_cmdline': {
+                            'BOOT_IMAGE': '/ostree/rhel-atomic-host-abc',
+                        },
+                    },
+                }
+                transport.variable_manager._fact_cache = fact_cache
+                result, facts = transport.get_info(
+                    '10.2.0.2', get_fixture_file_path('test/fake_key'),
+                    fast=True)
+
+                play_source = _play().load.call_args[0][0]
+                self.assertEquals(
+                    ansibleapi.Transport.FAST_GATHER_SUBSET,
+                    play_source['gather_subset'])
+                self.assertEquals('yes', play_source['gather_facts'])
+                # The facts must be the same as a full gather
+                self.assertEquals(0, result)
+                self.assertEquals(
+                    {
+                        'os': 'atomic',
+                        'cpus': 2,
+                        'memory': 987654321,
+                        'space': 123,
+                    },
+                    facts
+                )
+
+    def test_fast_gather_subset(self):
+        """
+        Verify Ansible's own subset handling keeps the hardware facts.
+        """
+        module = MagicMock(params={
+            'gather_subset': ansibleapi.Transport.FAST_GATHER_SUBSET.split(
+                ','),
+            'gather_timeout': 10,
+            'filter': '*',
+        })
+        with patch.object(module_facts, 'ansible_facts') as _ansible_facts:
+            _ansible_facts.return_value = {}
+            module_facts.get_all_facts(module)
+        self.assertEquals(
+            set(['hardware']), set(_ansible_facts.call_args[0][1]))
 
     def test_bootstrap(self):
         """
@@ -135,6 +205,13 @@ class Test_Transport(TestCase):
             transport = ansibleapi.Transport()
             transport.variable_manager._fact_cache = {}
             oscmd = MagicMock(OSCmdBase)
+            # Use the per package install commands
+            oscmd.install_packages.return_value = None
+            # Configs are bundled by their real destination paths
+            for attr in ('docker_config', 'flanneld_config',
+                         'kubernetes_config', 'kubernetes_kubeconfig',
+                         'kubelet_config'):
+                setattr(oscmd, attr, getattr(OSCmdBase, attr))
 
             config = Config(
                 etcd={
@@ -153,3 +230,456 @@ class Test_Transport(TestCase):
             # We should see expected calls
             self.assertEquals(1, oscmd.install_docker.call_count)
             self.assertEquals(1, oscmd.install_kube.call_count)
+
+    def bootstrap_tasks(self, transport, oscmd):
+        """
+        Returns the bootstrap tasks for an OSCmd on an unknown host.
+        """
+        configs = ansibleapi.TEMPLATES.render_files(
+            ('docker', 'flanneld', 'kubelet', 'kube_config', 'kubeconfig'),
+            Test_TemplateCache.tpl_vars)
+        archive = transport._mkarchive()
+        try:
+            return transport._bootstrap_tasks(oscmd, configs, None, archive)
+        finally:
+            os.unlink(archive)
+            ansibleapi.TEMPLATES.remove_files(configs)
+
+    def test_bootstrap_tasks_skip_noops(self):
+        """
+        Verify bootstrap leaves out no-op commands.
+        """
+        transport = ansibleapi.Transport()
+
+        def count_commands(oscmd):
+            tasks = self.bootstrap_tasks(transport, oscmd)
+            return len([
+                x for x in tasks if x['action']['module'] == 'command'])
+
+        self.assertEquals(0, count_commands(get_oscmd('atomic')()))
+        self.assertEquals(1, count_commands(get_oscmd('fedora')()))
+
+    def test_bootstrap_tasks_install_packages(self):
+        """
+        Verify bootstrap installs packages in one task when possible.
+        """
+        transport = ansibleapi.Transport()
+
+        tasks = self.bootstrap_tasks(transport, get_oscmd('rhel')())
+        self.assertEquals('Install Packages', tasks[0]['name'])
+        self.assertEquals(
+            'yum install -y flannel docker kubernetes-node',
+            tasks[0]['action']['args'])
+
+        # Fall back to one install per package
+        oscmd = get_oscmd('rhel')()
+        oscmd.install_packages = lambda: None
+        names = [x['name'] for x in self.bootstrap_tasks(transport, oscmd)]
+        for name in ('Install Flannel', 'Install Docker',
+                     'Install Kubernetes Node'):
+            self.assertTrue(name in names)
+        self.assertFalse('Install Packages' in names)
+
+    def test_bootstrap_skips_converged_steps(self):
+        """
+        Verify bootstrap only runs the steps which differ from the host.
+        """
+        transport = ansibleapi.Transport()
+        oscmd = get_oscmd('fedora')()
+        configs = ansibleapi.TEMPLATES.render_files(
+            ('docker', 'flanneld', 'kubelet', 'kube_config', 'kubeconfig'),
+            Test_TemplateCache.tpl_vars)
+
+        def digest(tpl_name):
+            with open(configs[tpl_name], 'rb') as f:
+                return hashlib.sha256(f.read()).hexdigest()
+
+        stdout = '\n'.join((
+            '#files',
+            '{0}  {1}'.format(digest('flanneld'), oscmd.flanneld_config),
+            '{0}  {1}'.format(digest('docker'), oscmd.docker_config),
+            '{0}  {1}'.format(digest('kube_config'), oscmd.kubernetes_config),
+            '{0}  {1}'.format(
+                digest('kubeconfig'), oscmd.kubernetes_kubeconfig),
+            '0000  {0}'.format(oscmd.kubelet_config),
+            '#packages',
+            'flannel',
+            'docker',
+            'kubernetes-node',
+            '#services',
+            'flanneld active enabled',
+            'docker active enabled',
+            'kubelet active enabled',
+            'kube-proxy inactive disabled'))
+        transport.executor.run = MagicMock(
+            return_value=(0, {}, [{'stdout': stdout}]))
+        state = transport._check_bootstrap(
+            '10.2.0.2', 'test/fake_key', oscmd)
+
+        archive = transport._mkarchive()
+        try:
+            tasks = transport._bootstrap_tasks(oscmd, configs, state, archive)
+            self.assertEquals(
+                ['Transfer Configuration', 'Install Configuration',
+                 'Enable and Start Kube Proxy'],
+                [x['name'] for x in tasks])
+            # Only the changed config is bundled
+            tar = tarfile.open(archive)
+            self.assertEquals(
+                [(oscmd.kubelet_config +
+                  transport.BUNDLE_SUFFIX).lstrip('/')],
+                tar.getnames())
+            tar.close()
+
+            # An unknown state means everything runs
+            transport.executor.run.return_value = (0, {}, [])
+            state = transport._check_bootstrap(
+                '10.2.0.2', 'test/fake_key', oscmd)
+            self.assertEquals(None, state)
+            self.assertEquals(7, len(transport._bootstrap_tasks(
+                oscmd, configs, state, archive)))
+        finally:
+            os.unlink(archive)
+            ansibleapi.TEMPLATES.remove_files(configs)
+
+    def test_bundle_configs(self):
+        """
+        Verify configs are bundled into one archive owned by root.
+        """
+        transport = ansibleapi.Transport()
+        archive = transport._mkarchive()
+        try:
+            unpack = transport._bundle_configs(archive, [
+                (get_fixture_file_path('test/fake_key'), '/etc/a', 0o644),
+                (get_fixture_file_path('test/fake_key'), '/var/lib/b',
+                 0o600)])
+            tar = tarfile.open(archive)
+            self.assertEquals(
+                [0o644, 0o600], [info.mode for info in tar.getmembers()])
+            for info in tar.getmembers():
+                self.assertEquals(0, info.uid)
+                self.assertEquals(0, info.gid)
+            self.assertEquals(
+                ['etc/a' + transport.BUNDLE_SUFFIX,
+                 'var/lib/b' + transport.BUNDLE_SUFFIX],
+                tar.getnames())
+            tar.close()
+            # Files are moved into place after unpacking
+            self.assertTrue(unpack.startswith('tar -xpf /tmp/'))
+            self.assertTrue(
+                'mv -f /etc/a{0} /etc/a'.format(
+                    transport.BUNDLE_SUFFIX) in unpack)
+        finally:
+            os.unlink(archive)
+
+    def test_bundle_configs_kubeconfig_private(self):
+        """
+        Verify the kubeconfig is bundled readable only by root.
+        """
+        transport = ansibleapi.Transport()
+        oscmd = get_oscmd('fedora')()
+        configs = ansibleapi.TEMPLATES.render_files(
+            ('docker', 'flanneld', 'kubelet', 'kube_config', 'kubeconfig'),
+            Test_TemplateCache.tpl_vars)
+        archive = transport._mkarchive()
+        try:
+            transport._bootstrap_tasks(oscmd, configs, None, archive)
+            tar = tarfile.open(archive)
+            modes = dict(
+                ('/' + info.name[:-len(transport.BUNDLE_SUFFIX)], info.mode)
+                for info in tar.getmembers())
+            tar.close()
+            self.assertEquals(0o600, modes[oscmd.kubernetes_kubeconfig])
+            self.assertEquals(0o644, modes[oscmd.docker_config])
+        finally:
+            os.unlink(archive)
+            ansibleapi.TEMPLATES.remove_files(configs)
+
+    def test_bootstrap_converged(self):
+        """
+        Verify bootstrap does not run a play on a converged host.
+        """
+        transport = ansibleapi.Transport()
+        transport._check_bootstrap = MagicMock(return_value={})
+        transport._bootstrap_tasks = MagicMock(return_value=[])
+        transport._run = MagicMock()
+        config = Config(
+            etcd={
+                'uri': urlparse('http://127.0.0.1:2379'),
+            },
+            kubernetes={
+                'uri': urlparse('http://127.0.0.1:8080'),
+                'token': 'token',
+            }
+        )
+
+        self.assertEquals((0, {}), transport.bootstrap(
+            '10.2.0.2', 'test/fake_key', config, get_oscmd('fedora')()))
+        self.assertEquals(0, transport._run.call_count)
+
+
+class Test_Executor(TestCase):
+    """
+    Tests for the long lived Executor.
+    """
+
+    play_source = {
+        'name': 'test',
+        'hosts': '10.2.0.2',
+        'gather_facts': 'no',
+        'tasks': [],
+    }
+
+    def assertNotCached(self, executor, ip):
+        """
+        Asserts an Executor holds no inventory entry, variable or fact
+        for a host.
+        """
+        self.assertFalse(ip in executor.inventory.groups)
+        for group in executor.inventory.groups.values():
+            self.assertFalse(ip in [x.name for x in group.get_hosts()])
+        for name in ('_hosts_cache', '_vars_per_host'):
+            self.assertFalse(ip in getattr(executor.inventory, name, {}))
+        for name in (
+                '_fact_cache', '_nonpersistent_fact_cache', '_vars_cache'):
+            self.assertFalse(
+                ip in getattr(executor.variable_manager, name, {}))
+
+    def test_executor_reuses_task_queue_manager(self):
+        """
+        Verify the Executor keeps one TaskQueueManager between plays.
+        """
+        with patch('commissaire.transport.ansibleapi.TaskQueueManager') as _tqm:
+            _tqm.return_value.run.return_value = 0
+            _tqm.reset_mock()
+
+            executor = ansibleapi.Executor()
+            members = []
+
+            def run(play):
+                members.append([
+                    x.name for x in
+                    executor.inventory.groups['10.2.0.2'].get_hosts()])
+                return 0
+
+            _tqm.return_value.run.side_effect = run
+            for x in range(0, 3):
+                result, facts, task_results = executor.run(
+                    '10.2.0.2', 'test/fake_key', self.play_source)
+                self.assertEquals(0, result)
+                self.assertEquals({}, facts)
+                self.assertEquals([], task_results)
+
+            self.assertEquals(1, _tqm.call_count)
+            self.assertEquals(3, _tqm.return_value.run.call_count)
+            self.assertEquals(0, _tqm.return_value.cleanup.call_count)
+            # The host is alone in its own group while its play runs
+            self.assertEquals([['10.2.0.2']] * 3, members)
+            # The host is evicted once its results are extracted
+            self.assertNotCached(executor, '10.2.0.2')
+
+    def test_executor_replaces_task_queue_manager_on_failure(self):
+        """
+        Verify a failed play does not leave the host marked as failed.
+        """
+        with patch('commissaire.transport.ansibleapi.TaskQueueManager') as _tqm:
+            _tqm().run.side_effect = (2, 0)
+            _tqm.reset_mock()
+
+            executor = ansibleapi.Executor()
+            self.assertEquals(2, executor.run(
+                '10.2.0.2', 'test/fake_key', self.play_source)[0])
+            self.assertEquals(None, executor.tqm)
+            self.assertEquals(0, executor.run(
+                '10.2.0.2', 'test/fake_key', self.play_source)[0])
+            self.assertEquals(2, _tqm.call_count)
+            self.assertEquals(1, _tqm().cleanup.call_count)
+
+    def test_executor_recycles(self):
+        """
+        Verify the Executor recycles itself after max_plays.
+        """
+        with patch('commissaire.transport.ansibleapi.TaskQueueManager') as _tqm:
+            _tqm().run.return_value = 0
+            _tqm.reset_mock()
+
+            executor = ansibleapi.Executor(max_plays=2)
+            variable_manager = executor.variable_manager
+            for x in range(0, 3):
+                executor.run('10.2.0.2', 'test/fake_key', self.play_source)
+
+            self.assertEquals(2, _tqm.call_count)
+            self.assertEquals(1, _tqm().cleanup.call_count)
+            self.assertNotEqual(variable_manager, executor.variable_manager)
+            self.assertEquals(1, executor.plays_run)
+
+    def test_executor_raises_and_recycles_on_error(self):
+        """
+        Verify the Executor passes on errors and recycles itself.
+        """
+        with patch('commissaire.transport.ansibleapi.TaskQueueManager') as _tqm:
+            _tqm().run.side_effect = Exception('error')
+            _tqm.reset_mock()
+
+            executor = ansibleapi.Executor()
+            self.assertRaises(
+                Exception, executor.run,
+                '10.2.0.2', 'test/fake_key', self.play_source)
+            self.assertEquals(1, _tqm().cleanup.call_count)
+            self.assertEquals(None, executor.tqm)
+
+    def test_executor_evicts_hosts(self):
+        """
+        Verify facts are returned and then evicted from the caches.
+        """
+        with patch('commissaire.transport.ansibleapi.TaskQueueManager') as _tqm:
+            executor = ansibleapi.Executor()
+
+            def run(play):
+                executor.variable_manager._fact_cache['10.2.0.2'] = {
+                    'ansible_processor_cores': 2}
+                return 0
+
+            _tqm().run.side_effect = run
+            result, facts, task_results = executor.run(
+                '10.2.0.2', 'test/fake_key', self.play_source)
+            self.assertEquals({'ansible_processor_cores': 2}, facts)
+            self.assertEquals(0, executor.cached_hosts())
+            self.assertNotCached(executor, '10.2.0.2')
+
+    def test_executor_recycles_at_cache_limit(self):
+        """
+        Verify the Executor recycles when too many hosts are cached.
+        """
+        with patch('commissaire.transport.ansibleapi.TaskQueueManager') as _tqm:
+            _tqm().run.return_value = 0
+            executor = ansibleapi.Executor(max_cached_hosts=2)
+            variable_manager = executor.variable_manager
+            # Facts for hosts which never ran a play through this executor
+            variable_manager._fact_cache['10.2.0.3'] = {}
+            variable_manager._fact_cache['10.2.0.4'] = {}
+            executor.run('10.2.0.2', 'test/fake_key', self.play_source)
+            self.assertNotEqual(variable_manager, executor.variable_manager)
+            self.assertEquals(0, executor.cached_hosts())
+
+    def test_executor_memory_is_bounded(self):
+        """
+        Verify investigating 10k hosts leaves nothing behind.
+        """
+        current = {}
+
+        class FakeTaskQueueManager(object):
+            """
+            Stands in for TaskQueueManager without recording calls.
+            """
+
+            def __init__(self, **kwargs):
+                pass
+
+            def run(self, play):
+                executor.variable_manager._fact_cache[current['ip']] = {
+                    'ansible_distribution': 'Fedora',
+                    'ansible_processor_cores': 2,
+                    'ansible_memory_mb': {'real': {'total': 1024}},
+                    'ansible_mounts': [{'size_total': 1024}],
+                    'ansible_env': dict((str(x), 'x' * 64) for x in range(64)),
+                }
+                return 0
+
+            def cleanup(self):
+                pass
+
+        with patch('commissaire.transport.ansibleapi.TaskQueueManager',
+                   FakeTaskQueueManager):
+            transport = ansibleapi.Transport()
+            executor = transport.executor
+
+            def investigate(start, count):
+                for x in range(start, start + count):
+                    current['ip'] = '10.{0}.{1}.{2}'.format(
+                        x // 65536, (x // 256) % 256, x % 256)
+                    result, facts = transport.get_info(
+                        current['ip'], 'test/fake_key')
+                    self.assertEquals(0, result)
+                    self.assertEquals(2, facts['cpus'])
+                    self.assertTrue(executor.cached_hosts() <= 1)
+
+            # Warm up so lazily created state is not counted
+            investigate(0, 200)
+            gc.collect()
+            retained = len(gc.get_objects())
+            investigate(200, 10000)
+            gc.collect()
+            # A leak of even one object per host would show up here
+            self.assertTrue(len(gc.get_objects()) - retained < 1000)
+            self.assertNotCached(executor, current['ip'])
+            self.assertEquals({}, executor.callback.results)
+            self.assertTrue(executor.plays_run <= executor.max_plays)
+
+
+class Test_TemplateCache(TestCase):
+    """
+    Tests for the TemplateCache class.
+    """
+
+    tpl_vars = {
+        'bootstrap_ip': '10.2.0.2',
+        'kubernetes_api_server_host': '127.0.0.1',
+        'kubernetes_api_server_port': 8080,
+        'kubernetes_bearer_token': 'token',
+        'docker_registry_host': '127.0.0.1',
+        'docker_registry_port': 8080,
+        'etcd_host': '127.0.0.1',
+        'etcd_port': 2379,
+        'flannel_key': '/atomic01/network',
+    }
+
+    def test_host_specific(self):
+        """
+        Verify only templates using host variables are host specific.
+        """
+        templates = ansibleapi.TemplateCache()
+        self.assertTrue(templates.is_host_specific('kubelet'))
+        for tpl_name in ('docker', 'flanneld', 'kube_config', 'kubeconfig'):
+            self.assertFalse(templates.is_host_specific(tpl_name))
+
+    def test_render_files(self):
+        """
+        Verify host independent output is rendered once and files are
+        private to each operation.
+        """
+        templates = ansibleapi.TemplateCache()
+        tpl_names = ('docker', 'kubelet')
+        first = templates.render_files(tpl_names, self.tpl_vars)
+
+        other_vars = dict(self.tpl_vars)
+        other_vars['bootstrap_ip'] = '10.2.0.3'
+        with patch.object(templates.env, 'get_template',
+                          wraps=templates.env.get_template) as _get:
+            second = templates.render_files(tpl_names, other_vars)
+            # Only the host specific template is rendered again
+            self.assertEquals(1, _get.call_count)
+
+        try:
+            # Each operation gets its own files, only readable by the owner
+            for tpl_name in tpl_names:
+                self.assertNotEqual(first[tpl_name], second[tpl_name])
+                self.assertEquals(0o600, stat.S_IMODE(
+                    os.stat(first[tpl_name]).st_mode))
+            with open(first['docker'], 'r') as f, \
+                    open(second['docker'], 'r') as g:
+                self.assertEquals(f.read(), g.read())
+            with open(second['kubelet'], 'r') as f:
+                self.assertTrue('10.2.0.3' in f.read())
+        finally:
+            templates.remove_files(first)
+            templates.remove_files(second)
+        # Removing the files leaves nothing behind
+        for path in list(first.values()) + list(second.values()):
+            self.assertFalse(os.path.exists(os.path.dirname(path)))
+
+        # A config change means the output is rendered again
+        other_vars['etcd_port'] = 4001
+        self.assertNotEqual(
+            templates.render('flanneld', self.tpl_vars),
+            templates.render('flanneld', other_vars))
@@ -0,0 +1,143 @@
+# Copyright (C) 2016  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Test cases for the commissaire.transport.connections module.
+"""
+
+import os
+import shutil
+import tempfile
+
+from . import TestCase
+from commissaire.transport.connections import (
+    CONTROL_DIR, CONTROL_DIR_ENV, ConnectionManager, remove_control_dir)
+from mock import patch
+
+
+class Test_ConnectionManager(TestCase):
+    """
+    Tests for the ConnectionManager class.
+    """
+
+    def before(self):
+        """
+        Sets up a fresh instance of the class before each run.
+        """
+        self.manager = ConnectionManager(
+            tempfile.mkdtemp(prefix='commissaire-test-ssh-'))
+
+    def after(self):
+        """
+        Removes the control directory after each run.
+        """
+        shutil.rmtree(self.manager.control_dir)
+
+    def touch_socket(self, ip):
+        """
+        Creates a fake control socket for a host.
+        """
+        open(self.manager.control_path(ip), 'w').close()
+
+    def test_ssh_args(self):
+        """
+        Verify the ssh arguments use the managed control directory.
+        """
+        self.assertTrue('ControlPath={0}/'.format(
+            self.manager.control_dir) in self.manager.ssh_args)
+        self.assertTrue('ControlMaster=auto' in self.manager.ssh_args)
+
+    def test_is_alive(self):
+        """
+        Verify is_alive checks the master behind the socket.
+        """
+        with patch('commissaire.transport.connections.subprocess') as _sp:
+            # No socket means no need to ask ssh
+            self.assertFalse(self.manager.is_alive('10.2.0.2'))
+            self.assertEquals(0, _sp.call.call_count)
+
+            self.touch_socket('10.2.0.2')
+            _sp.call.return_value = 0
+            self.assertTrue(self.manager.is_alive('10.2.0.2'))
+            _sp.call.return_value = 255
+            self.assertFalse(self.manager.is_alive('10.2.0.2'))
+            command = _sp.call.call_args[0][0]
+            self.assertTrue('check' in command)
+            self.assertEquals('10.2.0.2', command[-1])
+
+    def test_live_hosts(self):
+        """
+        Verify live_hosts reports hosts with live masters.
+        """
+        with patch('commissaire.transport.connections.subprocess') as _sp:
+            _sp.call.return_value = 0
+            self.touch_socket('10.2.0.2')
+            self.touch_socket('10.2.0.3')
+            self.assertEquals(
+                ['10.2.0.2', '10.2.0.3'], sorted(self.manager.live_hosts()))
+
+    def test_prewarm(self):
+        """
+        Verify prewarm opens masters for hosts without one.
+        """
+        with patch('commissaire.transport.connections.subprocess') as _sp:
+            # First host fails to connect, second one works
+            _sp.call.side_effect = (255, 0)
+            result = self.manager.prewarm([
+                ('10.2.0.2', 'test/fake_key'),
+                ('10.2.0.3', 'test/fake_key')])
+            self.assertEquals(['10.2.0.3'], result)
+            self.assertEquals(2, _sp.call.call_count)
+            for call in _sp.call.call_args_list:
+                self.assertTrue('ControlMaster=yes' in call[0][0])
+
+            # Hosts with a live master are not opened again
+            _sp.call.reset_mock()
+            _sp.call.side_effect = None
+            _sp.call.return_value = 0
+            self.touch_socket('10.2.0.3')
+            self.assertEquals(
+                ['10.2.0.3'],
+                self.manager.prewarm([('10.2.0.3', 'test/fake_key')]))
+            self.assertEquals(1, _sp.call.call_count)
+            self.assertTrue('check' in _sp.call.call_args[0][0])
+
+
+class Test_SharedControlDir(TestCase):
+    """
+    Tests for the process wide control directory.
+    """
+
+    def test_shared_control_dir(self):
+        """
+        Verify managers share one control directory which worker processes
+        inherit and only its creator removes.
+        """
+        with patch.dict(CONTROL_DIR, {'path': None}), \
+                patch.dict(os.environ), \
+                patch('commissaire.transport.connections.atexit') as _atexit:
+            os.environ.pop(CONTROL_DIR_ENV, None)
+            path = ConnectionManager().control_dir
+            self.assertEquals(path, ConnectionManager().control_dir)
+            self.assertEquals(path, os.environ[CONTROL_DIR_ENV])
+            _atexit.register.assert_called_once_with(remove_control_dir, path)
+            remove_control_dir(path)
+            self.assertFalse(os.path.isdir(path))
+
+            # A worker uses the directory of the process which started it
+            CONTROL_DIR['path'] = None
+            os.environ[CONTROL_DIR_ENV] = '/tmp/commissaire-ssh-parent'
+            self.assertEquals(
+                '/tmp/commissaire-ssh-parent', ConnectionManager().control_dir)
+            self.assertEquals(1, _atexit.register.call_count)
@@ -0,0 +1,82 @@
+# Copyright (C) 2016  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Test cases for the commissaire.transport.keys module.
+"""
+
+import os
+import shutil
+import stat
+
+from . import TestCase
+from commissaire.transport.keys import KeyProvider
+
+
+class Test_KeyProvider(TestCase):
+    """
+    Tests for the KeyProvider class.
+    """
+
+    def before(self):
+        """
+        Sets up a fresh instance of the class before each run.
+        """
+        self.provider = KeyProvider()
+
+    def after(self):
+        """
+        Removes the key directory after each run.
+        """
+        if self.provider.key_dir is not None:
+            shutil.rmtree(self.provider.key_dir)
+
+    def test_acquire(self):
+        """
+        Verify acquire writes the decoded key readable only by the owner.
+        """
+        # Nothing is created until a key is needed
+        self.assertEquals(None, self.provider.key_dir)
+        key_file = self.provider.acquire('dGVzdAo=')
+        self.assertEquals(self.provider.key_dir, os.path.dirname(key_file))
+        with open(key_file, 'rb') as f:
+            self.assertEquals(b'test\n', f.read())
+        self.assertEquals(0o600, stat.S_IMODE(os.stat(key_file).st_mode))
+
+    def test_acquire_shares_key_files(self):
+        """
+        Verify the same key is only written once.
+        """
+        first = self.provider.acquire('dGVzdAo=')
+        second = self.provider.acquire('dGVzdAo=')
+        other = self.provider.acquire('b3RoZXIK')
+        self.assertEquals(first, second)
+        self.assertNotEqual(first, other)
+        self.assertEquals(2, self.provider.in_use())
+
+    def test_release(self):
+        """
+        Verify the key file is removed with the last reference.
+        """
+        key_file = self.provider.acquire('dGVzdAo=')
+        self.provider.acquire('dGVzdAo=')
+
+        self.provider.release(key_file)
+        self.assertTrue(os.stat(key_file))
+        self.provider.release(key_file)
+        self.assertRaises(OSError, os.stat, key_file)
+        self.assertEquals(0, self.provider.in_use())
+
+        # Unknown files are ignored
+        self.provider.release(key_file)
@@ -0,0 +1,252 @@
+# Copyright (C) 2016  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Test cases for the commissaire.transport.worker module.
+"""
+
+import gevent
+import json
+import mock
+import os
+import shutil
+import sys
+import tempfile
+
+from io import StringIO
+
+from . import TestCase
+from commissaire.compat.urlparser import urlparse
+from commissaire.config import Config
+from commissaire.oscmd.fedora import OSCmd
+from commissaire.transport import connections, worker
+
+#: Worker which answers every request with a fixed result
+ECHO_WORKER = [sys.executable, '-c', (
+    'import sys, json\n'
+    'for line in iter(sys.stdin.readline, ""):\n'
+    '    request = json.loads(line)\n'
+    '    sys.stdout.write(json.dumps({"result": [0, request]}) + "\\n")\n'
+    '    sys.stdout.flush()\n')]
+
+#: Worker which answers with its SSH control directory
+CONTROL_DIR_WORKER = [sys.executable, '-c', (
+    'import sys, os, json\n'
+    'for line in iter(sys.stdin.readline, ""):\n'
+    '    sys.stdout.write(json.dumps({{"result": os.environ["{0}"]}}) + '
+    '"\\n")\n'
+    '    sys.stdout.flush()\n').format(connections.CONTROL_DIR_ENV)]
+
+
+class Test_Worker(TestCase):
+    """
+    Tests for the worker request handling.
+    """
+
+    def test_config_round_trip(self):
+        """
+        Verify configs survive serialization.
+        """
+        config = Config(
+            etcd={'uri': urlparse('http://127.0.0.1:2379')},
+            kubernetes={'uri': urlparse('http://127.0.0.1:8080'),
+                        'token': 'token'})
+        result = worker.config_from_dict(
+            json.loads(json.dumps(worker.config_to_dict(config))))
+        self.assertEquals(config.etcd['uri'], result.etcd['uri'])
+        self.assertEquals(config.kubernetes, result.kubernetes)
+
+    def test_handle(self):
+        """
+        Verify handle rebuilds the arguments and returns the result.
+        """
+        transport = mock.MagicMock()
+        transport.restart.return_value = (0, {})
+        response = worker.handle(transport, {
+            'method': 'restart',
+            'args': ['10.2.0.2', '/tmp/key', 'fedora']})
+        self.assertEquals({'result': (0, {})}, response)
+        args = transport.restart.call_args[0]
+        self.assertEquals('10.2.0.2', args[0])
+        self.assertTrue(isinstance(args[2], OSCmd))
+
+    def test_handle_errors(self):
+        """
+        Verify handle reports errors instead of raising.
+        """
+        transport = mock.MagicMock()
+        transport.get_info.side_effect = Exception('failed')
+        self.assertEquals(
+            {'error': 'failed'},
+            worker.handle(transport, {
+                'method': 'get_info', 'args': ['10.2.0.2', '/tmp/key']}))
+        self.assertTrue('error' in worker.handle(
+            transport, {'method': '__init__', 'args': []}))
+
+    def test_serve_pipe(self):
+        """
+        Verify serve_pipe answers one line per request.
+        """
+        transport = mock.MagicMock()
+        transport.get_info.return_value = (0, {'os': 'fedora'})
+        infile = StringIO(u'{"method": "get_info", "args": ["a", "b"]}\n'
+                          u'not json\n')
+        outfile = mock.MagicMock()
+        worker.serve_pipe(transport, infile, outfile)
+        lines = [json.loads(x[0][0]) for x in outfile.write.call_args_list]
+        self.assertEquals([{'result': [0, {'os': 'fedora'}]},
+                           {'error': 'Invalid request'}], lines)
+
+    def test_get_transport(self):
+        """
+        Verify get_transport only uses processes when a pool is set.
+        """
+        with mock.patch('commissaire.transport.ansibleapi.Transport') as _tp:
+            self.assertEquals(_tp(), worker.get_transport())
+        pool = mock.MagicMock()
+        with mock.patch.dict(worker.WORKERS, {'pool': pool}):
+            transport = worker.get_transport()
+            self.assertTrue(isinstance(transport, worker.ProcessTransport))
+            self.assertEquals(pool, transport.pool)
+
+
+class Test_ProcessTransport(TestCase):
+    """
+    Tests for the ProcessTransport class.
+    """
+
+    def test_upgrade(self):
+        """
+        Verify operations are sent to the pool as plain data.
+        """
+        pool = mock.MagicMock()
+        pool.request.return_value = {'result': [0, {}]}
+        transport = worker.ProcessTransport(pool)
+        self.assertEquals(
+            (0, {}), transport.upgrade('10.2.0.2', '/tmp/key', OSCmd()))
+        pool.request.assert_called_once_with({
+            'method': 'upgrade',
+            'args': ('10.2.0.2', '/tmp/key', 'fedora'),
+            'kwargs': {}})
+
+    def test_errors_raise(self):
+        """
+        Verify worker errors raise in the caller.
+        """
+        pool = mock.MagicMock()
+        pool.request.return_value = {'error': 'failed'}
+        transport = worker.ProcessTransport(pool)
+        self.assertRaises(
+            Exception, transport.get_info, '10.2.0.2', '/tmp/key')
+
+    def test_with_worker_processes(self):
+        """
+        Verify requests round trip through real worker processes.
+        """
+        pool = worker.WorkerPool(1, command=ECHO_WORKER)
+        try:
+            transport = worker.ProcessTransport(pool)
+            result = transport.get_info('10.2.0.2', '/tmp/key', fast=True)
+            self.assertEquals(0, result[0])
+            self.assertEquals('get_info', result[1]['method'])
+            self.assertEquals({'fast': True}, result[1]['kwargs'])
+        finally:
+            pool.close()
+
+    def test_dead_workers_are_replaced(self):
+        """
+        Verify a worker which exits is replaced.
+        """
+        pool = worker.WorkerPool(1, command=[sys.executable, '-c', 'pass'])
+        try:
+            self.assertRaises(Exception, pool.request, {'method': 'x'})
+            self.assertEquals(1, pool._idle.qsize())
+        finally:
+            pool.close()
+
+    def test_workers_share_control_dir(self):
+        """
+        Verify every worker uses the pool's SSH control directory.
+        """
+        pool = worker.WorkerPool(2, command=CONTROL_DIR_WORKER)
+        try:
+            for x in range(0, 2):
+                self.assertEquals(
+                    {'result': connections.shared_control_dir()},
+                    pool.request({'method': 'prewarm'}))
+        finally:
+            pool.close()
+
+
+class Test_RemoteWorkerPool(TestCase):
+    """
+    Tests for the RemoteWorkerPool class and serve_socket.
+    """
+
+    def before(self):
+        """
+        Sets up a fresh socket path for each test.
+        """
+        self.tmp_dir = tempfile.mkdtemp(prefix='commissaire-test-worker-')
+        self.path = os.path.join(self.tmp_dir, 'transport.sock')
+
+    def after(self):
+        """
+        Removes the socket path.
+        """
+        shutil.rmtree(self.tmp_dir)
+
+    def serve(self, pool):
+        """
+        Runs serve_socket in a greenlet until it is listening.
+        """
+        server = gevent.spawn(worker.serve_socket, self.path, pool)
+        while not os.path.exists(self.path):
+            gevent.sleep(0.01)
+        return server
+
+    def test_request(self):
+        """
+        Verify requests round trip through the unix socket.
+        """
+        pool = mock.MagicMock()
+        pool.request.return_value = {'result': [0, {}]}
+        server = self.serve(pool)
+        try:
+            transport = worker.ProcessTransport(
+                worker.RemoteWorkerPool(self.path))
+            self.assertEquals(
+                (0, {}), transport.upgrade('10.2.0.2', '/tmp/key', OSCmd()))
+            pool.request.assert_called_once_with({
+                'method': 'upgrade',
+                'args': ['10.2.0.2', '/tmp/key', 'fedora'],
+                'kwargs': {}})
+            self.assertEquals(0o600, os.stat(self.path).st_mode & 0o777)
+        finally:
+            server.kill()
+
+    def test_pool_errors_are_returned(self):
+        """
+        Verify pool errors are sent back and raised in the caller.
+        """
+        pool = mock.MagicMock()
+        pool.request.side_effect = Exception('worker exited')
+        server = self.serve(pool)
+        try:
+            transport = worker.ProcessTransport(
+                worker.RemoteWorkerPool(self.path))
+            self.assertRaises(
+                Exception, transport.get_info, '10.2.0.2', '/tmp/key')
+        finally:
+            server.kill()